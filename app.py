@@ -1,44 +1,161 @@
 """
 This script deploys a multi-stack AWS infrastructure using the AWS CDK.
-It creates a KeyStack for an SSH key pair, a BastionStack for an EC2
-instance, and a SageMakerStack for a SageMaker NoteBook Instance
-that is accessible via SSH.
+It creates a NetworkStack for the VPC and security groups, a KeyStack for
+an SSH key pair, a LifecycleStack for the notebooks' lifecycle config, a
+BastionStack for an EC2 instance (or an InstanceConnectStack for an EC2
+Instance Connect Endpoint, see ssh.connection in config.yaml), and a
+SageMakerStack for each SageMaker NoteBook Instance that is accessible
+via SSH. All notebooks share the
+key, bastion and VPC.
+
+Stacks only depend on the stacks whose resources they use, so that
+``cdk deploy --all --concurrency N`` deploys the network and the key in
+parallel, then the bastion and the lifecycle config, which authorizes
+the key on the notebooks, and then the notebooks in parallel.
+
+With SAGEMAKER_SSH_ENVIRONMENT set to the name of one of the
+``environments`` in config.yaml, the app is built for that environment's
+account and region, and its stack, export and resource names are
+prefixed with the environment's name, so that they don't collide with
+another's.
+deploy.py sets it when it deploys the environments.
 """
 import os
 
 import aws_cdk as cdk
-import yaml
 
+from app_config import (
+    ENVIRONMENT_VARIABLE,
+    environment,
+    load_config,
+    notebooks,
+)
 from stacks.bastion_stack import BastionStack
+from stacks.instance_connect_stack import InstanceConnectStack
 from stacks.key_stack import KeyStack
+from stacks.lifecycle_stack import LifecycleStack
+from stacks.network_stack import NetworkStack
 from stacks.sagemaker_stack import SageMakerStack
 
-# Get configs
-with open("config.yaml") as file:
-    config = yaml.load(file, Loader=yaml.SafeLoader)
-region = config["region"]
-suffix = config["notebook"]["name"]
 
-env = cdk.Environment(
-    account=os.environ["CDK_DEFAULT_ACCOUNT"],
-    region=os.environ["CDK_DEFAULT_REGION"] if region == "default" else region,
-)
+def build(app, config, env, namespace=None):
+    """Adds the stacks to ``app`` and returns them by construct ID.
+
+    With a ``namespace``, the name of a target environment, the stacks'
+    CloudFormation names, export names and the names of their resources
+    start with it.
+    """
+    suffix = config["notebook"]["name"]
+
+    def stack_options(id):
+        """Returns the keyword arguments of every stack."""
+        if namespace:
+            return {"env": env, "stack_name": f"{namespace}-{id}"}
+        return {"env": env}
+
+    # Create the VPC and the security groups
+    network = NetworkStack(
+        app,
+        f"NetworkStack-{suffix}",
+        config=config,
+        namespace=namespace,
+        **stack_options(f"NetworkStack-{suffix}"),
+    )
+
+    # Create a new SSH key pair
+    key = KeyStack(
+        app,
+        f"KeyStack-{suffix}",
+        config=config,
+        namespace=namespace,
+        **stack_options(f"KeyStack-{suffix}"),
+    )
+
+    # Create the lifecycle config of the notebooks. It authorizes the key
+    # pair when a notebook starts, so it depends on the KeyStack, and
+    # mounts the shared datasets of the NetworkStack if there are any.
+    lifecycle = LifecycleStack(
+        app,
+        f"LifecycleStack-{suffix}",
+        key_parameter_name=key.parameter_name,
+        file_system_dns_name=network.file_system_dns_name,
+        config=config,
+        namespace=namespace,
+        **stack_options(f"LifecycleStack-{suffix}"),
+    )
+
+    # Create the hop to the notebooks: a new EC2 instance using the key
+    # pair, or an EC2 Instance Connect Endpoint. Their VPC and security
+    # group references make them depend on the NetworkStack.
+    if config["ssh"].get("connection", "bastion") == "instance-connect":
+        bastion = InstanceConnectStack(
+            app,
+            f"InstanceConnectStack-{suffix}",
+            vpc=network.vpc,
+            security_group=network.bastion_security_group,
+            **stack_options(f"InstanceConnectStack-{suffix}"),
+        )
+    else:
+        bastion = BastionStack(
+            app,
+            f"BastionStack-{suffix}",
+            vpc=network.vpc,
+            security_group=network.bastion_security_group,
+            config=config,
+            namespace=namespace,
+            **stack_options(f"BastionStack-{suffix}"),
+        )
+        bastion.add_dependency(key)
+
+    # Create a notebook instance per configured notebook. They don't use
+    # the bastion, so they deploy alongside it.
+    notebook_stacks = []
+    for notebook in notebooks(config):
+        notebook_stack = SageMakerStack(
+            app,
+            f"SageMakerStack-{notebook['name']}",
+            notebook=notebook,
+            key_parameter_name=key.parameter_name,
+            config=config,
+            namespace=namespace,
+            **stack_options(f"SageMakerStack-{notebook['name']}"),
+        )
+        notebook_stack.add_dependency(network)
+        notebook_stack.add_dependency(lifecycle)
+        notebook_stacks.append(notebook_stack)
+
+    stacks = [network, key, lifecycle, bastion, *notebook_stacks]
+
+    # Add tags to stacks
+    for stack in stacks:
+        cdk.Tags.of(stack).add("Creator", "CDK")
+        cdk.Tags.of(stack).add("Description", "Dev stack")
+        if namespace:
+            cdk.Tags.of(stack).add("Environment", namespace)
 
-app = cdk.App()
+    return {stack.node.id: stack for stack in stacks}
 
-# Generate a new SSH key pair using Paramiko
-key = KeyStack(app, f"KeyStack-{suffix}", env=env)
 
-# Create a new EC2 instance using the key pair
-bastion = BastionStack(app, f"BastionStack-{suffix}", env=env)
-bastion.add_dependency(key)
+if __name__ == "__main__":
+    # Get configs
+    config = load_config()
+    region = config["region"]
+    account = os.environ["CDK_DEFAULT_ACCOUNT"]
 
-notebook = SageMakerStack(app, f"SageMakerStack-{suffix}", env=env)
-notebook.add_dependency(bastion)
+    # Or the account and region of the selected environment
+    namespace = os.environ.get(ENVIRONMENT_VARIABLE) or None
+    if namespace:
+        target = environment(config, namespace)
+        account = target.get("account") or account
+        region = target["region"]
 
-# Add tags to stacks
-for stack in [key, bastion, notebook]:
-    cdk.Tags.of(stack).add("Creator", "CDK")
-    cdk.Tags.of(stack).add("Description", "Dev stack")
+    env = cdk.Environment(
+        account=account,
+        region=(
+            os.environ["CDK_DEFAULT_REGION"] if region == "default" else region
+        ),
+    )
 
-app.synth()
+    app = cdk.App()
+    build(app, config, env, namespace)
+    app.synth()
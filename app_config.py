@@ -0,0 +1,335 @@
+"""
+The app config, config.yaml, shared by the CDK app and obtain_key.py.
+
+The file is found next to this module rather than in the current working
+directory, parsed once per process (and again only if it changes), and
+checked against ``SCHEMA`` before anything uses it, so that a misspelled
+or missing key is reported up front with its full name.
+"""
+
+import os
+import re
+
+import yaml
+
+from ssh_profiles import PROFILE_KEYS, PROFILES
+
+# The directory of the app, which holds config.yaml and the lifecycle
+# scripts
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_PATH = os.path.join(PROJECT_DIR, "config.yaml")
+
+
+class ConfigError(ValueError):
+    """Raised when config.yaml doesn't match the schema."""
+
+
+class Choice:
+    """A schema entry for a string that takes one of a few values."""
+
+    def __init__(self, *values):
+        self.values = values
+
+
+class MapOf:
+    """A schema entry for a mapping of names to values of one schema."""
+
+    def __init__(self, schema):
+        self.schema = schema
+
+
+class Optional:
+    """A schema entry for a key that may be left out."""
+
+    def __init__(self, schema):
+        self.schema = schema
+
+
+NOTEBOOK_SCHEMA = {
+    "name": str,
+    "append_username": bool,
+    "instance_type": str,
+    "volume_size": int,
+    "services": Optional(MapOf(int)),
+    "direct_internet_access": Optional(bool),
+}
+
+# A lifecycle step, see lifecycle_steps.py
+LIFECYCLE_STEP_SCHEMA = {
+    "name": str,
+    "script": Optional(str),
+    "run": Optional(str),
+    "after": Optional([str]),
+    "on": Optional([Choice("create", "start")]),
+}
+
+# A target account and region of the app, see deploy.py
+ENVIRONMENT_SCHEMA = {
+    "name": str,
+    "region": str,
+    "account": Optional(str),
+    "profile": Optional(str),
+}
+
+# Selects the target environment that app.py builds
+ENVIRONMENT_VARIABLE = "SAGEMAKER_SSH_ENVIRONMENT"
+
+# Environment names prefix stack and export names, so they take the
+# characters CloudFormation allows there
+ENVIRONMENT_NAME = re.compile(r"[A-Za-z][A-Za-z0-9-]*")
+
+# The layout of config.yaml. Sections are dicts, lists hold one schema for
+# all of their items.
+SCHEMA = {
+    "region": str,
+    # Deploy the app to each of these accounts and regions instead
+    "environments": Optional([ENVIRONMENT_SCHEMA]),
+    "ec2": {"instance_type": str, "bastions": Optional(int)},
+    "network": Optional(
+        {"vpc_endpoints": Optional(bool), "nat_gateway": Optional(bool)}
+    ),
+    # A shared dataset file system, see NetworkStack.add_file_system
+    "efs": Optional(
+        {
+            "throughput_mode": Optional(
+                Choice("bursting", "elastic", "provisioned")
+            ),
+            "provisioned_mibps": Optional(int),
+            "mount_point": Optional(str),
+        }
+    ),
+    "notebook": NOTEBOOK_SCHEMA,
+    # Entries override the "notebook" settings, so all keys are optional
+    "notebooks": Optional(
+        [{key: Optional(value) for key, value in NOTEBOOK_SCHEMA.items()}]
+    ),
+    "lifecycle": {
+        "name": str,
+        "toolchain_cache_mb": Optional(int),
+        "steps": Optional([LIFECYCLE_STEP_SCHEMA]),
+    },
+    "ssh": {
+        "key_name": str,
+        "key_type": Optional(Choice("rsa", "ed25519")),
+        "key_storage": Optional(Choice("file", "agent")),
+        "agent_lifetime": Optional(int),
+        "connection": Optional(Choice("bastion", "instance-connect")),
+        "config_suffix": str,
+        "include_file": Optional(str),
+        "profile": Optional(str),
+        # Checked against ssh_profiles.PROFILE_KEYS by _check_ssh_profiles
+        "profiles": Optional(MapOf(dict)),
+    },
+}
+
+_TYPE_NAMES = {str: "a string", int: "an integer", bool: "true or false"}
+
+# Parsed configs by path, with the file signature they were parsed from
+_CACHE = {}
+
+
+def _check(value, schema, name, errors):
+    """Appends the ways ``value`` doesn't match ``schema`` to errors."""
+    if isinstance(schema, Optional):
+        schema = schema.schema
+    if isinstance(schema, dict):
+        if not isinstance(value, dict):
+            errors.append(f"{name} must be a section with keys")
+            return
+        for key in value:
+            if key not in schema:
+                import difflib  # Only needed for errors
+
+                close = difflib.get_close_matches(str(key), schema, n=1)
+                hint = f", did you mean {close[0]}?" if close else ""
+                errors.append(f"unknown key {name}.{key}{hint}".lstrip("."))
+        for key, entry in schema.items():
+            if key in value and value[key] is not None:
+                _check(value[key], entry, f"{name}.{key}".lstrip("."), errors)
+            elif not isinstance(entry, Optional):
+                errors.append(f"missing key {name}.{key}".replace(" .", " "))
+    elif isinstance(schema, list):
+        if not isinstance(value, list):
+            errors.append(f"{name} must be a list")
+            return
+        for i, item in enumerate(value):
+            _check(item, schema[0], f"{name}[{i}]", errors)
+    elif isinstance(schema, MapOf):
+        if not isinstance(value, dict):
+            errors.append(f"{name} must be a section with keys")
+            return
+        for key, item in value.items():
+            _check(item, schema.schema, f"{name}.{key}", errors)
+    elif isinstance(schema, Choice):
+        if value not in schema.values:
+            errors.append(f"{name} must be one of {', '.join(schema.values)}")
+    elif not isinstance(value, schema) or (
+        isinstance(value, bool) and schema is not bool
+    ):
+        type_name = _TYPE_NAMES.get(schema, schema.__name__)
+        errors.append(f"{name} must be {type_name}, got {value!r}")
+
+
+def _check_network(config, errors):
+    """Appends the notebooks that would have no route to AWS, and a pool
+    without bastions, to errors."""
+    if config["ec2"].get("bastions", 1) < 1:
+        errors.append("ec2.bastions must be at least 1")
+    network = config.get("network") or {}
+    if network.get("nat_gateway", True) or network.get("vpc_endpoints"):
+        return
+    for notebook in notebooks(config):
+        if notebook.get("direct_internet_access") is False:
+            errors.append(
+                f"notebook {notebook['name']} has no direct internet access, "
+                "so it needs network.nat_gateway or network.vpc_endpoints"
+            )
+
+
+def _check_efs(config, errors):
+    """Appends a provisioned throughput without its amount to errors."""
+    efs = config.get("efs") or {}
+    if efs.get("throughput_mode") == "provisioned":
+        if "provisioned_mibps" not in efs:
+            errors.append(
+                "efs.throughput_mode provisioned needs efs.provisioned_mibps"
+            )
+
+
+def _check_environments(config, errors):
+    """Appends invalid or repeated environment names to errors."""
+    seen = set()
+    for environment in config.get("environments") or []:
+        name = environment["name"]
+        if not ENVIRONMENT_NAME.fullmatch(name):
+            errors.append(
+                f"environment name {name!r} must start with a letter and "
+                "have only letters, digits and hyphens"
+            )
+        elif name in seen:
+            errors.append(f"environment {name} is listed twice")
+        seen.add(name)
+
+
+def _check_ssh_profiles(config, errors):
+    """Appends an unknown SSH profile and unknown profile settings to
+    errors."""
+    import difflib  # Only needed for errors
+
+    profiles = config["ssh"].get("profiles") or {}
+    name = config["ssh"].get("profile", "default")
+    if name not in profiles and name not in PROFILES:
+        available = sorted({*PROFILES, *profiles})
+        close = difflib.get_close_matches(name, available, n=1)
+        hint = f", did you mean {close[0]}?" if close else ""
+        errors.append(
+            f"ssh.profile {name!r} is not one of {', '.join(available)}{hint}"
+        )
+    for profile, settings in profiles.items():
+        for key in settings:
+            if key in PROFILE_KEYS:
+                continue
+            close = difflib.get_close_matches(str(key), PROFILE_KEYS, n=1)
+            hint = f", did you mean {close[0]}?" if close else ""
+            errors.append(f"unknown key ssh.profiles.{profile}.{key}{hint}")
+
+
+def validate(config, path=CONFIG_PATH):
+    """Checks a parsed config against ``SCHEMA``.
+
+    Raises
+    ------
+    ConfigError
+        Listing every problem found.
+    """
+    errors = []
+    _check(config, SCHEMA, "", errors)
+    if not errors:
+        _check_network(config, errors)
+        _check_efs(config, errors)
+        _check_environments(config, errors)
+        _check_ssh_profiles(config, errors)
+    if errors:
+        raise ConfigError(
+            f"Invalid {path}:\n" + "\n".join(f"- {e}" for e in errors)
+        )
+
+
+def load_config(path=None):
+    """Returns the parsed and validated app config.
+
+    The result is cached, and shared between callers, which must not
+    change it.
+
+    Parameters
+    ----------
+    path : str
+        The config file. Defaults to the config.yaml of this app.
+    """
+    path = os.path.abspath(path or CONFIG_PATH)
+    st = os.stat(path)
+    signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+    cached = _CACHE.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    with open(path) as file:
+        config = yaml.load(file, Loader=yaml.SafeLoader)
+    validate(config, path)
+    _CACHE[path] = (signature, config)
+    return config
+
+
+def notebooks(config):
+    """Returns the settings of each notebook to deploy.
+
+    Each entry of the optional ``notebooks`` list overrides the defaults
+    in ``notebook``. Without that list, the single ``notebook`` is
+    deployed.
+    """
+    defaults = config["notebook"]
+    entries = config.get("notebooks") or [{}]
+    return [dict(defaults, **entry) for entry in entries]
+
+
+def environments(config):
+    """Returns the configured target environments, by name."""
+    return {
+        environment["name"]: environment
+        for environment in config.get("environments") or []
+    }
+
+
+def environment(config, name):
+    """Returns the settings of the target environment called ``name``.
+
+    Raises
+    ------
+    ConfigError
+        If config.yaml doesn't list it.
+    """
+    try:
+        return environments(config)[name]
+    except KeyError:
+        names = ", ".join(environments(config)) or "none"
+        raise ConfigError(
+            f"Unknown environment {name}, config.yaml lists: {names}"
+        ) from None
+
+
+def export_name(name, namespace=None):
+    """Returns the name of a CloudFormation export of the app.
+
+    Export names are unique per account and region, so the stacks of an
+    environment prefix them with its name, ``namespace``.
+    """
+    return physical_name(name, namespace)
+
+
+def physical_name(name, namespace=None):
+    """Returns the name of a named resource of the app, such as the key
+    pair, the lifecycle config or a notebook instance.
+
+    Like export names, they are unique per account and region, so the
+    stacks of an environment prefix them with its name, ``namespace``.
+    """
+    return f"{namespace}-{name}" if namespace else name
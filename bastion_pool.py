@@ -0,0 +1,168 @@
+"""
+Picks the fastest healthy bastion of a pool, for each SSH connection.
+
+With several bastions (``ec2.bastions`` in config.yaml), the notebook
+hosts that obtain_key.py writes connect through this script instead of a
+fixed ProxyJump::
+
+    ProxyCommand python3 bastion_pool.py proxy %h %p bastion-1=203.0.113.10
+        bastion-2=203.0.113.11
+
+It probes every bastion at once, by the time its SSH server takes to send
+its banner, which also catches a bastion that accepts connections but is
+too loaded to answer, and runs ``ssh -W`` through the fastest one. The
+probe results are cached for half a minute, so that the connections VS
+Code opens in a burst don't each probe again.
+
+It runs on every connection, so it only uses the standard library.
+"""
+
+import argparse
+import json
+import os
+import shlex
+import socket
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# How long a probe waits for a bastion's banner, in seconds
+PROBE_TIMEOUT = 2.0
+
+# How long probe results are reused, in seconds
+DEFAULT_TTL = 30.0
+
+
+def default_cache_path():
+    """Returns the probe cache path, under $XDG_CACHE_HOME if it is set."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(
+        os.path.join("~", ".cache")
+    )
+    return os.path.join(cache_home, "sagemaker-ssh", "bastions.json")
+
+
+def probe(address, port=22, timeout=PROBE_TIMEOUT):
+    """Returns the seconds until ``address`` sent an SSH banner, or None
+    if it didn't within ``timeout``."""
+    start = time.perf_counter()
+    try:
+        with socket.create_connection((address, port), timeout) as sock:
+            sock.settimeout(max(0.0, timeout - (time.perf_counter() - start)))
+            banner = sock.recv(4)
+    except OSError:
+        return None
+    if banner != b"SSH-":
+        return None
+    return time.perf_counter() - start
+
+
+def probe_all(addresses, port=22, timeout=PROBE_TIMEOUT, probe=probe):
+    """Probes the addresses concurrently.
+
+    Returns
+    -------
+    rtts : dict
+        The probe time of each address, None for the unhealthy ones.
+    """
+    with ThreadPoolExecutor(max_workers=len(addresses)) as pool:
+        results = pool.map(lambda a: probe(a, port, timeout), addresses)
+        return dict(zip(addresses, results))
+
+
+class BastionPool:
+    """
+    Selects the fastest healthy bastion, with the probes cached.
+
+    Parameters
+    ----------
+    path : str
+        The cache file. Defaults to ``default_cache_path()``.
+    ttl : float
+        How long probe results are reused, in seconds.
+    clock : callable
+        Returns the current time in seconds, for tests.
+    probe : callable
+        Probes an address, see ``probe``.
+    """
+
+    def __init__(
+        self, path=None, ttl=DEFAULT_TTL, clock=time.time, probe=probe
+    ):
+        self.path = path or default_cache_path()
+        self.ttl = ttl
+        self.clock = clock
+        self.probe = probe
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write(self, entries):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    def rtts(self, addresses, port=22):
+        """Returns the probe time of each address, None for the unhealthy
+        ones, from the cache if it is recent enough."""
+        key = f"{','.join(sorted(addresses))}:{port}"
+        entries = self._read()
+        entry = entries.get(key)
+        now = self.clock()
+        if entry and 0 <= now - entry["checked_at"] < self.ttl:
+            return entry["rtts"]
+        rtts = probe_all(addresses, port, probe=self.probe)
+        entries[key] = {"checked_at": now, "rtts": rtts}
+        try:
+            self._write(entries)
+        except OSError:
+            pass  # Only a cache
+        return rtts
+
+    def select(self, addresses, port=22):
+        """Returns the fastest healthy address, or the first one if none
+        is healthy, so that ssh reports the error."""
+        if len(addresses) == 1:
+            return addresses[0]
+        rtts = self.rtts(addresses, port)
+        healthy = [a for a in addresses if rtts.get(a) is not None]
+        if not healthy:
+            return addresses[0]
+        return min(healthy, key=lambda address: rtts[address])
+
+
+def proxy_command(bastions):
+    """Returns the ProxyCommand of a notebook host that goes through the
+    fastest of ``bastions``, the IP addresses by SSH host name."""
+    command = [sys.executable, os.path.abspath(__file__), "proxy"]
+    command += [f"{host}={address}" for host, address in bastions.items()]
+    return f"{shlex.join(command[:3])} %h %p {shlex.join(command[3:])}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    proxy = subparsers.add_parser(
+        "proxy", help="Connect to HOST:PORT through the fastest bastion"
+    )
+    proxy.add_argument("host")
+    proxy.add_argument("port")
+    proxy.add_argument(
+        "bastions", nargs="+", metavar="HOST=ADDRESS", help="The bastions"
+    )
+    args = parser.parse_args(argv)
+
+    hosts = dict(bastion.split("=", 1)[::-1] for bastion in args.bastions)
+    address = BastionPool().select(list(hosts))
+    os.execvp("ssh", ["ssh", "-W", f"{args.host}:{args.port}", hosts[address]])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+Measures connection latency and bulk throughput through the bastion for
+each SSH connection profile, against two local sshd processes standing in
+for the bastion and the notebook.
+
+For each profile the host blocks are generated the way obtain_key.py
+writes them, and compared with the "legacy" blocks that used
+``ProxyCommand ssh -W`` without connection sharing. Three numbers are
+reported:
+
+- cold: a connection with no shared connection open, i.e. two handshakes
+- warm: a connection while the shared connections are open
+- throughput: copying a file to the notebook with ``cat > /dev/null``
+
+Requires the OpenSSH server (sshd), which is run as the current user on
+free local ports.
+
+Usage: python benchmarks/bench_handshake.py [--runs N] [--size MB]
+"""
+
+import argparse
+import base64
+import getpass
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from obtain_key import host_entries  # noqa: E402
+from ssh_profiles import PROFILES, load_profile  # noqa: E402
+from ssh_utils import SSHConfig  # noqa: E402
+
+SSHD_CONFIG = """\
+ListenAddress 127.0.0.1
+Port {port}
+HostKey {directory}/host_key
+PidFile {directory}/{name}.pid
+AuthorizedKeysFile {directory}/authorized_keys
+PasswordAuthentication no
+KbdInteractiveAuthentication no
+UsePAM no
+StrictModes no
+AllowTcpForwarding yes
+"""
+
+
+def find_sshd():
+    """Returns the path of sshd, which must be run by its absolute path."""
+    return shutil.which("sshd") or next(
+        (
+            path
+            for path in ("/usr/sbin/sshd", "/usr/local/sbin/sshd")
+            if os.path.exists(path)
+        ),
+        None,
+    )
+
+
+def free_port():
+    """Returns a local TCP port that is free right now."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    """Waits until something listens on ``port``."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def start_sshd(sshd, directory, name):
+    """Starts an sshd stand-in and returns its process and port."""
+    port = free_port()
+    config_path = os.path.join(directory, f"{name}_sshd_config")
+    with open(config_path, "w") as f:
+        f.write(SSHD_CONFIG.format(port=port, directory=directory, name=name))
+    process = subprocess.Popen(
+        [sshd, "-D", "-e", "-f", config_path],
+        stderr=open(os.path.join(directory, f"{name}.log"), "w"),
+    )
+    wait_for_port(port)
+    return process, port
+
+
+def keygen(path, key_type):
+    subprocess.run(
+        ["ssh-keygen", "-q", "-t", key_type, "-N", "", "-f", path],
+        check=True,
+    )
+
+
+def write_config(path, directory, profile_name, ports, key_type):
+    """Writes the bastion and notebook blocks for a profile.
+
+    The blocks are generated by obtain_key.host_entries and only pointed
+    at the stand-ins: their ports, the current user, and a control socket
+    directory inside ``directory``.
+    """
+    settings = {
+        "key_filepath": os.path.join(directory, f"id_{key_type}"),
+        "connection": "bastion",
+        "bastion_host_name": "bastion",
+        "bastions": {"bastion": "127.0.0.1"},
+        "notebooks": [{"instance_name": "notebook", "host_name": "notebook"}],
+        "profile": load_profile(
+            "default" if profile_name == "legacy" else profile_name
+        ),
+    }
+    hosts = host_entries(settings, {"notebook": "127.0.0.1"})
+    for host, options in hosts.items():
+        options.pop("LocalForward", None)
+        options.pop("ForwardX11", None)
+        options.update(
+            User=getpass.getuser(),
+            Port=str(ports[host]),
+            UserKnownHostsFile="/dev/null",
+            StrictHostKeyChecking="no",
+            LogLevel="ERROR",
+        )
+        if "ControlPath" in options and options["ControlPath"] != "none":
+            options["ControlPath"] = os.path.join(directory, "%C")
+        if profile_name == "legacy":
+            for key in ("ControlMaster", "ControlPath", "ControlPersist"):
+                options.pop(key, None)
+    if profile_name == "legacy":
+        del hosts["notebook"]["ProxyJump"]
+        hosts["notebook"]["ProxyCommand"] = f"ssh -F {path} -W %h:%p bastion"
+    ssh_config = SSHConfig(path)
+    with ssh_config.transaction() as txn:
+        for host, options in hosts.items():
+            txn.add_host(host, **options)
+
+
+def ssh(config_path, *args, **kwargs):
+    return subprocess.run(
+        ["ssh", "-F", config_path, *args], check=True, **kwargs
+    )
+
+
+def close_connections(config_path):
+    """Closes the shared connections, if there are any."""
+    for host in ("notebook", "bastion"):
+        subprocess.run(
+            ["ssh", "-F", config_path, "-O", "exit", host],
+            stderr=subprocess.DEVNULL,
+        )
+
+
+def timed(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def benchmark(config_path, runs, payload, host="notebook"):
+    """Returns the median cold and warm connect times, and the throughput.
+
+    ``payload`` is the path of the file to copy for the throughput.
+    """
+    connect = lambda: ssh(config_path, host, "true")  # noqa: E731
+    cold = []
+    for _ in range(runs):
+        close_connections(config_path)
+        cold.append(timed(connect))
+    # With sharing, the last cold run left the connections open
+    warm = [timed(connect) for _ in range(runs)]
+
+    def copy():
+        with open(payload, "rb") as f:
+            ssh(config_path, host, "cat > /dev/null", stdin=f)
+
+    size = os.path.getsize(payload)
+    throughput = size / min(timed(copy) for _ in range(3)) / 2**20
+    close_connections(config_path)
+    return statistics.median(cold), statistics.median(warm), throughput
+
+
+def write_payload(path, size):
+    """Writes ``size`` bytes that compress about as well as source code."""
+    with open(path, "wb") as f:
+        chunk = base64.b64encode(os.urandom(3 * 2**18))
+        for _ in range(max(1, size // len(chunk))):
+            f.write(chunk)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--size", type=int, default=64, help="MiB to copy")
+    parser.add_argument(
+        "--key-type", choices=("ed25519", "rsa"), default="ed25519"
+    )
+    parser.add_argument(
+        "--profiles", nargs="+", default=["legacy", *sorted(PROFILES)]
+    )
+    args = parser.parse_args(argv)
+
+    sshd = find_sshd()
+    if sshd is None:
+        sys.exit("This benchmark needs the OpenSSH server (sshd)")
+
+    # Keep the directory short, control socket paths are limited in length
+    directory = tempfile.mkdtemp(prefix="ssh-bench-", dir="/tmp")
+    processes = []
+    try:
+        keygen(os.path.join(directory, "host_key"), "ed25519")
+        key_path = os.path.join(directory, f"id_{args.key_type}")
+        keygen(key_path, args.key_type)
+        shutil.copy(
+            key_path + ".pub", os.path.join(directory, "authorized_keys")
+        )
+        ports = {}
+        for name in ("bastion", "notebook"):
+            process, ports[name] = start_sshd(sshd, directory, name)
+            processes.append(process)
+        payload = os.path.join(directory, "payload")
+        write_payload(payload, args.size * 2**20)
+
+        print(f"{'profile':<12}{'cold':>10}{'warm':>10}{'throughput':>14}")
+        for profile_name in args.profiles:
+            config_path = os.path.join(directory, f"config-{profile_name}")
+            write_config(
+                config_path, directory, profile_name, ports, args.key_type
+            )
+            cold, warm, throughput = benchmark(config_path, args.runs, payload)
+            print(
+                f"{profile_name:<12}{cold * 1e3:>8.1f}ms{warm * 1e3:>8.1f}ms"
+                f"{throughput:>9.1f}MiB/s"
+            )
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
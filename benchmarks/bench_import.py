@@ -0,0 +1,88 @@
+"""
+Measures the startup cost of the CDK app and of obtain_key.py.
+
+Each target is run a few times in a fresh interpreter with
+``python -X importtime``, and the median wall time is reported with the
+modules that took the longest to import, counting their own imports
+(the "cumulative" column of ``-X importtime``). Targets:
+
+- config: ``import app_config`` and loading config.yaml
+- obtain_key: ``import obtain_key``, which must not import aws_cdk
+- app: ``python3 app.py``, i.e. everything ``cdk synth`` runs, writing
+  the templates to a temporary directory
+
+Usage: python benchmarks/bench_import.py [--runs N] [--top N] [TARGET...]
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+TARGETS = {
+    "config": ["-c", "import app_config; app_config.load_config()"],
+    "obtain_key": ["-c", "import obtain_key"],
+    "app": ["app.py"],
+}
+
+# A line of -X importtime output: self and cumulative microseconds, then
+# the module name indented by its import depth
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+def run(args, out_dir):
+    """Runs a target once and returns its wall time and import times."""
+    env = dict(
+        os.environ,
+        CDK_DEFAULT_ACCOUNT="123456789012",
+        CDK_DEFAULT_REGION="us-east-1",
+        CDK_OUTDIR=out_dir,
+    )
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        cwd=PROJECT_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall = time.perf_counter() - start
+    imports = {}
+    for line in process.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if match:
+            _, cumulative, indent, module = match.groups()
+            imports[module] = (int(cumulative), len(indent) // 2)
+    return wall, imports
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("targets", nargs="*", default=list(TARGETS))
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        for target in args.targets:
+            walls = []
+            for _ in range(args.runs):
+                wall, imports = run(TARGETS[target], out_dir)
+                walls.append(wall)
+            print(f"{target}: {statistics.median(walls) * 1e3:.0f}ms")
+            print(f"  aws_cdk imported: {'aws_cdk' in imports}")
+            # The slowest modules of the last run
+            slowest = sorted(imports.items(), key=lambda item: -item[1][0])
+            for module, (cumulative, depth) in slowest[: args.top]:
+                print(f"  {cumulative / 1e3:>8.1f}ms  {'  ' * depth}{module}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Compares the cost of the key operations behind each SSH connection for
+the key types EC2 key pairs support: loading the private key file,
+signing (the client's side of public key authentication) and verifying
+(the server's side).
+
+Usage: python benchmarks/bench_keys.py [--repeat N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, padding, rsa
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from ssh_utils import load_private_key  # noqa: E402
+
+# The session identifier and request that ssh signs are about this long
+MESSAGE = os.urandom(256)
+
+
+def rsa_key():
+    """An RSA key as EC2 creates it, in the traditional PEM format."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    data = key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    public_key = key.public_key()
+
+    def sign():
+        # rsa-sha2-256, as negotiated by current OpenSSH
+        return key.sign(MESSAGE, padding.PKCS1v15(), hashes.SHA256())
+
+    signature = sign()
+
+    def verify():
+        public_key.verify(
+            signature, MESSAGE, padding.PKCS1v15(), hashes.SHA256()
+        )
+
+    return data, sign, verify
+
+
+def ed25519_key():
+    """An ed25519 key as EC2 creates it, in the OpenSSH format."""
+    key = ed25519.Ed25519PrivateKey.generate()
+    data = key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.OpenSSH,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    public_key = key.public_key()
+
+    def sign():
+        return key.sign(MESSAGE)
+
+    signature = sign()
+
+    def verify():
+        public_key.verify(signature, MESSAGE)
+
+    return data, sign, verify
+
+
+def best_time(function, repeat, number):
+    """Returns the best time per call of ``function``, in microseconds."""
+    times = timeit.repeat(function, repeat=repeat, number=number)
+    return min(times) / number * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    print(f"{'key type':<10}{'load':>12}{'sign':>12}{'verify':>12}")
+    for name, make_key in (("rsa", rsa_key), ("ed25519", ed25519_key)):
+        data, sign, verify = make_key()
+
+        def load():
+            return load_private_key(data)
+
+        results = [
+            best_time(function, args.repeat, args.number)
+            for function in (load, sign, verify)
+        ]
+        print(f"{name:<10}" + "".join(f"{t:>10.1f}us" for t in results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Compares reaching the notebook through the tunnel daemon with reaching it
+through a ``ProxyCommand ssh -W`` process per connection, against two
+local sshd processes standing in for the bastion and the notebook (see
+bench_handshake.py).
+
+Reported per route:
+
+- channel: the time until the notebook's SSH banner arrives on a new
+  channel, i.e. the cost of the bastion hop alone
+- connect: the time of ``ssh notebook true``, with no shared connection
+- throughput: copying a file to the notebook with ``cat > /dev/null``
+
+Requires the OpenSSH server (sshd).
+
+Usage: python benchmarks/bench_tunnel.py [--runs N] [--size MB]
+"""
+
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import bench_handshake  # noqa: E402
+from port_forwards import port_is_free  # noqa: E402
+from ssh_utils import SSHConfig  # noqa: E402
+from tunnel import (  # noqa: E402
+    Listener,
+    Transport,
+    TunnelDaemon,
+    transport_command,
+)
+
+
+def start_daemon(config_path, notebook_port):
+    """Runs a tunnel daemon in a background thread.
+
+    Returns the daemon, once it is connected, and the future to cancel to
+    stop it.
+    """
+    socks_port = bench_handshake.free_port()
+    transport = Transport(
+        transport_command("bastion", socks_port, config_file=config_path),
+        socks_port,
+    )
+    listener = Listener("notebook", 0, "127.0.0.1", notebook_port)
+    daemon = TunnelDaemon(transport, [listener], rtt_interval=0)
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    future = asyncio.run_coroutine_threadsafe(daemon.run(), loop)
+    while transport.state != "connected":
+        if future.done():
+            future.result()
+        time.sleep(0.05)
+    return daemon, future
+
+
+def stop_daemon(daemon, future):
+    future.cancel()
+    deadline = time.monotonic() + 10
+    while daemon.transport.state != "stopped" and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def banner_through_tunnel(port):
+    """Reads the SSH banner through the daemon's listener."""
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        sock.recv(256)
+
+
+def banner_through_proxy_command(config_path, notebook_port):
+    """Reads the SSH banner through a new ``ssh -W`` process."""
+    process = subprocess.Popen(
+        ["ssh", "-F", config_path, "-W", f"127.0.0.1:{notebook_port}"]
+        + ["bastion"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    process.stdout.read1(256)
+    process.kill()
+    process.wait()
+
+
+def median_time(function, runs):
+    return statistics.median(
+        bench_handshake.timed(function) for _ in range(runs)
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--size", type=int, default=64, help="MiB to copy")
+    args = parser.parse_args(argv)
+
+    sshd = bench_handshake.find_sshd()
+    if sshd is None:
+        sys.exit("This benchmark needs the OpenSSH server (sshd)")
+
+    directory = tempfile.mkdtemp(prefix="ssh-bench-", dir="/tmp")
+    processes = []
+    daemon = None
+    try:
+        bench_handshake.keygen(os.path.join(directory, "host_key"), "ed25519")
+        key_path = os.path.join(directory, "id_ed25519")
+        bench_handshake.keygen(key_path, "ed25519")
+        shutil.copy(
+            key_path + ".pub", os.path.join(directory, "authorized_keys")
+        )
+        ports = {}
+        for name in ("bastion", "notebook"):
+            process, ports[name] = bench_handshake.start_sshd(
+                sshd, directory, name
+            )
+            processes.append(process)
+        payload = os.path.join(directory, "payload")
+        bench_handshake.write_payload(payload, args.size * 2**20)
+
+        # The legacy blocks, plus a host that goes through the daemon
+        config_path = os.path.join(directory, "config")
+        bench_handshake.write_config(
+            config_path, directory, "legacy", ports, "ed25519"
+        )
+        daemon, future = start_daemon(config_path, ports["notebook"])
+        ssh_config = SSHConfig(config_path)
+        options = ssh_config.lookup_host("notebook")
+        del options["ProxyCommand"]
+        options.update(
+            Port=str(daemon.listeners[0].local_port), HostKeyAlias="notebook"
+        )
+        with ssh_config.transaction() as txn:
+            txn.add_host("notebook-tunnel", **options)
+        assert not port_is_free(daemon.listeners[0].local_port)
+
+        print(f"{'route':<16}{'channel':>10}{'connect':>10}{'throughput':>14}")
+        routes = {
+            "proxy-command": (
+                "notebook",
+                lambda: banner_through_proxy_command(
+                    config_path, ports["notebook"]
+                ),
+            ),
+            "tunnel": (
+                "notebook-tunnel",
+                lambda: banner_through_tunnel(daemon.listeners[0].local_port),
+            ),
+        }
+        for route, (host, open_channel) in routes.items():
+            channel = median_time(open_channel, args.runs)
+            connect, _, throughput = bench_handshake.benchmark(
+                config_path, args.runs, payload, host=host
+            )
+            print(
+                f"{route:<16}{channel * 1e3:>8.1f}ms{connect * 1e3:>8.1f}ms"
+                f"{throughput:>9.1f}MiB/s"
+            )
+        print(f"tunnel stats: {daemon.stats()['channels']}")
+    finally:
+        if daemon is not None:
+            stop_daemon(daemon, future)
+        for process in processes:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+"""
+Copies a local directory to a notebook through the generated SSH hosts.
+
+Only files whose contents changed since the last sync are sent. Each file
+is identified by its SHA-256 digest; digests are cached by size and
+modification time, so unchanged files are not read again, and the digests
+of the files already on the notebook are kept in a local manifest per
+destination.
+
+The changed files are split into a few streams of about equal size, each a
+gzip-compressed tar stream piped into ``tar -x`` on the notebook. The
+streams run in parallel over the host's shared connection (ControlMaster,
+see ssh_profiles.py), so there is a single handshake. Files are added and
+updated, never deleted, on the notebook.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import shlex
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from endpoint_cache import default_cache_path
+from ssh_utils import atomic_write
+
+# Bytes read at a time, when hashing and sending files
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path):
+    """Returns the SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _raise(error):
+    raise error
+
+
+def list_files(root):
+    """Returns ``{relative path: os.stat_result}`` of the files in root.
+
+    Raises
+    ------
+    OSError
+        If root or one of its directories can't be read. os.walk would
+        skip them, and an empty directory would be synced instead.
+    """
+    files = {}
+    for directory, subdirectories, filenames in os.walk(root, onerror=_raise):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(directory, filename)
+            st = os.lstat(path)
+            if os.path.isfile(path) and not os.path.islink(path):
+                files[os.path.relpath(path, root).replace(os.sep, "/")] = st
+    return files
+
+
+def split_streams(files, sizes, streams):
+    """Splits ``files`` into at most ``streams`` groups of similar size.
+
+    The largest files are placed first, each in the smallest group so far.
+    """
+    groups = [[] for _ in range(max(1, min(streams, len(files))))]
+    totals = [0] * len(groups)
+    for name in sorted(files, key=lambda name: -sizes[name]):
+        i = totals.index(min(totals))
+        groups[i].append(name)
+        totals[i] += sizes[name]
+    return [group for group in groups if group]
+
+
+class Manifest:
+    """
+    The cached state of one sync destination.
+
+    It holds the digest of each local file with the size and modification
+    time it was computed for, and the digest of each file last sent to
+    the destination.
+
+    Parameters
+    ----------
+    path : str
+        The path of the manifest file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            data = {}
+        self.local = data.get("local", {})
+        self.remote = data.get("remote", {})
+
+    @classmethod
+    def for_destination(cls, root, host, destination):
+        """Returns the manifest of syncing ``root`` to host:destination."""
+        key = json.dumps([os.path.abspath(root), host, destination])
+        name = hashlib.sha256(key.encode()).hexdigest()[:32] + ".json"
+        cache_dir = os.path.dirname(default_cache_path())
+        return cls(os.path.join(cache_dir, "sync", name))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        data = {"local": self.local, "remote": self.remote}
+        atomic_write(self.path, [json.dumps(data, sort_keys=True).encode()])
+
+    def digests(self, root, files, max_workers=8):
+        """Returns the digest of each file, hashing only changed files."""
+        digests = {}
+        stale = []
+        for name, st in files.items():
+            cached = self.local.get(name)
+            stamp = (st.st_size, st.st_mtime_ns)
+            if cached and (cached["size"], cached["mtime_ns"]) == stamp:
+                digests[name] = cached["sha256"]
+            else:
+                stale.append(name)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            paths = [os.path.join(root, name) for name in stale]
+            for name, digest in zip(stale, pool.map(file_sha256, paths)):
+                digests[name] = digest
+                st = files[name]
+                self.local[name] = {
+                    "size": st.st_size,
+                    "mtime_ns": st.st_mtime_ns,
+                    "sha256": digest,
+                }
+        for name in set(self.local) - set(files):
+            del self.local[name]
+        return digests
+
+
+class Progress:
+    """Counts the bytes sent and prints the progress at most every
+    ``interval`` seconds."""
+
+    def __init__(self, total, interval=0.5, stream=sys.stderr):
+        self.total = total
+        self.sent = 0
+        self.interval = interval
+        self.stream = stream
+        self.start = time.perf_counter()
+        self._printed = self.start
+        self._lock = threading.Lock()
+
+    def add(self, count):
+        with self._lock:
+            self.sent += count
+            now = time.perf_counter()
+            if now - self._printed >= self.interval:
+                self._printed = now
+                self.print()
+
+    def rate(self):
+        """Returns the throughput so far, in bytes per second."""
+        return self.sent / max(time.perf_counter() - self.start, 1e-9)
+
+    def print(self, end=""):
+        mib = 2**20
+        self.stream.write(
+            f"\r{self.sent / mib:.1f}/{self.total / mib:.1f} MiB "
+            f"({self.rate() / mib:.1f} MiB/s)" + end
+        )
+        self.stream.flush()
+
+
+class _CountingFile:
+    """A file object that reports the bytes read to a ``Progress``."""
+
+    def __init__(self, f, progress):
+        self._f = f
+        self._progress = progress
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self._progress.add(len(data))
+        return data
+
+
+def remote_extract_command(destination, compress, directories=()):
+    """Returns the shell command that unpacks a stream on the notebook.
+
+    ``directories`` are created first: tar creates missing directories
+    too, but streams unpacking into the same new directory at once race
+    to create it, and tar then fails.
+    """
+    paths = [destination]
+    paths += [f"{destination}/{directory}" for directory in directories]
+    flags = "-xzf" if compress else "-xf"
+    return (
+        f"mkdir -p {' '.join(map(shlex.quote, paths))} && "
+        f"tar {flags} - -C {shlex.quote(destination)}"
+    )
+
+
+def remote_digests(ssh, host, destination):
+    """Returns the digest of each file under destination on the notebook."""
+    destination = shlex.quote(destination)
+    command = (
+        f"cd {destination} 2>/dev/null || exit 0; "
+        "find . -type f -print0 | xargs -0 -r sha256sum"
+    )
+    output = subprocess.run(
+        [*ssh, host, command], check=True, capture_output=True, text=True
+    ).stdout
+    digests = {}
+    for line in output.splitlines():
+        digest, name = line.split("  ", 1)
+        digests[name[2:] if name.startswith("./") else name] = digest
+    return digests
+
+
+def send_stream(ssh, host, root, names, destination, compress, progress):
+    """Sends ``names`` as one tar stream, through one ssh session.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If ssh or tar on the notebook fail.
+    """
+    directories = sorted({posixpath.dirname(name) for name in names} - {""})
+    command = [
+        *ssh,
+        host,
+        remote_extract_command(destination, compress, directories),
+    ]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    try:
+        if compress:
+            out = gzip.GzipFile(
+                fileobj=process.stdin, mode="wb", compresslevel=compress
+            )
+        else:
+            out = process.stdin
+        with tarfile.open(fileobj=out, mode="w|", bufsize=CHUNK_SIZE) as tar:
+            for name in names:
+                path = os.path.join(root, name)
+                info = tar.gettarinfo(path, arcname=name)
+                with open(path, "rb") as f:
+                    tar.addfile(info, _CountingFile(f, progress))
+        if compress:
+            out.close()
+        process.stdin.close()
+    except BrokenPipeError:
+        pass
+    finally:
+        returncode = process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, command)
+
+
+def sync(
+    root,
+    host,
+    destination,
+    streams=4,
+    compress=1,
+    manifest=None,
+    checksum=False,
+    ssh=("ssh",),
+    progress_stream=sys.stderr,
+):
+    """Copies the changed files of ``root`` to ``host:destination``.
+
+    Parameters
+    ----------
+    root : str
+        The local directory.
+    host : str
+        The SSH host of the notebook.
+    destination : str
+        The directory on the notebook, relative to the home directory if
+        not absolute.
+    streams : int
+        The number of parallel transfer streams.
+    compress : int
+        The gzip level of the streams, 0 to turn compression off.
+    manifest : Manifest
+        The destination's cached state. Defaults to the one in the cache
+        directory.
+    checksum : bool
+        Whether to hash the files on the notebook instead of relying on
+        the manifest, e.g. if they were changed there.
+    ssh : tuple
+        The ssh command and options, e.g. ``("ssh", "-F", "config")``.
+
+    Returns
+    -------
+    stats : dict
+        The files sent and skipped, the bytes sent and the time taken.
+    """
+    manifest = manifest or Manifest.for_destination(root, host, destination)
+    start = time.perf_counter()
+    if checksum:
+        manifest.remote = remote_digests(ssh, host, destination)
+    files = list_files(root)
+    digests = manifest.digests(root, files)
+    changed = [
+        name for name in files if manifest.remote.get(name) != digests[name]
+    ]
+    sizes = {name: st.st_size for name, st in files.items()}
+    progress = Progress(
+        sum(sizes[name] for name in changed), stream=progress_stream
+    )
+    groups = split_streams(changed, sizes, streams)
+
+    if len(groups) > 1:
+        # Open the shared connection first, so the streams don't race to
+        # create it
+        subprocess.run([*ssh, host, "true"], check=True)
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, len(groups))) as pool:
+        futures = {
+            pool.submit(
+                send_stream,
+                ssh,
+                host,
+                root,
+                group,
+                destination,
+                compress,
+                progress,
+            ): group
+            for group in groups
+        }
+        for future, group in futures.items():
+            try:
+                future.result()
+            except (OSError, subprocess.CalledProcessError) as e:
+                errors.append(e)
+                continue
+            manifest.remote.update({name: digests[name] for name in group})
+    manifest.save()
+    progress.print(end="\n")
+    if errors:
+        raise errors[0]
+    return {
+        "sent": len(changed),
+        "skipped": len(files) - len(changed),
+        "bytes": progress.sent,
+        "seconds": time.perf_counter() - start,
+        "streams": len(groups),
+    }
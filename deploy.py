@@ -0,0 +1,761 @@
+"""
+Synthesizes and deploys the app's stacks, skipping the work that the
+last deploy already did.
+
+``cdk deploy --all`` creates a CloudFormation change set for every stack,
+which takes minutes even when nothing changed. This script keeps a small
+state file in cdk.out with:
+
+- a digest of the app's inputs (config.yaml, the lifecycle scripts, the
+  project modules that app.py imports, cdk.json, the CDK version and the
+  account settings): if
+  it matches and the templates are still in cdk.out, ``cdk synth`` is
+  skipped too
+- a digest of each stack's synthesized template as last deployed, and
+  how long that deploy took
+
+and deploys only the stacks whose template changed, or whose outputs are
+missing from outputs.json, with one ``cdk deploy --concurrency`` so that
+independent stacks deploy in parallel. The outputs of the deployed stacks
+are merged into outputs.json.
+
+A report shows what was deployed or skipped, how long each deployed stack
+and its slowest resources took, read from the stacks' CloudFormation
+events, and the time saved per skipped stack, estimated from its last
+deploy.
+
+If config.yaml lists target ``environments``, each of them is synthesized
+to its own cloud assembly, cdk.out/environments/<name>, and deployed as
+above with its AWS profile, ``--jobs`` environments at a time. Their
+stack names start with the environment's name, and their outputs are
+merged into outputs.json, which obtain_key.py --environment reads.
+
+Usage: python deploy.py [--force] [--dry-run] [--concurrency N]
+       [--environment NAME]... [--jobs N]
+"""
+
+import argparse
+import ast
+import datetime
+import functools
+import getpass
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from importlib import metadata
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+from app_config import (
+    ENVIRONMENT_VARIABLE,
+    PROJECT_DIR,
+    ConfigError,
+    environment,
+    environments,
+    load_config,
+)
+from endpoint_cache import file_digest
+from ssh_utils import atomic_write
+
+# The files the templates are synthesized from, relative to the project,
+# besides the modules that the app imports (see app_modules)
+INPUT_PATTERNS = (
+    "cdk.json",
+    "config.yaml",
+    "lifecycle/*.sh",
+    "stacks/*.py",
+)
+
+# The app's entry point, whose project imports are inputs too
+APP_MODULE = "app.py"
+
+# Environment variables that change what is synthesized or where it goes
+INPUT_ENVIRONMENT = (
+    "AWS_PROFILE",
+    "AWS_REGION",
+    "AWS_DEFAULT_REGION",
+    "CDK_DEFAULT_ACCOUNT",
+    "CDK_DEFAULT_REGION",
+)
+
+STATE_FILENAME = "deploy-state.json"
+
+# Stacks deployed at a time: at most the network, key and lifecycle
+# stacks, and then the bastion and the notebooks, are independent
+DEFAULT_CONCURRENCY = 4
+
+# Environments deployed at a time. Each runs its own cdk processes.
+DEFAULT_JOBS = 3
+
+
+def module_path(project_dir, module):
+    """Returns the file of a dotted module name if it is in the project."""
+    base = os.path.join(project_dir, *module.split("."))
+    for path in (base + ".py", os.path.join(base, "__init__.py")):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def app_modules(project_dir=PROJECT_DIR, entry=APP_MODULE):
+    """Returns the project's modules that the app imports, directly or not.
+
+    Imports are read from the modules' code, including the imports inside
+    functions, so that a module a stack imports, such as
+    lifecycle_steps.py, is an input without being listed.
+    """
+    pending = [os.path.join(project_dir, entry)]
+    found = set()
+    while pending:
+        path = pending.pop()
+        if path in found:
+            continue
+        found.add(path)
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and not node.level:
+                # "from package import module" may import a module
+                names = [node.module] + [
+                    f"{node.module}.{alias.name}" for alias in node.names
+                ]
+            else:
+                continue
+            for name in names:
+                module = module_path(project_dir, name)
+                if module:
+                    pending.append(module)
+    return found
+
+
+def input_files(project_dir=PROJECT_DIR):
+    """Returns the paths of the files the templates are synthesized from."""
+    paths = app_modules(project_dir)
+    for pattern in INPUT_PATTERNS:
+        paths.update(glob.glob(os.path.join(project_dir, pattern)))
+    return sorted(paths)
+
+
+def input_digest(project_dir=PROJECT_DIR, environ=os.environ):
+    """Returns a digest of everything the synthesized templates depend on.
+
+    Besides the files, this covers the CDK version, the account settings
+    and the user name, which notebook names may include.
+    """
+    digest = hashlib.sha256()
+    for path in input_files(project_dir):
+        name = os.path.relpath(path, project_dir)
+        digest.update(f"{name}\0{file_digest(path)}\0".encode())
+    try:
+        cdk_version = metadata.version("aws-cdk-lib")
+    except metadata.PackageNotFoundError:
+        cdk_version = None
+    extra = {
+        "aws-cdk-lib": cdk_version,
+        "user": getpass.getuser(),
+        "environment": {name: environ.get(name) for name in INPUT_ENVIRONMENT},
+    }
+    digest.update(json.dumps(extra, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def read_stacks(out_dir):
+    """Returns the stacks of a cloud assembly, in dependency order.
+
+    Returns
+    -------
+    stacks : list
+        Dicts with the stack's ``name`` in the app, its CloudFormation
+        ``stack_name`` and ``region``, the path of its ``template``, its
+        ``properties`` in the assembly manifest, and the names of the
+        stacks it depends on.
+    """
+    with open(os.path.join(out_dir, "manifest.json")) as f:
+        artifacts = json.load(f)["artifacts"]
+    stacks = {
+        name: artifact
+        for name, artifact in artifacts.items()
+        if artifact["type"] == "aws:cloudformation:stack"
+    }
+    ordered = []
+    visited = set()
+
+    def visit(name):
+        if name in visited:
+            return
+        visited.add(name)
+        artifact = stacks[name]
+        dependencies = [
+            dependency
+            for dependency in artifact.get("dependencies", [])
+            if dependency in stacks
+        ]
+        for dependency in dependencies:
+            visit(dependency)
+        properties = artifact["properties"]
+        # e.g. "aws://123456789012/us-east-1"
+        region = artifact.get("environment", "").rpartition("/")[2]
+        ordered.append(
+            {
+                "name": name,
+                "stack_name": properties.get("stackName", name),
+                "region": None if region == "unknown-region" else region,
+                "template": os.path.join(out_dir, properties["templateFile"]),
+                "properties": properties,
+                "dependencies": dependencies,
+            }
+        )
+
+    for name in stacks:
+        visit(name)
+    return ordered
+
+
+def template_digest(stack):
+    """Returns a digest of what is deployed for a stack: its template and
+    the deployment properties, such as parameters, tags and the stack
+    name."""
+    digest = hashlib.sha256(file_digest(stack["template"]).encode())
+    properties = dict(stack["properties"])
+    properties.pop("templateFile", None)
+    digest.update(json.dumps(properties, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class DeployState:
+    """
+    The state file of the last synth and deploys.
+
+    Parameters
+    ----------
+    path : str
+        The path of the state file, cdk.out/deploy-state.json by default.
+        Removing it, or cdk.out, makes the next run deploy every stack.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            data = {}
+        self.inputs = data.get("inputs")
+        self.synth_seconds = data.get("synth_seconds")
+        self.stacks = data.get("stacks", {})
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = {
+            "inputs": self.inputs,
+            "synth_seconds": self.synth_seconds,
+            "stacks": self.stacks,
+        }
+        atomic_write(self.path, [json.dumps(data, indent=2).encode()])
+
+
+def read_outputs(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def plan(stacks, state, outputs, force=False):
+    """Returns the names of the stacks to deploy, in dependency order.
+
+    A stack is deployed if its template or deployment properties changed
+    since its last deploy, or if outputs.json has no outputs for it. The
+    outputs are listed by CloudFormation stack name.
+    """
+    changed = []
+    for stack in stacks:
+        deployed = state.stacks.get(stack["name"], {})
+        if (
+            force
+            or deployed.get("template") != template_digest(stack)
+            or stack["stack_name"] not in outputs
+        ):
+            changed.append(stack["name"])
+    return changed
+
+
+def profile_options(profile):
+    """Returns the cdk options that select an AWS profile, if any."""
+    return ["--profile", profile] if profile else []
+
+
+def synth(out_dir, run=subprocess.run, environ=None, profile=None):
+    """Runs ``cdk synth`` and returns how long it took."""
+    start = time.perf_counter()
+    run(
+        [
+            "cdk",
+            "synth",
+            "--quiet",
+            "--output",
+            out_dir,
+            *profile_options(profile),
+        ],
+        check=True,
+        cwd=PROJECT_DIR,
+        env=environ,
+    )
+    return time.perf_counter() - start
+
+
+def dependency_levels(stacks):
+    """Groups stacks into the waves that a concurrent deploy runs.
+
+    Returns
+    -------
+    levels : list
+        Lists of stack names. Each stack is in the level after the last
+        of its dependencies, so the stacks of a level can deploy in
+        parallel.
+    """
+    level = {}
+    for stack in stacks:
+        level[stack["name"]] = 1 + max(
+            (level[dependency] for dependency in stack["dependencies"]),
+            default=-1,
+        )
+    levels = [[] for _ in range(max(level.values(), default=-1) + 1)]
+    for stack in stacks:
+        levels[level[stack["name"]]].append(stack["name"])
+    return levels
+
+
+def deploy_stacks(
+    names, out_dir, outputs_path, concurrency, run, environ=None, profile=None
+):
+    """Deploys stacks from the synthesized assembly with one cdk command.
+
+    Independent stacks are deployed in parallel, up to ``concurrency`` at
+    a time. The stacks' outputs are merged into ``outputs_path``.
+
+    Returns
+    -------
+    seconds : float
+        How long the deploy took.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        stack_outputs = os.path.join(directory, "outputs.json")
+        start = time.perf_counter()
+        run(
+            [
+                "cdk",
+                "deploy",
+                *names,
+                "--app",
+                out_dir,
+                "--exclusively",
+                "--concurrency",
+                str(concurrency),
+                "--require-approval",
+                "never",
+                "--outputs-file",
+                stack_outputs,
+                *profile_options(profile),
+            ],
+            check=True,
+            cwd=PROJECT_DIR,
+            env=environ,
+        )
+        seconds = time.perf_counter() - start
+        outputs = read_outputs(outputs_path)
+        outputs.update(read_outputs(stack_outputs))
+    atomic_write(outputs_path, [json.dumps(outputs, indent=2).encode()])
+    return seconds
+
+
+def stack_timings(cloudformation, stack_name, since):
+    """Returns how long a stack's last deploy and each of its resources
+    took, from the stack's CloudFormation events.
+
+    Parameters
+    ----------
+    cloudformation : botocore.client.BaseClient
+        A CloudFormation client in the stack's region.
+    stack_name : str
+        The deployed stack.
+    since : datetime.datetime
+        When the deploy started. Older events are ignored.
+
+    Returns
+    -------
+    timings : dict
+        The ``seconds`` the stack took, or None if its events don't show
+        it, and its ``resources``: dicts with the logical ``id``,
+        ``type``, ``status`` and ``seconds`` of each resource that was
+        created, updated or deleted, slowest first.
+    """
+    starts = {}
+    ends = {}
+    types = {}
+    statuses = {}
+    paginator = cloudformation.get_paginator("describe_stack_events")
+    for page in paginator.paginate(StackName=stack_name):
+        events = [
+            event
+            for event in page["StackEvents"]
+            if event["Timestamp"] >= since
+        ]
+        # Events are listed newest first, so the first status seen is the
+        # last one, and the last start seen is the first one
+        for event in events:
+            resource = event["LogicalResourceId"]
+            status = event["ResourceStatus"]
+            types[resource] = event["ResourceType"]
+            statuses.setdefault(resource, status)
+            if status.endswith("_IN_PROGRESS"):
+                starts[resource] = event["Timestamp"]
+            elif resource not in ends:
+                ends[resource] = event["Timestamp"]
+        if len(events) < len(page["StackEvents"]):
+            break
+
+    def seconds(resource):
+        if resource in starts and resource in ends:
+            return (ends[resource] - starts[resource]).total_seconds()
+        return None
+
+    resources = [
+        {
+            "id": resource,
+            "type": types[resource],
+            "status": statuses[resource],
+            "seconds": seconds(resource),
+        }
+        for resource in types
+        if resource != stack_name and seconds(resource) is not None
+    ]
+    resources.sort(key=lambda resource: -resource["seconds"])
+    return {"seconds": seconds(stack_name), "resources": resources}
+
+
+def cloudformation_client(region, profile=None):
+    session = boto3.session.Session(profile_name=profile)
+    return session.client("cloudformation", region_name=region)
+
+
+def environment_dir(name):
+    """Returns the cloud assembly directory of a target environment."""
+    return os.path.join(PROJECT_DIR, "cdk.out", "environments", name)
+
+
+def deploy(
+    out_dir=None,
+    outputs_path="outputs.json",
+    force=False,
+    dry_run=False,
+    concurrency=DEFAULT_CONCURRENCY,
+    run=subprocess.run,
+    clients=cloudformation_client,
+    target=None,
+):
+    """Synthesizes if needed, and deploys the changed stacks.
+
+    Parameters
+    ----------
+    out_dir : str
+        The cloud assembly directory. Defaults to the project's cdk.out.
+    outputs_path : str
+        The outputs file that obtain_key.py reads.
+    force : bool
+        Whether to synthesize and deploy everything anyway.
+    dry_run : bool
+        Whether to only synthesize and report what would be deployed.
+    concurrency : int
+        The number of stacks deployed at a time.
+    run : callable
+        Runs the cdk commands, ``subprocess.run`` by default.
+    clients : callable
+        Returns a CloudFormation client for a region, to read the deploy
+        events from.
+    target : dict
+        The target environment to deploy, from ``environments`` in
+        config.yaml. The app is built for its account and region, and
+        the cdk commands use its profile. Its cloud assembly defaults to
+        ``environment_dir``.
+
+    Returns
+    -------
+    report : list
+        A dict per step and stack: its ``name``, ``action`` ("deployed",
+        "skipped", "synthesized", or "would deploy" in a dry run), the
+        ``seconds`` it took and the ``saved`` seconds, if known. Deployed
+        stacks also have the ``resources`` that took the longest, see
+        ``stack_timings``.
+    """
+    environ = profile = None
+    if target:
+        environ = dict(os.environ, **{ENVIRONMENT_VARIABLE: target["name"]})
+        profile = target.get("profile")
+        out_dir = out_dir or environment_dir(target["name"])
+        if profile:
+            clients = functools.partial(clients, profile=profile)
+    out_dir = out_dir or os.path.join(PROJECT_DIR, "cdk.out")
+    state = DeployState(os.path.join(out_dir, STATE_FILENAME))
+    report = []
+
+    inputs = input_digest()
+    cached = (
+        not force
+        and state.inputs == inputs
+        and os.path.exists(os.path.join(out_dir, "manifest.json"))
+        and all(
+            os.path.exists(stack["template"])
+            and template_digest(stack)
+            == state.stacks[stack["name"]].get("synth")
+            for stack in read_stacks(out_dir)
+            if stack["name"] in state.stacks
+        )
+    )
+    if cached:
+        report.append(
+            {
+                "name": "synth",
+                "action": "skipped",
+                "seconds": 0.0,
+                "saved": state.synth_seconds,
+            }
+        )
+    else:
+        seconds = synth(out_dir, run, environ, profile)
+        report.append(
+            {
+                "name": "synth",
+                "action": "synthesized",
+                "seconds": seconds,
+                "saved": None,
+            }
+        )
+        state.inputs = inputs
+        state.synth_seconds = seconds
+
+    stacks = read_stacks(out_dir)
+    for stack in stacks:
+        entry = state.stacks.setdefault(stack["name"], {})
+        entry["synth"] = template_digest(stack)
+    # Drop the stacks that are no longer in the app
+    names = {stack["name"] for stack in stacks}
+    for name in set(state.stacks) - names:
+        del state.stacks[name]
+    state.save()
+
+    changed = plan(stacks, state, read_outputs(outputs_path), force)
+    timings = {}
+    wall = None
+    if changed and not dry_run:
+        since = datetime.datetime.now(datetime.timezone.utc)
+        wall = deploy_stacks(
+            changed, out_dir, outputs_path, concurrency, run, environ, profile
+        )
+        for stack in stacks:
+            if stack["name"] not in changed:
+                continue
+            try:
+                timings[stack["name"]] = stack_timings(
+                    clients(stack["region"]), stack["stack_name"], since
+                )
+            except (BotoCoreError, ClientError):
+                timings[stack["name"]] = {"seconds": None, "resources": []}
+
+    for stack in stacks:
+        name = stack["name"]
+        entry = state.stacks[name]
+        if name not in changed:
+            action, seconds, saved = "skipped", 0.0, entry.get("seconds")
+        elif dry_run:
+            action, seconds, saved = "would deploy", 0.0, None
+        else:
+            action, saved = "deployed", None
+            # Without events, all that is known is the whole deploy's time
+            seconds = timings[name]["seconds"] or wall
+            entry.update(template=entry["synth"], seconds=seconds)
+        row = {
+            "name": name,
+            "action": action,
+            "seconds": seconds,
+            "saved": saved,
+        }
+        if name in timings:
+            row["resources"] = timings[name]["resources"]
+        report.append(row)
+    state.save()
+    if wall is not None:
+        report.append(
+            {
+                "name": "deploy",
+                "action": "total",
+                "seconds": wall,
+                "saved": None,
+            }
+        )
+    return report
+
+
+def deploy_environments(
+    targets, outputs_path="outputs.json", jobs=DEFAULT_JOBS, **options
+):
+    """Deploys target environments in parallel, each with ``deploy``.
+
+    Each environment has its own cloud assembly, deploy state and outputs
+    file in ``environment_dir``, so that their synths and deploys don't
+    share files. Once they are all done, their outputs are merged into
+    ``outputs_path``. Their stack names start with the environment's
+    name, so they don't collide there.
+
+    Parameters
+    ----------
+    targets : list
+        The target environments, see ``environments`` in config.yaml.
+    outputs_path : str
+        The merged outputs file that obtain_key.py reads.
+    jobs : int
+        The number of environments deployed at a time.
+    options
+        The other arguments of ``deploy``.
+
+    Returns
+    -------
+    reports : dict
+        The report of each environment, by name, see ``deploy``, or the
+        error its synth or deploy failed with. An environment that fails
+        doesn't stop the others.
+    """
+
+    def deploy_target(target):
+        out_dir = environment_dir(target["name"])
+        return deploy(
+            out_dir=out_dir,
+            outputs_path=os.path.join(out_dir, "outputs.json"),
+            target=target,
+            **options,
+        )
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {
+            target["name"]: pool.submit(deploy_target, target)
+            for target in targets
+        }
+    reports = {}
+    for name, future in futures.items():
+        try:
+            reports[name] = future.result()
+        except (subprocess.CalledProcessError, OSError) as e:
+            reports[name] = e
+
+    # A failed deploy may still have updated some of its stacks' outputs
+    outputs = read_outputs(outputs_path)
+    for name in futures:
+        outputs.update(
+            read_outputs(os.path.join(environment_dir(name), "outputs.json"))
+        )
+    atomic_write(outputs_path, [json.dumps(outputs, indent=2).encode()])
+    return reports
+
+
+def print_report(report, stream=None, resources=5):
+    """Prints the steps, the slowest resources of each deployed stack, and
+    the total time saved."""
+    stream = stream or sys.stdout
+    width = max(len(row["name"]) for row in report)
+    for row in report:
+        if row["saved"] is not None:
+            saved = f"{row['saved']:.1f}s"
+        else:
+            # Skipped, but never deployed by this script
+            saved = "?" if row["action"] == "skipped" else ""
+        stream.write(
+            f"{row['name']:<{width}}  {row['action']:<12}"
+            f"{row['seconds']:>8.1f}s  {saved:>8}\n"
+        )
+        for resource in row.get("resources", [])[:resources]:
+            stream.write(
+                f"    {resource['id']} ({resource['type']}) "
+                f"{resource['seconds']:.1f}s\n"
+            )
+    total = sum(row["saved"] or 0 for row in report)
+    stream.write(f"Saved about {total:.0f}s\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Synthesize and deploy every stack",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report the stacks that would be deployed",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="The number of stacks to deploy at a time",
+    )
+    parser.add_argument(
+        "--environment",
+        action="append",
+        metavar="NAME",
+        help="Deploy only this one of the environments in config.yaml, "
+        "can be repeated",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=DEFAULT_JOBS,
+        help="The number of environments to deploy at a time",
+    )
+    parser.add_argument("--outputs-file", default="outputs.json")
+    args = parser.parse_args(argv)
+    options = dict(
+        force=args.force, dry_run=args.dry_run, concurrency=args.concurrency
+    )
+
+    config = load_config()
+    if not environments(config):
+        if args.environment:
+            parser.error("config.yaml lists no environments")
+        print_report(deploy(outputs_path=args.outputs_file, **options))
+        return
+
+    try:
+        targets = [
+            environment(config, name)
+            for name in args.environment or environments(config)
+        ]
+    except ConfigError as e:
+        parser.error(str(e))
+    reports = deploy_environments(
+        targets, args.outputs_file, args.jobs, **options
+    )
+    failed = False
+    for name, report in reports.items():
+        print(f"{name}:")
+        if isinstance(report, Exception):
+            print(f"Deploy failed: {report}")
+            failed = True
+        else:
+            print_report(report)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
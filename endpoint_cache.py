@@ -0,0 +1,95 @@
+"""
+A local cache of what obtain_key.py resolved for each notebook: the
+fingerprint of the installed key, the notebook's network interface and
+private IP, and a digest of the outputs.json it was resolved from.
+
+After a notebook restart only its private IP can change, so the cache
+lets the "refresh" action skip the SSM download and the sudo steps and
+re-check the address with a single describe call.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+from ssh_utils import atomic_write
+
+# Entries older than this are ignored and resolved from scratch
+DEFAULT_TTL = 24 * 60 * 60
+
+
+def default_cache_path():
+    """Returns the cache file path, under $XDG_CACHE_HOME if it is set."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(
+        os.path.join("~", ".cache")
+    )
+    return os.path.join(cache_home, "sagemaker-ssh", "endpoints.json")
+
+
+def file_digest(path):
+    """Returns the SHA-256 hex digest of a file's contents."""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class EndpointCache:
+    """
+    A JSON file of resolved notebook endpoints, keyed by notebook name.
+
+    Parameters
+    ----------
+    path : str
+        The path to the cache file. Defaults to ``default_cache_path()``.
+    ttl : float
+        The number of seconds an entry stays valid.
+    clock : callable
+        Returns the current time in seconds, for tests.
+    """
+
+    def __init__(self, path=None, ttl=DEFAULT_TTL, clock=time.time):
+        self.path = path or default_cache_path()
+        self.ttl = ttl
+        self.clock = clock
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write(self, entries):
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        data = json.dumps(entries, indent=2, sort_keys=True).encode()
+        atomic_write(self.path, [data])
+
+    def load(self, notebook):
+        """Returns the entry for ``notebook``, or None if absent or stale."""
+        entry = self._read().get(notebook)
+        if entry is None or self.clock() - entry["updated_at"] > self.ttl:
+            return None
+        return entry
+
+    def store(self, notebook, **fields):
+        """Creates or updates the entry for ``notebook``."""
+        return self.update({notebook: fields})[notebook]
+
+    def update(self, entries):
+        """Creates or updates several entries with a single write.
+
+        ``entries`` maps notebook names to the fields to set.
+        """
+        stored = self._read()
+        now = self.clock()
+        for notebook, fields in entries.items():
+            stored.setdefault(notebook, {}).update(fields, updated_at=now)
+        self._write(stored)
+        return stored
+
+    def delete(self, *notebooks):
+        """Removes the entries for ``notebooks``, if any."""
+        entries = self._read()
+        removed = [entries.pop(notebook, None) for notebook in notebooks]
+        if any(entry is not None for entry in removed):
+            self._write(entries)
@@ -0,0 +1,67 @@
+#!/usr/bin/env bash
+#
+# Mounts the shared dataset file system of the NetworkStack (efs in
+# config.yaml), so that datasets are downloaded once for the team rather
+# than once per notebook.
+#
+# It mounts over NFS 4.1 with the options EFS recommends: 1 MB reads and
+# writes, hard mounts with a 60 s timeout, and noresvport, so that the
+# client reconnects on a new port after a network interruption. Mounts
+# don't survive a restart, so this runs at every start. The mount target's
+# DNS name can take a minute to resolve after the file system is created,
+# so mounting is retried.
+#
+# Everything is configurable through the environment, for tests:
+# EFS_DNS_NAME, EFS_MOUNT_POINT, MOUNT, ATTEMPTS, RETRY_DELAY and OWNER.
+
+set -euo pipefail
+
+EFS_DNS_NAME=${EFS_DNS_NAME:-}
+EFS_MOUNT_POINT=${EFS_MOUNT_POINT:-/home/ec2-user/SageMaker/datasets}
+MOUNT=${MOUNT:-mount}
+ATTEMPTS=${ATTEMPTS:-6}
+RETRY_DELAY=${RETRY_DELAY:-5}
+OWNER=${OWNER:-ec2-user}
+
+OPTIONS=nfsvers=4.1,rsize=1048576,wsize=1048576,hard,timeo=600,retrans=2
+OPTIONS=$OPTIONS,noresvport,_netdev
+
+log() {
+    echo "efs-mount: $*"
+}
+
+give_to_owner() {
+    if [ "$(id -u)" -eq 0 ] && id "$OWNER" >/dev/null 2>&1; then
+        chown "$OWNER:$OWNER" "$@"
+    fi
+}
+
+main() {
+    if [ -z "$EFS_DNS_NAME" ]; then
+        log "no EFS_DNS_NAME, no file system to mount"
+        return
+    fi
+    if mountpoint -q "$EFS_MOUNT_POINT" 2>/dev/null; then
+        log "$EFS_MOUNT_POINT is already mounted"
+        return
+    fi
+    mkdir -p "$EFS_MOUNT_POINT"
+    local attempt delay=$RETRY_DELAY
+    for attempt in $(seq "$ATTEMPTS"); do
+        if "$MOUNT" -t nfs4 -o "$OPTIONS" "$EFS_DNS_NAME:/" \
+            "$EFS_MOUNT_POINT"; then
+            # The file system's root belongs to root at first
+            give_to_owner "$EFS_MOUNT_POINT"
+            log "mounted $EFS_DNS_NAME on $EFS_MOUNT_POINT"
+            return
+        fi
+        [ "$attempt" -lt "$ATTEMPTS" ] || break
+        log "mounting failed, retrying in ${delay}s"
+        sleep "$delay"
+        delay=$((delay * 2))
+    done
+    log "could not mount $EFS_DNS_NAME"
+    return 1
+}
+
+main "$@"
@@ -0,0 +1,78 @@
+# The job runner of the generated lifecycle scripts, see lifecycle_steps.py.
+#
+# Every step runs as a background job that waits for the steps it comes
+# after, so independent steps run in parallel. A step whose dependency
+# failed is skipped. Each step's output goes to $LOG_DIR/<event>/<step>.log
+# and the timings of all steps to $LOG_DIR/<event>.json.
+
+LOG_DIR=${LOG_DIR:-/var/log/sagemaker-ssh}
+RUN_DIR=${RUN_DIR:-/tmp/sagemaker-ssh-$EVENT}
+
+now() {
+    date +%s.%N
+}
+
+# Runs step $1 once the steps $2... are done, and writes its status file:
+# "<ok|failed|skipped> <exit code> <start> <end>"
+run_step() {
+    local name=$1 dependency status code start end
+    shift
+    for dependency in "$@"; do
+        while [ ! -f "$RUN_DIR/$dependency.status" ]; do
+            sleep 0.1
+        done
+        read -r status _ <"$RUN_DIR/$dependency.status"
+        if [ "$status" != ok ]; then
+            end=$(now)
+            echo "skipped - $end $end" >"$RUN_DIR/$name.tmp"
+            mv "$RUN_DIR/$name.tmp" "$RUN_DIR/$name.status"
+            return
+        fi
+    done
+    start=$(now)
+    code=0
+    bash "$RUN_DIR/steps/$name.sh" >"$LOG_DIR/$EVENT/$name.log" 2>&1 ||
+        code=$?
+    end=$(now)
+    status=ok
+    [ "$code" -eq 0 ] || status=failed
+    echo "$status $code $start $end" >"$RUN_DIR/$name.tmp"
+    mv "$RUN_DIR/$name.tmp" "$RUN_DIR/$name.status"
+}
+
+# Writes the timings JSON from the status files, "pending" for the
+# steps that haven't finished
+write_timings() {
+    local started=$1 finished=$2 name status code start end separator=""
+    {
+        printf '{"event": "%s", "started": %s, "finished": %s, "steps": [' \
+            "$EVENT" "$started" "$finished"
+        for name in "${STEPS[@]}"; do
+            if [ -f "$RUN_DIR/$name.status" ]; then
+                read -r status code start end <"$RUN_DIR/$name.status"
+            else
+                status=pending code=- start=null end=null
+            fi
+            [ "$code" = - ] && code=null
+            printf '%s\n  {"name": "%s", "status": "%s", "exit_code": %s, ' \
+                "$separator" "$name" "$status" "$code"
+            printf '"start": %s, "end": %s, "log": "%s"}' \
+                "$start" "$end" "$LOG_DIR/$EVENT/$name.log"
+            separator=,
+        done
+        printf '\n]}\n'
+    } >"$LOG_DIR/$EVENT.json.tmp"
+    mv "$LOG_DIR/$EVENT.json.tmp" "$LOG_DIR/$EVENT.json"
+    chmod 644 "$LOG_DIR/$EVENT.json"
+}
+
+run_steps() {
+    local started
+    started=$(now)
+    rm -f "$RUN_DIR"/*.status
+    mkdir -p "$LOG_DIR/$EVENT"
+    write_timings "$started" null
+    start_steps
+    wait
+    write_timings "$started" "$(now)"
+}
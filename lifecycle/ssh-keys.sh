@@ -0,0 +1,109 @@
+#!/usr/bin/env bash
+#
+# Authorizes the key pair of the KeyStack to log in as ec2-user, so that
+# the notebook is connectable as soon as it is in service.
+#
+# The public key is derived from the key pair's private key, which the
+# KeyStack keeps in the SSM parameter SSH_KEY_PARAMETER. The private key
+# only goes through a pipe, it is never written to disk. The public key is
+# added to ~/SageMaker/authorized_keys, on the persistent volume, and that
+# file is copied to ~/.ssh/authorized_keys at every start, by
+# copy-ssh-keys. Keys added to ~/SageMaker/authorized_keys by hand are
+# kept.
+#
+# If the key pair can't be read, the keys added by hand are still copied,
+# and the step then fails.
+#
+# Everything is configurable through the environment, for tests:
+# HOME_DIR, SSH_KEY_PARAMETER, AWS_CLI, BIN_DIR, OWNER and ATTEMPTS.
+
+set -euo pipefail
+
+HOME_DIR=${HOME_DIR:-/home/ec2-user}
+SSH_KEY_PARAMETER=${SSH_KEY_PARAMETER:-}
+AWS_CLI=${AWS_CLI:-aws}
+BIN_DIR=${BIN_DIR:-/usr/bin}
+OWNER=${OWNER:-ec2-user}
+
+# Attempts at reading the parameter, while the instance's credentials or
+# network may not be ready yet
+ATTEMPTS=${ATTEMPTS:-5}
+
+# Logs to stderr, as stdout carries the public key
+log() {
+    echo "ssh-keys: $*" >&2
+}
+
+give_to_owner() {
+    if [ "$(id -u)" -eq 0 ] && id "$OWNER" >/dev/null 2>&1; then
+        chown "$OWNER:$OWNER" "$@"
+    fi
+}
+
+# Prints the public key of the private key in the SSM parameter $1
+fetch_public_key() {
+    local attempt delay=1
+    for attempt in $(seq "$ATTEMPTS"); do
+        if "$AWS_CLI" ssm get-parameter --name "$1" --with-decryption \
+            --query Parameter.Value --output text |
+            ssh-keygen -y -f /dev/stdin; then
+            return
+        fi
+        [ "$attempt" -lt "$ATTEMPTS" ] || break
+        log "reading $1 failed, retrying in ${delay}s"
+        sleep "$delay"
+        delay=$((delay * 2))
+    done
+    return 1
+}
+
+# Adds the public key $1 to the authorized keys on the persistent volume,
+# unless it is there already
+authorize() {
+    local keys="$HOME_DIR/SageMaker/authorized_keys" key blob
+    touch "$keys"
+    give_to_owner "$keys"
+    # The key type and blob, without the key's comment
+    key=$(cut -d " " -f 1,2 <<<"$1")
+    blob=$(cut -d " " -f 2 <<<"$1")
+    if grep -q -F "$blob" "$keys"; then
+        return
+    fi
+    echo "$key sagemaker-ssh" >>"$keys"
+    log "authorized the key pair's public key"
+}
+
+install_copy_ssh_keys() {
+    cat >"$BIN_DIR/copy-ssh-keys" <<EOF
+#!/usr/bin/env bash
+# Copies the authorized keys on the persistent volume to ~/.ssh
+set -e
+touch "$HOME_DIR/SageMaker/authorized_keys"
+cp "$HOME_DIR/SageMaker/authorized_keys" "$HOME_DIR/.ssh/authorized_keys"
+chmod 600 "$HOME_DIR/.ssh/authorized_keys"
+EOF
+    chmod +x "$BIN_DIR/copy-ssh-keys"
+    give_to_owner "$BIN_DIR/copy-ssh-keys"
+}
+
+main() {
+    mkdir -p "$HOME_DIR/.ssh"
+    chmod 700 "$HOME_DIR/.ssh"
+    give_to_owner "$HOME_DIR/.ssh"
+    local public_key status=0
+    if [ -z "$SSH_KEY_PARAMETER" ]; then
+        log "no SSH_KEY_PARAMETER, only keys added by hand are authorized"
+    elif public_key=$(fetch_public_key "$SSH_KEY_PARAMETER"); then
+        authorize "$public_key"
+    else
+        log "could not read $SSH_KEY_PARAMETER, only keys added by hand" \
+            "are authorized"
+        status=1
+    fi
+    install_copy_ssh_keys
+    "$BIN_DIR/copy-ssh-keys"
+    give_to_owner "$HOME_DIR/.ssh/authorized_keys"
+    return "$status"
+}
+
+main "$@"
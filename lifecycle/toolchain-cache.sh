@@ -0,0 +1,136 @@
+#!/usr/bin/env bash
+#
+# Keeps the VS Code server and conda environments on the persistent
+# SageMaker volume, so that they survive notebook restarts.
+#
+# Only /home/ec2-user/SageMaker persists across restarts: the rest of the
+# home directory is reset, and VS Code would download its server and
+# extensions again before the first window opens. This script moves them
+# to a cache directory on the persistent volume, the first time, and links
+# them back into the home directory at every start:
+#
+#   ~/.vscode-server  ->  $CACHE_DIR/v1/vscode-server
+#   ~/.condarc           lists $CACHE_DIR/v1/conda/envs and conda/pkgs
+#
+# The cache layout is versioned (v1): directories of other layout versions
+# are removed. Old VS Code server versions and conda package downloads
+# are evicted, oldest first, while the cache is larger than CACHE_MAX_MB.
+# The newest server version and the conda environments are never evicted.
+#
+# Everything is configurable through the environment, for tests:
+# HOME_DIR, CACHE_DIR, CACHE_MAX_MB and OWNER.
+
+set -euo pipefail
+
+HOME_DIR=${HOME_DIR:-/home/ec2-user}
+CACHE_DIR=${CACHE_DIR:-$HOME_DIR/SageMaker/.toolchain-cache}
+CACHE_MAX_MB=${CACHE_MAX_MB:-4096}
+OWNER=${OWNER:-ec2-user}
+
+LAYOUT=v1
+CACHE="$CACHE_DIR/$LAYOUT"
+
+log() {
+    echo "toolchain-cache: $*"
+}
+
+# Gives a path to OWNER when running as root, as lifecycle scripts do
+give_to_owner() {
+    if [ "$(id -u)" -eq 0 ] && id "$OWNER" >/dev/null 2>&1; then
+        chown -R -h "$OWNER:$OWNER" "$@"
+    fi
+}
+
+# Links $HOME_DIR/$1 to the cache directory $2, moving what is already
+# there into the cache the first time
+link_into_home() {
+    local home_path="$HOME_DIR/$1" cache_path="$CACHE/$2"
+    if [ -L "$home_path" ]; then
+        [ "$(readlink "$home_path")" = "$cache_path" ] && return
+        rm "$home_path"
+    elif [ -d "$home_path" ]; then
+        if [ -e "$cache_path" ]; then
+            # Merge, keeping what the cache already has
+            cp -a -n "$home_path/." "$cache_path/"
+            rm -rf "$home_path"
+        else
+            mv "$home_path" "$cache_path"
+        fi
+    fi
+    mkdir -p "$cache_path"
+    ln -s "$cache_path" "$home_path"
+    log "linked ~/$1"
+}
+
+# Adds the cached conda directories to the front of ~/.condarc's lists
+write_condarc() {
+    mkdir -p "$CACHE/conda/envs" "$CACHE/conda/pkgs"
+    local condarc="$HOME_DIR/.condarc"
+    grep -q -F "$CACHE/conda" "$condarc" 2>/dev/null && return
+    {
+        echo "envs_dirs:"
+        echo "  - $CACHE/conda/envs"
+        echo "pkgs_dirs:"
+        echo "  - $CACHE/conda/pkgs"
+        if [ -f "$condarc" ]; then
+            grep -v -E '^(envs_dirs|pkgs_dirs):' "$condarc" || true
+        fi
+    } >"$condarc.tmp"
+    mv "$condarc.tmp" "$condarc"
+    log "added the cached conda directories to ~/.condarc"
+}
+
+# Removes the directories of other cache layout versions
+remove_old_layouts() {
+    local dir
+    for dir in "$CACHE_DIR"/*; do
+        [ -d "$dir" ] && [ "$dir" != "$CACHE" ] || continue
+        rm -rf "$dir"
+        log "removed old cache layout $(basename "$dir")"
+    done
+}
+
+cache_size_mb() {
+    du -s -m "$CACHE_DIR" | cut -f1
+}
+
+# Prints the evictable entries, oldest first: every VS Code server version
+# but the newest of each kind, and the conda package downloads
+evictable() {
+    local versions
+    for versions in "$CACHE/vscode-server/bin" \
+        "$CACHE/vscode-server/cli/servers"; do
+        [ -d "$versions" ] || continue
+        find "$versions" -mindepth 1 -maxdepth 1 -printf '%T@ %p\n' |
+            sort -n | head -n -1
+    done
+    if [ -d "$CACHE/conda/pkgs" ]; then
+        find "$CACHE/conda/pkgs" -mindepth 1 -maxdepth 1 \
+            ! -name urls ! -name urls.txt -printf '%T@ %p\n'
+    fi
+}
+
+evict() {
+    local size entry
+    size=$(cache_size_mb)
+    [ "$size" -le "$CACHE_MAX_MB" ] && return
+    while read -r _ entry; do
+        rm -rf "$entry"
+        log "evicted ${entry#"$CACHE/"}"
+        size=$(cache_size_mb)
+        [ "$size" -le "$CACHE_MAX_MB" ] && return
+    done < <(evictable | sort -n)
+    log "the cache is still ${size} MB, over ${CACHE_MAX_MB} MB"
+}
+
+main() {
+    mkdir -p "$CACHE"
+    remove_old_layouts
+    link_into_home .vscode-server vscode-server
+    write_condarc
+    evict
+    give_to_owner "$CACHE_DIR" "$HOME_DIR/.condarc" "$HOME_DIR/.vscode-server"
+    log "$(cache_size_mb) MB cached in $CACHE_DIR"
+}
+
+main "$@"
@@ -0,0 +1,271 @@
+"""
+The notebook lifecycle scripts, generated from the steps in config.yaml.
+
+SageMaker stops a notebook whose lifecycle script runs for more than
+about five minutes. So the generated script only writes the steps and a
+small job runner (lifecycle/runner.sh) to disk, starts the runner
+detached, and returns. The runner starts every step as soon as the steps
+it comes ``after`` are done, so independent steps run in parallel, and
+writes how long each step took to a JSON file on the notebook, which
+``obtain_key.py lifecycle`` prints.
+
+Each step runs a script from the lifecycle directory or an inline
+command, on notebook creation, start, or both::
+
+    lifecycle:
+      steps:
+        - name: ssh-keys
+          script: ssh-keys.sh
+          on: [create, start]
+        - name: conda-env
+          run: conda env update -f ~/SageMaker/environment.yml
+          after: [toolchain-cache]
+"""
+
+import base64
+import os
+import re
+import shlex
+
+from app_config import PROJECT_DIR, ConfigError
+
+LIFECYCLE_DIR = os.path.join(PROJECT_DIR, "lifecycle")
+
+# The steps run when config.yaml lists none, and the one added to them
+# when the config has an efs section
+DEFAULT_STEPS = [
+    {"name": "ssh-keys", "script": "ssh-keys.sh", "on": ["create", "start"]},
+    {"name": "toolchain-cache", "script": "toolchain-cache.sh"},
+]
+EFS_STEP = {"name": "efs-mount", "script": "efs-mount.sh"}
+
+# Where the runner writes the timings and the steps' output, on the
+# notebook
+LOG_DIR = "/var/log/sagemaker-ssh"
+
+# The longest lifecycle script SageMaker accepts, in characters once
+# base64-encoded
+MAX_SCRIPT_LENGTH = 16384
+
+STEP_NAME = re.compile(r"[A-Za-z0-9_.-]+$")
+
+
+def load_steps(config):
+    """Returns the lifecycle steps of the config, with their defaults.
+
+    Raises
+    ------
+    ConfigError
+        If a step has a bad name, both or neither of ``script`` and
+        ``run``, or comes after an unknown step or, indirectly, itself.
+    """
+    entries = config["lifecycle"].get("steps")
+    if not entries:
+        entries = DEFAULT_STEPS
+        if config.get("efs") is not None:
+            entries = [*entries, EFS_STEP]
+    steps = []
+    for entry in entries:
+        name = entry["name"]
+        if not STEP_NAME.match(name):
+            raise ConfigError(f"Invalid lifecycle step name {name!r}")
+        if ("script" in entry) == ("run" in entry):
+            raise ConfigError(
+                f"Lifecycle step {name} needs one of script and run"
+            )
+        steps.append(
+            {
+                "name": name,
+                "script": entry.get("script"),
+                "run": entry.get("run"),
+                "after": list(entry.get("after") or []),
+                "on": list(entry.get("on") or ["start"]),
+            }
+        )
+    names = [step["name"] for step in steps]
+    for step in steps:
+        if names.count(step["name"]) > 1:
+            raise ConfigError(f"Duplicate lifecycle step {step['name']}")
+        for dependency in step["after"]:
+            if dependency not in names:
+                raise ConfigError(
+                    f"Lifecycle step {step['name']} comes after unknown "
+                    f"step {dependency}"
+                )
+    return order_steps(steps)
+
+
+def order_steps(steps):
+    """Sorts steps so that each comes after its dependencies.
+
+    Raises
+    ------
+    ConfigError
+        If the steps depend on each other in a cycle.
+    """
+    by_name = {step["name"]: step for step in steps}
+    ordered = []
+    state = {}
+
+    def visit(name, path):
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            start = path.index(name)
+            cycle = " -> ".join(path[start:] + [name])
+            raise ConfigError(f"Lifecycle steps depend on each other: {cycle}")
+        state[name] = "visiting"
+        for dependency in by_name[name]["after"]:
+            visit(dependency, path + [name])
+        state[name] = "done"
+        ordered.append(by_name[name])
+
+    for step in steps:
+        visit(step["name"], [])
+    return ordered
+
+
+def compact(content):
+    """Returns a bash script without its comment lines and blank lines,
+    which take most of the room SageMaker gives the lifecycle script.
+
+    Shebang lines are kept, and so are comments after a command.
+    """
+    return "".join(
+        line
+        for line in content.splitlines(keepends=True)
+        if line.strip()
+        and (line.startswith("#!") or not line.lstrip().startswith("#"))
+    )
+
+
+def step_content(step, lifecycle_dir=LIFECYCLE_DIR):
+    """Returns the bash script of a step, compacted if it is a script
+    from the lifecycle directory."""
+    if step["run"] is not None:
+        return f"set -e\n{step['run']}\n"
+    with open(os.path.join(lifecycle_dir, step["script"])) as f:
+        return compact(f.read())
+
+
+def _heredoc(path, content, delimiter):
+    if not content.endswith("\n"):
+        content += "\n"
+    if f"\n{delimiter}\n" in f"\n{content}":
+        raise ValueError(f"{path} contains its heredoc delimiter")
+    return f"cat > {path} <<'{delimiter}'\n{content}{delimiter}\n"
+
+
+def render(steps, event, environment=None, lifecycle_dir=LIFECYCLE_DIR):
+    """Returns the lifecycle script of an event, "create" or "start".
+
+    Parameters
+    ----------
+    steps : list
+        The steps, see ``load_steps``. Only those that run on ``event``
+        are included; ``after`` dependencies on the others are dropped.
+    environment : dict
+        Variables exported to every step. Their values are quoted, so
+        they are never run as shell code.
+
+    Raises
+    ------
+    ValueError
+        If the script is longer than SageMaker allows once
+        base64-encoded.
+    """
+    steps = [step for step in steps if event in step["on"]]
+    names = {step["name"] for step in steps}
+    with open(os.path.join(lifecycle_dir, "runner.sh")) as f:
+        runner = compact(f.read())
+
+    lines = [
+        "#!/usr/bin/env bash",
+        "# Generated from the lifecycle steps in config.yaml, see",
+        "# lifecycle_steps.py",
+        "set -e",
+        f"export EVENT={event}",
+        f"export LOG_DIR=${{LOG_DIR:-{LOG_DIR}}}",
+        f"export RUN_DIR=${{RUN_DIR:-/tmp/sagemaker-ssh-{event}}}",
+    ]
+    lines += [
+        f"export {key}={shlex.quote(str(value))}"
+        for key, value in (environment or {}).items()
+    ]
+    lines.append('mkdir -p "$RUN_DIR/steps" "$LOG_DIR"')
+    for step in steps:
+        lines.append(
+            _heredoc(
+                f'"$RUN_DIR/steps/{step["name"]}.sh"',
+                step_content(step, lifecycle_dir),
+                "SAGEMAKER_SSH_STEP_EOF",
+            )
+        )
+
+    launches = []
+    for step in steps:
+        after = [name for name in step["after"] if name in names]
+        launches.append(f"    run_step {' '.join([step['name'], *after])} &")
+    run_script = "\n".join(
+        [
+            runner,
+            f"STEPS=({' '.join(step['name'] for step in steps)})",
+            "start_steps() {",
+            *launches,
+            "    :",
+            "}",
+            "run_steps",
+        ]
+    )
+    lines.append(
+        _heredoc('"$RUN_DIR/run.sh"', run_script, "SAGEMAKER_SSH_RUN_EOF")
+    )
+    lines += [
+        'if [ -n "${LIFECYCLE_FOREGROUND:-}" ]; then',
+        '    bash "$RUN_DIR/run.sh"',
+        "else",
+        "    # Detached, so that the notebook doesn't wait for the steps",
+        '    nohup setsid bash "$RUN_DIR/run.sh" \\',
+        '        >"$LOG_DIR/$EVENT.runner.log" 2>&1 </dev/null &',
+        "fi",
+    ]
+    script = "\n".join(lines) + "\n"
+    length = len(base64.b64encode(script.encode()))
+    if length > MAX_SCRIPT_LENGTH:
+        raise ValueError(
+            f"The {event} lifecycle script is {length} characters long "
+            f"once base64-encoded, SageMaker allows {MAX_SCRIPT_LENGTH}"
+        )
+    return script
+
+
+def timings_path(event="start"):
+    """Returns the path of an event's timings JSON on the notebook."""
+    return f"{LOG_DIR}/{event}.json"
+
+
+def format_timings(timings):
+    """Returns the timings JSON of a lifecycle run as a table."""
+    started = timings["started"]
+    finished = timings["finished"]
+    lines = []
+    for step in timings["steps"]:
+        if step["start"] is None:
+            span = ""
+        else:
+            span = (
+                f"{step['start'] - started:>7.1f}s"
+                f"{step['end'] - step['start']:>8.1f}s"
+            )
+        lines.append(f"  {step['name']:<24}{step['status']:<9}{span}")
+    if finished is None:
+        total = "still running"
+    else:
+        total = f"{finished - started:.1f}s"
+    return "\n".join(
+        [
+            f"{timings['event']} lifecycle: {total}",
+            f"  {'step':<24}{'status':<9}{'offset':>8}{'time':>9}",
+            *lines,
+        ]
+    )
@@ -8,184 +8,1224 @@ The script requires an "outputs.json" file with the following entries:
 - KeyStack.Region: the AWS region of the key pair
 - KeyStack.MyKeyPairName: the name of the key pair
 - KeyStack.MyKeyPairParameterName: the name of the key pair parameter in SSM
-- BastionStack.PublicIP: the public IP of the bastion host
+- BastionStack.PublicIP: the public IP of the bastion host, and
+  PublicIP2... with several ec2.bastions, or with ssh.connection
+  "instance-connect", InstanceConnectStack.EndpointID: the
+  ID of the EC2 Instance Connect Endpoint the notebook hosts tunnel through
 - SageMakerStack.SageMakerNotebookName: the name of the SageMaker Notebook
 - SageMakerStack.SageMakerNotebookURL: the URL of the SageMaker Notebook
 
-Usage: python script.py [action]
+with one SageMakerStack per notebook if config.yaml lists several
+"notebooks". All notebooks are resolved together and written to the SSH
+config in one write.
+
+If config.yaml lists target "environments", deploy.py merges the outputs
+of all of them into outputs.json, with stack names that start with the
+environment's name, and --environment NAME picks the environment to act
+on. Its host names, key file and endpoint cache include its name, so
+that the hosts of every environment can be set up side by side.
+
+Usage: python script.py [action] [--environment NAME] [--timings]
 
 Actions:
 
-- "get": retrieves the key pair parameter, writes the key to a file,
-sets permissions, adds hosts to the SSH config, and prints instructions.
+- "get": retrieves the key pair parameter, writes the key to a file only
+the user can read (or with ssh.key_storage "agent", loads it into the
+ssh-agent), adds hosts to the SSH config, and prints how to connect.
+The notebooks authorize the key themselves when they start. The key and
+the notebook's address are resolved concurrently; pass --timings to
+print how long each phase took.
+- "refresh": after a notebook restart, re-checks only the notebook's
+private IP (one describe call) using the endpoint cache written by "get",
+and rewrites only the notebook's Hostname. Falls back to "get" if the
+cache is missing, stale, or the key or outputs.json changed.
+- "resume": starts the stopped notebooks and bastions, waits until they
+are all ready, bounded by --timeout, and then refreshes the Hostname of
+the notebooks that weren't, like "refresh". See resume.py.
+- "wait": the same, for notebooks and bastions that are already
+starting, without starting the stopped ones.
+- "forward HOST SERVICE": forwards a notebook service, by its name in
+config.yaml or its remote port, through the open shared connection to
+HOST, without reconnecting. With --cancel, stops forwarding it.
+- "tunnel": runs the tunnel daemon until interrupted. It keeps one
+connection to the bastion and relays local ports to the notebooks' SSH
+servers and services over it, so that connecting to the "-tunnel" hosts
+it adds starts no ssh process for the bastion hop. Needs a "get" first.
+- "sync LOCAL_DIR [REMOTE_DIR]": copies the files of LOCAL_DIR that
+changed since the last sync to the notebook, by default to
+~/SageMaker/<name of LOCAL_DIR>, in parallel compressed streams over the
+notebook host's shared connection. See data_sync.py.
+- "lifecycle [start|create]": prints how long each lifecycle step took
+on the notebooks at their last start (or creation), from the timings the
+generated lifecycle script writes. See lifecycle_steps.py.
 - "remove": removes the key file and removes hosts from the SSH config.
 """
 
 import argparse
+import asyncio
+import contextlib
 import json
 import os
 import subprocess
-import yaml
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import boto3
 from botocore.exceptions import ClientError
 
-from ssh_utils import SSHConfig, private_to_public_key
-
-parser = argparse.ArgumentParser(
-    description="Retrieve or remove a parameter from SSM Parameter Store"
+import data_sync
+import lifecycle_steps
+import resume
+from app_config import (
+    ConfigError,
+    environment,
+    environments,
+    load_config,
+    notebooks,
+)
+from bastion_pool import BastionPool, proxy_command
+from endpoint_cache import EndpointCache, default_cache_path, file_digest
+from port_forwards import (
+    ForwardRegistry,
+    control_forward,
+    local_forward,
+    port_is_free,
+)
+from ssh_profiles import connection_options, ensure_control_dir, load_profile
+from ssh_utils import (
+    SSHConfig,
+    atomic_write,
+    key_fingerprint,
+    private_to_public_key,
 )
+from tunnel import Listener, Transport, TunnelDaemon, transport_command
 
-parser.add_argument(
-    "action",
-    choices=["get", "remove"],
-    help='Action to perform: "get" to retrieve the '
-    'parameter or "remove" to delete the key file',
+# Network interface IDs per describe_network_interfaces call
+ENI_BATCH_SIZE = 200
+
+# Concurrent describe_notebook_instance calls
+DESCRIBE_CONCURRENCY = 8
+
+# How long the ssh-agent keeps the key with ssh.key_storage "agent", in
+# seconds
+DEFAULT_AGENT_LIFETIME = 12 * 60 * 60
+
+# The ProxyCommand of the notebook hosts without a bastion. Needs the AWS
+# CLI v2 and the ec2-instance-connect:OpenTunnel permission.
+INSTANCE_CONNECT_COMMAND = (
+    "aws ec2-instance-connect open-tunnel "
+    "--instance-connect-endpoint-id {endpoint_id} "
+    "--private-ip-address %h --remote-port %p --region {region}"
 )
-args = parser.parse_args()
-
-# Get configs
-with open("config.yaml") as file:
-    config = yaml.load(file, Loader=yaml.SafeLoader)
-config_suffix = config["ssh"]["config_suffix"]
-suffix = config["notebook"]["name"]
-
-# Get outputs
-with open("outputs.json") as file:
-    outputs = json.load(file)
-region = outputs[f"KeyStack-{suffix}"]["Region"]
-key_name = outputs[f"KeyStack-{suffix}"]["MyKeyPairName"]
-key_parameter_name = outputs[f"KeyStack-{suffix}"]["MyKeyPairParameterName"]
-key_filename = key_name + ".pem"
-key_filepath = os.path.expanduser(os.path.join("~", ".ssh", key_filename))
-bastion_ip = outputs[f"BastionStack-{suffix}"]["PublicIP"]
-notebook_instance_name = outputs[f"SageMakerStack-{suffix}"]["SageMakerNotebookName"]
-notebook_url = outputs[f"SageMakerStack-{suffix}"]["SageMakerNotebookURL"]
-
-# Define host names with account name
-bastion_host_name = "ec2-bastion-" + config_suffix
-notebook_host_name = "sagemaker-notebook-" + config_suffix
-
-# Create a Boto3 client for the SSM service
-ssm = boto3.client("ssm", region_name=region)
-
-# Instantiate an SSHConfig object
-ssh_config_file = os.path.expanduser(os.path.join("~", ".ssh", "config"))
-config = SSHConfig(ssh_config_file)
-
-
-if args.action == "get":
+
+
+class Timings:
+    """Records how long each phase of an action takes."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the enclosed block as phase ``name``."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.phases.append((name, start, end))
+
+    def timed(self, name, function):
+        """Wraps ``function`` so that each call is timed as ``name``."""
+
+        def wrapper(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    def print_report(self):
+        """Prints each phase's start offset and duration."""
+        total = time.perf_counter() - self.start
+        print(f"{'phase':<24}{'start':>10}{'duration':>10}")
+        for name, start, end in sorted(self.phases, key=lambda p: p[1]):
+            print(f"{name:<24}{start - self.start:>9.3f}s{end - start:>9.3f}s")
+        print(f"{'total':<24}{'':>10}{total:>9.3f}s")
+
+
+def run_graph(tasks, timings, max_workers=8):
+    """Runs ``tasks`` concurrently, each as soon as its dependencies finish.
+
+    Parameters
+    ----------
+    tasks : dict
+        Maps a task name to ``(function, dependencies)``. The function is
+        called with the results of its dependencies as keyword arguments.
+    timings : Timings
+        Records the duration of each task.
+    max_workers : int
+        The maximum number of tasks to run at the same time.
+
+    Returns
+    -------
+    results : dict
+        The result of each task, by name.
+    """
+    results = {}
+    pending = dict(tasks)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for name, (function, dependencies) in list(pending.items()):
+                if all(dep in results for dep in dependencies):
+                    kwargs = {dep: results[dep] for dep in dependencies}
+                    future = pool.submit(
+                        timings.timed(name, function), **kwargs
+                    )
+                    running[future] = name
+                    del pending[name]
+            if not running:
+                raise ValueError(f"Unsatisfiable dependencies: {pending}")
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+
+
+def load_settings(
+    config_path=None, outputs_path="outputs.json", environment_name=None
+):
+    """Reads the app config and the deployed stacks' outputs.
+
+    With an ``environment_name``, reads the outputs of that target
+    environment's stacks, whose names start with it.
+    """
+    config = load_config(config_path)
+    config_suffix = config["ssh"]["config_suffix"]
+    suffix = config["notebook"]["name"]
+    prefix = ""
+    key_suffix = ""
+    target = {}
+    # The stacks of a target environment start with its name, and its
+    # hosts and key file include it
+    if environment_name:
+        target = environment(config, environment_name)
+        prefix = f"{environment_name}-"
+        config_suffix = f"{environment_name}-{config_suffix}"
+        key_suffix = f"-{environment_name}"
+
+    with open(outputs_path) as file:
+        outputs = json.load(file)
+    key_outputs = outputs[f"{prefix}KeyStack-{suffix}"]
+    key_name = key_outputs["MyKeyPairName"]
+
+    # Define host names with account name, and with the notebook's name
+    # when there are several
+    notebook_settings = []
+    for notebook in notebooks(config):
+        stack_name = f"{prefix}SageMakerStack-{notebook['name']}"
+        notebook_outputs = outputs[stack_name]
+        host_name = "sagemaker-notebook-" + config_suffix
+        if config.get("notebooks"):
+            host_name = (
+                f"sagemaker-notebook-{notebook['name']}-" + config_suffix
+            )
+        notebook_settings.append(
+            {
+                "instance_name": notebook_outputs["SageMakerNotebookName"],
+                "url": notebook_outputs["SageMakerNotebookURL"],
+                "host_name": host_name,
+                "services": dict(notebook.get("services") or {}),
+            }
+        )
+
+    # The hosts go to a fragment Included from the main config if one is
+    # configured
+    include_file = config["ssh"].get("include_file")
+    ssh_dir = os.path.expanduser(os.path.join("~", ".ssh"))
+    main_config_file = os.path.join(ssh_dir, "config")
+    ssh_config_file = main_config_file
+    if include_file:
+        ssh_config_file = os.path.join(
+            ssh_dir, os.path.expanduser(include_file)
+        )
+
+    ssh = config["ssh"]
+    profile = load_profile(ssh.get("profile", "default"), ssh.get("profiles"))
+
+    # The notebooks are reached through the bastions or an EC2 Instance
+    # Connect Endpoint
+    connection = ssh.get("connection", "bastion")
+    bastion_host_name = "ec2-bastion-" + config_suffix
+    bastions = {}
+    bastion_instance_ids = []
+    endpoint_id = None
+    if connection == "bastion":
+        bastion_outputs = outputs[f"{prefix}BastionStack-{suffix}"]
+        for index in range(config["ec2"].get("bastions", 1)):
+            id_suffix = str(index + 1) if index else ""
+            host = f"{bastion_host_name}-{index + 1}" if index else None
+            bastions[host or bastion_host_name] = bastion_outputs[
+                "PublicIP" + id_suffix
+            ]
+            bastion_instance_ids.append(
+                bastion_outputs["InstanceID" + id_suffix]
+            )
+    else:
+        endpoint_id = outputs[f"{prefix}InstanceConnectStack-{suffix}"][
+            "EndpointID"
+        ]
+
+    # The hosts' IdentityFile: the private key, or the public key that
+    # selects the key in the ssh-agent
+    key_storage = ssh.get("key_storage", "file")
+    key_extension = ".pub" if key_storage == "agent" else ".pem"
+
+    # Each environment has its own endpoint cache, as the notebooks have
+    # the same names in all of them
+    cache_path = None
+    if environment_name:
+        cache_path = os.path.join(
+            os.path.dirname(default_cache_path()),
+            f"endpoints-{environment_name}.json",
+        )
+
+    return {
+        "environment": environment_name,
+        "aws_profile": target.get("profile"),
+        "endpoint_cache_path": cache_path,
+        "region": key_outputs["Region"],
+        "key_name": key_name,
+        "key_parameter_name": key_outputs["MyKeyPairParameterName"],
+        "key_filepath": os.path.join(
+            ssh_dir, key_name + key_suffix + key_extension
+        ),
+        "key_storage": key_storage,
+        "agent_lifetime": ssh.get("agent_lifetime", DEFAULT_AGENT_LIFETIME),
+        "connection": connection,
+        "bastion_host_name": bastion_host_name,
+        "bastions": bastions,
+        "bastion_instance_ids": bastion_instance_ids,
+        "instance_connect_endpoint_id": endpoint_id,
+        "notebooks": notebook_settings,
+        "profile": profile,
+        "outputs_digest": file_digest(outputs_path),
+        "include_file": include_file,
+        "main_config_file": main_config_file,
+        "ssh_config_file": ssh_config_file,
+    }
+
+
+class Clients(dict):
+    """AWS clients by service name, created once on first use."""
+
+    def __init__(self, region, profile=None):
+        super().__init__()
+        self._session = boto3.session.Session(
+            region_name=region, profile_name=profile
+        )
+
+    def __missing__(self, service):
+        client = self[service] = self._session.client(service)
+        return client
+
+
+def fetch_key(ssm, parameter_name):
+    """Retrieves the private key from SSM Parameter Store."""
+    response = ssm.get_parameter(Name=parameter_name, WithDecryption=True)
+    return response["Parameter"]["Value"]
+
+
+def install_key(key_material, key_filepath):
+    """Writes the key to a file only the user can read.
+
+    The file is replaced atomically, and readable by the user alone from
+    its creation on.
+    """
+    os.makedirs(os.path.dirname(key_filepath), mode=0o700, exist_ok=True)
+    atomic_write(key_filepath, [key_material.encode()], mode=0o400)
+    print(f"Wrote key to file: {key_filepath}")
+    return key_filepath
+
+
+def add_key_to_agent(key_material, public_key, public_key_path, lifetime):
+    """Loads the key into the running ssh-agent for ``lifetime`` seconds.
+
+    The private key goes to ssh-add through a pipe and never touches the
+    disk. The public key is written to ``public_key_path``, for the hosts'
+    IdentityFile to select the key in the agent.
+
+    Raises
+    ------
+    RuntimeError
+        If no agent is running or ssh-add fails.
+    """
+    if not os.environ.get("SSH_AUTH_SOCK"):
+        raise RuntimeError(
+            "no ssh-agent is running (SSH_AUTH_SOCK is not set), start one "
+            "or set ssh.key_storage to file"
+        )
     try:
-        # Retrieve the parameter value
-        response = ssm.get_parameter(
-            Name=key_parameter_name,
-            WithDecryption=True,
+        subprocess.run(
+            ["ssh-add", "-q", "-t", str(lifetime), "-"],
+            input=key_material.encode(),
+            capture_output=True,
+            check=True,
+        )
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"ssh-add failed: {e.stderr.decode().strip()}")
+    os.makedirs(os.path.dirname(public_key_path), mode=0o700, exist_ok=True)
+    atomic_write(public_key_path, [(public_key + "\n").encode()], mode=0o644)
+    print(f"Added key to ssh-agent for {lifetime}s: {public_key_path}")
+    return public_key_path
+
+
+def notebook_network_interface(sagemaker, notebook_instance_name):
+    """Returns the ID of the SageMaker notebook instance's ENI, or None
+    while it has none, when it is stopped or still starting."""
+    return sagemaker.describe_notebook_instance(
+        NotebookInstanceName=notebook_instance_name
+    ).get("NetworkInterfaceId")
+
+
+def notebook_network_interfaces(
+    sagemaker, notebook_instance_names, max_workers=DESCRIBE_CONCURRENCY
+):
+    """Returns the ENI ID of each notebook instance, by name.
+
+    SageMaker has no batch describe, so the calls run concurrently, at most
+    ``max_workers`` at a time. Notebooks without an ENI are left out.
+    """
+    notebook_instance_names = list(notebook_instance_names)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        network_interface_ids = pool.map(
+            lambda name: notebook_network_interface(sagemaker, name),
+            notebook_instance_names,
         )
-        param_value = response["Parameter"]["Value"]
+        return {
+            name: network_interface_id
+            for name, network_interface_id in zip(
+                notebook_instance_names, network_interface_ids
+            )
+            if network_interface_id is not None
+        }
 
-        # Write the key to a file and set permissions
-        with open(key_filename, "w") as f:
-            f.write(param_value)
-        subprocess.run(["sudo", "mv", key_filename, key_filepath])
-        subprocess.run(["sudo", "chmod", "400", key_filepath])
-        print(f"Wrote key to file: {key_filepath}")
 
-        # Get public key
-        public_key_str = private_to_public_key(key_filepath)
+def network_interface_ips(ec2, network_interface_ids):
+    """Returns the private IP of each network interface, by ID.
 
-        # Create a Boto3 EC2 client
-        ec2 = boto3.client("ec2", region_name=region)
+    The interfaces are described in batches of ``ENI_BATCH_SIZE`` IDs
+    through the paginated API. Interfaces that no longer exist are missing
+    from the result.
+    """
+    network_interface_ids = list(dict.fromkeys(network_interface_ids))
+    paginator = ec2.get_paginator("describe_network_interfaces")
+    ips = {}
+    for start in range(0, len(network_interface_ids), ENI_BATCH_SIZE):
+        end = start + ENI_BATCH_SIZE
+        batch = network_interface_ids[start:end]
+        pages = paginator.paginate(
+            Filters=[{"Name": "network-interface-id", "Values": batch}]
+        )
+        for page in pages:
+            for interface in page["NetworkInterfaces"]:
+                ips[interface["NetworkInterfaceId"]] = interface[
+                    "PrivateIpAddress"
+                ]
+    return ips
 
-        # Get the NetworkInterfaceId from the SageMaker notebook instance
-        sagemaker = boto3.client("sagemaker", region_name=region)
 
-        # Get the NetworkInterfaceId from the SageMaker notebook instance
-        network_interface_id = sagemaker.describe_notebook_instance(
-            NotebookInstanceName=notebook_instance_name
-        )["NetworkInterfaceId"]
+def notebook_ips(ec2, network_interface_ids):
+    """Maps notebook names to private IPs, given their ENIs by name."""
+    ips = network_interface_ips(ec2, network_interface_ids.values())
+    return {
+        name: ips[network_interface_id]
+        for name, network_interface_id in network_interface_ids.items()
+        if network_interface_id in ips
+    }
 
 
-        # Describe the network interface and get its PrivateIpAddress
-        response = ec2.describe_network_interfaces(
-            NetworkInterfaceIds=[network_interface_id]
+def unreachable_notebooks(settings, ips):
+    """Prints the notebooks that have no private IP in ``ips``, as they are
+    stopped or still starting, and returns their names."""
+    missing = [
+        notebook["instance_name"]
+        for notebook in settings["notebooks"]
+        if notebook["instance_name"] not in ips
+    ]
+    for name in missing:
+        print(
+            f"{name} has no address, it is stopped or still starting: run "
+            '"resume" to start it, or "wait" until it has started'
         )
-        sagemaker_ip = response["NetworkInterfaces"][0]["PrivateIpAddress"]
+    return missing
 
 
-        # Add a new bastion host
-        new_host_bastion = {
+def host_entries(settings, ips, forwards=None):
+    """Returns the bastion and notebook Host blocks, by host name.
+
+    ``ips`` maps notebook instance names to their private IPs, and
+    ``forwards`` notebook host names to their allocated port forwards (see
+    port_forwards.ForwardRegistry). Notebooks without an IP get no host.
+    With several bastions, the notebook hosts go through the fastest one,
+    see bastion_pool.py. Without a bastion, they tunnel through the EC2
+    Instance Connect Endpoint instead.
+    """
+    forwards = forwards or {}
+    key_filepath = settings["key_filepath"]
+    connection = connection_options(settings["profile"])
+    hosts = {}
+    for host, bastion_ip in settings["bastions"].items():
+        hosts[host] = {
             "Hostname": bastion_ip,
             "User": "ec2-user",
             "ForwardAgent": "yes",
             "IdentityFile": key_filepath,
+            "IdentitiesOnly": "yes",
             "ForwardX11": "yes",
+            **connection,
         }
-
-        # Add a new notebook host
-        new_host_notebook = {
-            "Hostname": sagemaker_ip,
+    if len(settings["bastions"]) > 1:
+        proxy = {"ProxyCommand": proxy_command(settings["bastions"])}
+    elif settings["bastions"]:
+        proxy = {"ProxyJump": settings["bastion_host_name"]}
+    else:
+        command = INSTANCE_CONNECT_COMMAND.format(
+            endpoint_id=settings["instance_connect_endpoint_id"],
+            region=settings["region"],
+        )
+        proxy = {"ProxyCommand": command}
+    for notebook in settings["notebooks"]:
+        if notebook["instance_name"] not in ips:
+            continue
+        host = notebook["host_name"]
+        hosts[host] = {
+            "Hostname": ips[notebook["instance_name"]],
             "User": "ec2-user",
             "UserKnownHostsFile": "/dev/null",
             "StrictHostKeyChecking": "no",
-            "ProxyCommand": f"ssh -W %h:%p ec2-user@{bastion_host_name}",
+            **proxy,
             "IdentityFile": key_filepath,
-            "LocalForward": "6006 localhost:6006",  # Tensorboard
+            "IdentitiesOnly": "yes",
+            "LocalForward": [
+                local_forward(forward["local_port"], forward["remote_port"])
+                for forward in forwards.get(host, {}).values()
+            ],
             "ForwardX11": "yes",
+            **connection,
         }
+        if not hosts[host]["LocalForward"]:
+            del hosts[host]["LocalForward"]
+    return hosts
 
-        # Add the hosts to the SSH config
-        config.add_host(bastion_host_name, **new_host_bastion)
-        config.add_host(notebook_host_name, **new_host_notebook)
 
-        # Print the new hosts
-        config.print_host(bastion_host_name)
-        config.print_host(notebook_host_name)
+def write_hosts(settings, hosts):
+    """Adds the hosts to the SSH config with a single write."""
+    # Make sure the main SSH config Includes the fragment
+    if settings["include_file"]:
+        with SSHConfig(settings["main_config_file"]).transaction() as txn:
+            txn.add_include(settings["include_file"])
 
-        # Get the public key
-        public_key_str = private_to_public_key(key_filepath)
+    ensure_control_dir()
+    ssh_config = SSHConfig(settings["ssh_config_file"])
+    with ssh_config.transaction() as txn:
+        for host, options in hosts.items():
+            txn.add_host(host, **options)
+    return ssh_config
 
-        # Print the instructions
-        green = "\033[32m"
-        reset = "\033[0m"
-        print(
-            f"{green}Step 1. Open the Notebook instance at:\n{notebook_url}\n"
+
+def get(settings, clients, timings, cache, registry):
+    """Resolves the key and the notebook addresses and writes the hosts.
+
+    The independent AWS calls run concurrently: the key is fetched,
+    installed and its public key derived while the notebooks' network
+    interfaces and private IPs are looked up. The notebooks' services get
+    their local ports from ``registry``. With ssh.key_storage "agent",
+    the key is loaded into the ssh-agent instead of written to a file.
+    Notebooks that are stopped or still starting are reported, and get no
+    host.
+
+    Returns
+    -------
+    results : dict
+        The results of each step, by name.
+    """
+    names = [notebook["instance_name"] for notebook in settings["notebooks"]]
+
+    def store_endpoints(key_filepath, network_interface_ids, notebook_ips):
+        key_fingerprint = file_digest(key_filepath)
+        cache.update(
+            {
+                name: {
+                    "key_fingerprint": key_fingerprint,
+                    "network_interface_id": network_interface_ids[name],
+                    "private_ip": notebook_ips[name],
+                    "outputs_digest": settings["outputs_digest"],
+                }
+                for name in notebook_ips
+            }
         )
-        print(
-            f"Step 2. Paste the following contents into the file "
-            f"'authorized_keys':\n{public_key_str}\n"
+
+    if settings["key_storage"] == "agent":
+        store_key = (
+            lambda key_material, public_key: add_key_to_agent(
+                key_material,
+                public_key,
+                settings["key_filepath"],
+                settings["agent_lifetime"],
+            ),
+            ["key_material", "public_key"],
         )
-        print(
-            "Step 3. Open a terminal in the notebook and run the "
-            "following command:\ncopy-ssh-keys\n"
+    else:
+        store_key = (
+            lambda key_material: install_key(
+                key_material, settings["key_filepath"]
+            ),
+            ["key_material"],
         )
-        print(
-            f"Step 4. Connect to the notebook instance:\n"
-            f"ssh {notebook_host_name}\n"
+
+    tasks = {
+        "key_material": (
+            lambda: fetch_key(clients["ssm"], settings["key_parameter_name"]),
+            [],
+        ),
+        "key_filepath": store_key,
+        "public_key": (
+            lambda key_material: private_to_public_key(key_material.encode()),
+            ["key_material"],
+        ),
+        "network_interface_ids": (
+            lambda: notebook_network_interfaces(clients["sagemaker"], names),
+            [],
+        ),
+        "notebook_ips": (
+            lambda network_interface_ids: notebook_ips(
+                clients["ec2"], network_interface_ids
+            ),
+            ["network_interface_ids"],
+        ),
+        "forwards": (
+            lambda: registry.allocate(
+                {
+                    notebook["host_name"]: notebook["services"]
+                    for notebook in settings["notebooks"]
+                }
+            ),
+            [],
+        ),
+        "ssh_config": (
+            lambda notebook_ips, forwards: write_hosts(
+                settings, host_entries(settings, notebook_ips, forwards)
+            ),
+            ["notebook_ips", "forwards"],
+        ),
+        "cache": (
+            store_endpoints,
+            ["key_filepath", "network_interface_ids", "notebook_ips"],
+        ),
+    }
+    results = run_graph(tasks, timings)
+    unreachable_notebooks(settings, results["notebook_ips"])
+    return results
+
+
+def resume_notebooks(
+    settings,
+    clients,
+    timings,
+    cache,
+    start=True,
+    timeout=resume.DEFAULT_TIMEOUT,
+):
+    """Starts the stopped notebooks and bastions and waits until they are
+    ready, see resume.wait_ready. Then refreshes the hosts of the
+    notebooks that weren't ready, as their addresses may have changed.
+
+    Returns
+    -------
+    refreshed : bool
+        False if there are no usable cache entries and a full "get" is
+        needed.
+    """
+    names = [notebook["instance_name"] for notebook in settings["notebooks"]]
+    with timings.phase("wait_ready"):
+        resumed = resume.wait_ready(
+            clients["sagemaker"],
+            clients["ec2"],
+            names,
+            settings["bastion_instance_ids"],
+            start=start,
+            timeout=timeout,
         )
+    affected = [
+        notebook
+        for notebook in settings["notebooks"]
+        if notebook["instance_name"] in resumed
+    ]
+    if not affected:
+        print("All notebooks are ready")
+        return True
+    return refresh(dict(settings, notebooks=affected), clients, timings, cache)
+
+
+def cached_endpoints(settings, cache):
+    """Returns the cache entries if they still describe this deployment.
+
+    Returns None unless every notebook has an entry that was resolved from
+    the same outputs.json and key file.
+    """
+    try:
+        key_fingerprint = file_digest(settings["key_filepath"])
+    except OSError:
+        return None
+    entries = {}
+    for notebook in settings["notebooks"]:
+        entry = cache.load(notebook["instance_name"])
+        if (
+            entry is None
+            or entry["outputs_digest"] != settings["outputs_digest"]
+            or entry["key_fingerprint"] != key_fingerprint
+        ):
+            return None
+        entries[notebook["instance_name"]] = entry
+    return entries
+
+
+def refresh(settings, clients, timings, cache):
+    """Updates the notebooks' addresses from the endpoint cache.
+
+    Only the notebooks' private IPs are looked up, normally with a single
+    batched describe_network_interfaces call, and only the Hostnames that
+    changed are rewritten. Notebooks that have no IP, as they are stopped
+    or still starting, are reported and keep their hosts.
+
+    Returns
+    -------
+    refreshed : bool
+        False if there are no usable cache entries and a full "get" is
+        needed.
+    """
+    entries = cached_endpoints(settings, cache)
+    if entries is None:
+        return False
+
+    with timings.phase("notebook_ips"):
+        network_interface_ids = {
+            name: entry["network_interface_id"]
+            for name, entry in entries.items()
+        }
+        ips = notebook_ips(clients["ec2"], network_interface_ids)
+        missing = [name for name in network_interface_ids if name not in ips]
+        if missing:
+            # These notebooks were given new network interfaces
+            moved = notebook_network_interfaces(clients["sagemaker"], missing)
+            network_interface_ids.update(moved)
+            ips.update(notebook_ips(clients["ec2"], moved))
+
+    with timings.phase("ssh_config"):
+        ssh_config = SSHConfig(settings["ssh_config_file"])
+        hosts = ssh_config.config
+        changed = {}
+        unreachable = unreachable_notebooks(settings, ips)
+        for notebook in settings["notebooks"]:
+            if notebook["instance_name"] in unreachable:
+                continue
+            host, ip = notebook["host_name"], ips[notebook["instance_name"]]
+            if hosts.get(host, {}).get("Hostname") != ip:
+                changed[host] = ip
+                print(f"Updated {host} to {ip}")
+            else:
+                print(f"{host} is up to date ({ip})")
+        if changed:
+            with ssh_config.transaction() as txn:
+                for host, ip in changed.items():
+                    txn.update_host(host, Hostname=ip)
+        cache.update(
+            {
+                name: {
+                    "network_interface_id": network_interface_ids[name],
+                    "private_ip": ips[name],
+                }
+                for name in ips
+            }
+        )
+    return True
+
+
+def print_instructions(settings, ssh_config, public_key_str, forwards):
+    """Prints the new hosts and the steps to connect."""
+    notebook_host_names = [
+        notebook["host_name"] for notebook in settings["notebooks"]
+    ]
+    notebook_urls = "\n".join(
+        notebook["url"] for notebook in settings["notebooks"]
+    )
+    host_names = "\n".join(notebook_host_names)
+
+    # Print the new hosts
+    for host_name in settings["bastions"]:
+        ssh_config.print_host(host_name)
+    for host_name in notebook_host_names:
+        ssh_config.print_host(host_name)
+
+    # Print the instructions. The notebooks' lifecycle script authorizes
+    # the key, see lifecycle/ssh-keys.sh.
+    green = "\033[32m"
+    reset = "\033[0m"
+    print(
+        f"{green}The notebooks authorize the key "
+        f"(fingerprint {key_fingerprint(public_key_str)}) when they start. "
+        f"They are at:\n{notebook_urls}\n"
+    )
+    print(
+        "Step 1. Connect to the notebook instance:\n"
+        + "".join(f"ssh {host_name}\n" for host_name in notebook_host_names)
+    )
+    print(
+        "Step 2: Open VS Code, go to the Remote Explorer tab, "
+        "click the plus sign next to SSH, and enter the following:\n"
+        f"{host_names}{reset}\n"
+    )
+    for host_name in notebook_host_names:
+        for service, forward in forwards.get(host_name, {}).items():
+            print(
+                f"{service} on {host_name}: "
+                f"http://localhost:{forward['local_port']}"
+            )
+
+
+def forward(settings, registry, host, service, cancel=False):
+    """Adds or removes a forward to a notebook service while connected.
+
+    Parameters
+    ----------
+    host : str
+        The notebook's host name.
+    service : str
+        A service of the notebook in config.yaml, or a remote port.
+    cancel : bool
+        Whether to remove the forward instead.
+    """
+    services = {
+        notebook["host_name"]: notebook["services"]
+        for notebook in settings["notebooks"]
+    }
+    if host not in services:
+        print(f"Unknown notebook host {host}, use one of {list(services)}")
+        return
+    if service.isdigit():
+        remote_port = int(service)
+        service = f"port-{remote_port}"
+    elif service in services[host]:
+        remote_port = services[host][service]
+    else:
+        print(f"Unknown service {service}, use one of {list(services[host])}")
+        return
+
+    if cancel:
+        entry = registry.forwards(host).get(service)
+        if entry is None:
+            print(f"{service} is not forwarded from {host}")
+            return
+        registry.release(host, service)
+    else:
+        previous = registry.forwards(host).get(service)
+        entry = registry.add(host, service, remote_port)
+    try:
+        control_forward(
+            host, entry["local_port"], entry["remote_port"], cancel=cancel
+        )
+    except subprocess.CalledProcessError as e:
+        if not cancel and entry != previous:
+            # Don't keep a port reserved for a forward that wasn't set up
+            registry.release(host, service)
+        print(f"Error running ssh -O on {host}: {e.stderr.strip()}")
+        print(f"The forward needs a shared connection, run: ssh -fN {host}")
+        return
+    if cancel:
+        print(f"Stopped forwarding localhost:{entry['local_port']}")
+    else:
+        print(f"{service} on {host}: http://localhost:{entry['local_port']}")
+
+
+def tunnel_host_entries(settings, ssh_ports):
+    """Returns the Host blocks that connect through the tunnel daemon.
+
+    ``ssh_ports`` maps notebook host names to the local ports the daemon
+    relays to their SSH servers. The blocks are named after the notebook
+    hosts with a "-tunnel" suffix.
+    """
+    connection = connection_options(settings["profile"])
+    return {
+        f"{host}-tunnel": {
+            "Hostname": "127.0.0.1",
+            "Port": str(port),
+            "HostKeyAlias": host,
+            "User": "ec2-user",
+            "UserKnownHostsFile": "/dev/null",
+            "StrictHostKeyChecking": "no",
+            "IdentityFile": settings["key_filepath"],
+            "IdentitiesOnly": "yes",
+            "ForwardX11": "yes",
+            **connection,
+        }
+        for host, port in ssh_ports.items()
+    }
+
+
+def tunnel(settings, cache, registry):
+    """Runs the tunnel daemon until interrupted.
+
+    The daemon keeps one connection to the bastion, the fastest one if
+    there are several, and relays local ports to each notebook's SSH server
+    and forwarded services over it, see tunnel.py. The notebooks' addresses
+    come from the endpoint cache.
+    """
+    if settings["connection"] != "bastion":
+        print("The tunnel daemon needs the bastion, see ssh.connection")
+        return
+    entries = cached_endpoints(settings, cache)
+    if entries is None:
+        print('No valid cached endpoint, run "get" first')
+        return
+
+    bastions = {ip: host for host, ip in settings["bastions"].items()}
+    bastion = bastions[BastionPool().select(list(bastions))]
+    listeners = []
+    ssh_ports = {}
+    for notebook in settings["notebooks"]:
+        host = notebook["host_name"]
+        ip = entries[notebook["instance_name"]]["private_ip"]
+        ssh_ports[host] = registry.add(host, "ssh-tunnel", 22)["local_port"]
+        listeners.append(Listener(host, ssh_ports[host], ip, 22))
+        for service, entry in registry.forwards(host).items():
+            if service == "ssh-tunnel":
+                continue
+            if not port_is_free(entry["local_port"]):
+                # Most likely forwarded by an open ssh connection
+                print(f"Not relaying {service}: port in use")
+                continue
+            listeners.append(
+                Listener(
+                    f"{host} {service}",
+                    entry["local_port"],
+                    ip,
+                    entry["remote_port"],
+                )
+            )
+    socks_port = registry.add(bastion, "tunnel-socks", 0)["local_port"]
+    stats_port = registry.add(bastion, "tunnel-stats", 0)["local_port"]
+    write_hosts(settings, tunnel_host_entries(settings, ssh_ports))
+
+    transport = Transport(transport_command(bastion, socks_port), socks_port)
+    daemon = TunnelDaemon(transport, listeners, stats_port=stats_port)
+    for listener in listeners:
         print(
-            "Step 5: Open VS Code, go to the Remote Explorer tab, "
-            "click the plus sign next to SSH, and enter the following:\n"
-            f"{notebook_host_name}{reset}\n"
+            f"{listener.name}: localhost:{listener.local_port} -> "
+            f"{listener.host}:{listener.port}"
         )
+    for host in ssh_ports:
+        print(f"Connect with: ssh {host}-tunnel")
+    print(f"Stats: http://localhost:{stats_port}")
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(daemon.run())
+
+
+def sync_data(settings, source, destination=None, host=None, **kwargs):
+    """Copies the changed files of a local directory to a notebook.
+
+    Parameters
+    ----------
+    source : str
+        The local directory.
+    destination : str
+        The directory on the notebook. Defaults to one of the same name
+        under ~/SageMaker, which is on the notebook's EBS volume.
+    host : str
+        The notebook's host name. Defaults to the first notebook's.
+    **kwargs
+        Passed to data_sync.sync, e.g. streams and compress.
+    """
+    host = host or settings["notebooks"][0]["host_name"]
+    if destination is None:
+        name = os.path.basename(os.path.abspath(source))
+        destination = f"SageMaker/{name}"
+    print(f"Syncing {source} to {host}:{destination}")
+    try:
+        stats = data_sync.sync(source, host, destination, **kwargs)
+    except (subprocess.CalledProcessError, OSError) as e:
+        # OSError from reading the source or from the streams' pipes
+        print(f"Error syncing to {host}: {e}")
+        return None
+    print(
+        f"Sent {stats['sent']} files ({stats['bytes'] / 2**20:.1f} MiB) "
+        f"in {stats['seconds']:.1f}s over {stats['streams']} streams, "
+        f"skipped {stats['skipped']} unchanged files"
+    )
+    return stats
+
+
+def fetch_lifecycle_timings(host, event="start", ssh=("ssh",)):
+    """Returns the timings JSON of a notebook's last lifecycle run.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If the host is unreachable, or hasn't written the file yet.
+    """
+    output = subprocess.run(
+        [*ssh, host, f"cat {lifecycle_steps.timings_path(event)}"],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output)
 
-    except ClientError as e:
-        if e.response["Error"]["Code"] == "ParameterNotFound":
-            print(f"Parameter {key_parameter_name} not found.")
-        else:
-            print(f"Error retrieving parameter {key_parameter_name}: {e}")
 
-elif args.action == "remove":
+def lifecycle_timings(settings, event="start", host=None, ssh=("ssh",)):
+    """Prints how long each lifecycle step took on the notebooks.
+
+    Parameters
+    ----------
+    event : str
+        "start" or "create".
+    host : str
+        The notebook host to ask. Defaults to every notebook's.
+
+    Returns
+    -------
+    timings : dict
+        The timings of each host that answered.
+    """
+    hosts = [host] if host else [n["host_name"] for n in settings["notebooks"]]
+    results = {}
+    with ThreadPoolExecutor(max_workers=DESCRIBE_CONCURRENCY) as pool:
+        futures = {
+            host: pool.submit(fetch_lifecycle_timings, host, event, ssh)
+            for host in hosts
+        }
+        for host, future in futures.items():
+            try:
+                results[host] = future.result()
+            except (subprocess.CalledProcessError, json.JSONDecodeError) as e:
+                print(f"{host}: no {event} lifecycle timings ({e})")
+                continue
+            print(f"{host}: {lifecycle_steps.format_timings(results[host])}")
+    return results
+
+
+def remove(settings, cache, registry):
+    """Removes the key file and the hosts from the SSH config."""
+    key_filepath = settings["key_filepath"]
+    cache.delete(
+        *(notebook["instance_name"] for notebook in settings["notebooks"])
+    )
+    for notebook in settings["notebooks"]:
+        registry.release(notebook["host_name"])
+    if settings["key_storage"] == "agent":
+        # Remove the key from the agent, if it is still there
+        subprocess.run(["ssh-add", "-q", "-d", key_filepath], check=False)
     try:
         # Remove the key file
         os.remove(key_filepath)
         print(f"Removed key file: {key_filepath}")
-        # Remove the hosts from the SSH config
-        config.delete_host(bastion_host_name)
-        config.delete_host(notebook_host_name)
+        # Remove the hosts from the SSH config with a single write
+        ssh_config = SSHConfig(settings["ssh_config_file"])
+        with ssh_config.transaction() as txn:
+            for host in settings["bastions"]:
+                txn.delete_host(host)
+            for notebook in settings["notebooks"]:
+                txn.delete_host(notebook["host_name"])
+                txn.delete_host(f"{notebook['host_name']}-tunnel")
         print("Removed hosts from SSH config")
 
     except OSError as e:
         print(f"Error running remove: {e}")
-else:
-    print(f"Invalid action: {args.action}")
-    
\ No newline at end of file
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Retrieve or remove a parameter from SSM Parameter Store"
+    )
+    parser.add_argument(
+        "action",
+        choices=[
+            "get",
+            "refresh",
+            "resume",
+            "wait",
+            "forward",
+            "tunnel",
+            "sync",
+            "lifecycle",
+            "remove",
+        ],
+        help='Action to perform: "get" to retrieve the parameter, '
+        '"refresh" to update the notebook address after a restart, '
+        '"resume" to start the stopped notebooks and wait until they are '
+        'ready, "wait" to only wait, '
+        '"forward" to forward a notebook service while connected, '
+        '"tunnel" to run the tunnel daemon, '
+        '"sync" to copy a directory to the notebook, '
+        '"lifecycle" to show how long the lifecycle steps took '
+        'or "remove" to delete the key file',
+    )
+    parser.add_argument(
+        "target",
+        nargs="*",
+        metavar="ARG",
+        help='For "forward": the notebook host, and the service name in '
+        'config.yaml or the remote port. For "sync": the local directory, '
+        'and optionally the directory on the notebook. For "lifecycle": '
+        '"start" (the default) or "create"',
+    )
+    parser.add_argument(
+        "--cancel",
+        action="store_true",
+        help='With "forward", remove the forward instead',
+    )
+    parser.add_argument(
+        "--host",
+        help='With "sync" or "lifecycle", the notebook host',
+    )
+    parser.add_argument(
+        "--streams",
+        type=int,
+        default=4,
+        help='With "sync", the number of parallel transfer streams',
+    )
+    parser.add_argument(
+        "--compress",
+        type=int,
+        default=1,
+        choices=range(10),
+        metavar="LEVEL",
+        help='With "sync", the gzip level, 0 for no compression',
+    )
+    parser.add_argument(
+        "--checksum",
+        action="store_true",
+        help='With "sync", compare with the files on the notebook instead '
+        "of the local manifest",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=resume.DEFAULT_TIMEOUT,
+        metavar="SECONDS",
+        help='With "resume" or "wait", how long to wait in all',
+    )
+    parser.add_argument(
+        "--environment",
+        metavar="NAME",
+        help="The environment of config.yaml to act on, if it lists several",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print how long each phase of the action took",
+    )
+    args = parser.parse_args(argv)
+    arg_counts = {"forward": (2,), "sync": (1, 2), "lifecycle": (0, 1)}
+    if len(args.target) not in arg_counts.get(args.action, (0,)):
+        parser.error(f"Wrong number of arguments for {args.action}")
+    events = {"start", "create"}
+    if args.action == "lifecycle" and not set(args.target) <= events:
+        parser.error('The lifecycle event must be "start" or "create"')
+
+    # A single environment needs no --environment
+    environment_name = args.environment
+    targets = environments(load_config())
+    if not environment_name and len(targets) == 1:
+        (environment_name,) = targets
+    elif not environment_name and targets:
+        parser.error(
+            f"Pick an environment with --environment: {', '.join(targets)}"
+        )
+
+    timings = Timings()
+    try:
+        settings = load_settings(environment_name=environment_name)
+    except ConfigError as e:
+        parser.error(str(e))
+    cache = EndpointCache(settings["endpoint_cache_path"])
+    registry = ForwardRegistry()
+    clients = Clients(settings["region"], settings["aws_profile"])
+
+    try:
+        if args.action in ("resume", "wait"):
+            if not resume_notebooks(
+                settings,
+                clients,
+                timings,
+                cache,
+                start=args.action == "resume",
+                timeout=args.timeout,
+            ):
+                print("No valid cached endpoint, running get")
+                args.action = "get"
+
+        if args.action == "refresh":
+            if not refresh(settings, clients, timings, cache):
+                print("No valid cached endpoint, running get")
+                args.action = "get"
+
+        if args.action == "get":
+            with timings.phase("clients"):
+                # Create them up front, sessions are not thread-safe
+                for service in ("ssm", "sagemaker", "ec2"):
+                    clients[service]
+            results = get(settings, clients, timings, cache, registry)
+            reachable = [
+                notebook
+                for notebook in settings["notebooks"]
+                if notebook["instance_name"] in results["notebook_ips"]
+            ]
+            print_instructions(
+                dict(settings, notebooks=reachable),
+                results["ssh_config"],
+                results["public_key"],
+                results["forwards"],
+            )
+
+        elif args.action == "forward":
+            forward(settings, registry, *args.target, cancel=args.cancel)
+
+        elif args.action == "sync":
+            sync_data(
+                settings,
+                *args.target,
+                host=args.host,
+                streams=args.streams,
+                compress=args.compress,
+                checksum=args.checksum,
+            )
+
+        elif args.action == "tunnel":
+            tunnel(settings, cache, registry)
+
+        elif args.action == "lifecycle":
+            lifecycle_timings(settings, *args.target, host=args.host)
+
+        elif args.action == "remove":
+            remove(settings, cache, registry)
+
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ParameterNotFound":
+            print(f"Parameter {settings['key_parameter_name']} not found.")
+        else:
+            print(f"Error calling {e.operation_name}: {e}")
+    except (RuntimeError, TimeoutError) as e:
+        # From resume.wait_ready
+        print(f"Error running {args.action}: {e}")
+
+    if args.timings:
+        timings.print_report()
+
+
+if __name__ == "__main__":
+    main()
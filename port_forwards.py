@@ -0,0 +1,182 @@
+"""
+Local port forwards to the services running on the notebooks, such as
+TensorBoard, Jupyter or the Ray dashboard.
+
+Services are declared per notebook in config.yaml as name: remote port.
+Each one gets a local port, which is recorded in a small registry so that
+the same notebook service keeps the same local port across runs, and no
+two forwards try to bind the same port. A service's own port is used if it
+is free, otherwise a port derived from the host and service names.
+
+The allocated forwards go into the notebook's Host block as LocalForward
+options. Forwards can also be added or removed while connected, through
+the shared connection's control socket (``ssh -O forward``), without
+reconnecting.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import zlib
+
+from endpoint_cache import default_cache_path
+from ssh_utils import atomic_write
+
+# Local ports handed out when a service's own port is taken
+PORT_RANGE = (20000, 40000)
+
+
+def default_registry_path():
+    """Returns the registry path, next to the endpoint cache."""
+    return os.path.join(os.path.dirname(default_cache_path()), "forwards.json")
+
+
+def port_is_free(port):
+    """Returns whether a local TCP port can be bound."""
+    with socket.socket() as sock:
+        try:
+            sock.bind(("127.0.0.1", port))
+        except OSError:
+            return False
+    return True
+
+
+def candidate_ports(host, service, remote_port, port_range=PORT_RANGE):
+    """Yields the local ports to try for a service, in order.
+
+    The service's own port comes first, unless it is privileged, then
+    every port in ``port_range``, starting from one derived from the host
+    and service names.
+    """
+    if remote_port >= 1024:
+        yield remote_port
+    low, high = port_range
+    start = zlib.crc32(f"{host}/{service}".encode()) % (high - low)
+    for offset in range(high - low):
+        yield low + (start + offset) % (high - low)
+
+
+def local_forward(local_port, remote_port):
+    """Returns the LocalForward argument of a forward."""
+    return f"{local_port} localhost:{remote_port}"
+
+
+class ForwardRegistry:
+    """
+    A JSON file of the allocated forwards:
+    ``{host: {service: {"local_port": ..., "remote_port": ...}}}``.
+
+    Parameters
+    ----------
+    path : str
+        The path to the registry file. Defaults to
+        ``default_registry_path()``.
+    is_free : callable
+        Returns whether a local port is free, for tests.
+    """
+
+    def __init__(self, path=None, is_free=port_is_free):
+        self.path = path or default_registry_path()
+        self.is_free = is_free
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write(self, forwards):
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        data = json.dumps(forwards, indent=2, sort_keys=True).encode()
+        atomic_write(self.path, [data])
+
+    def forwards(self, host):
+        """Returns the forwards of ``host``, by service name."""
+        return self._read().get(host, {})
+
+    def _allocate(self, forwards, host, service, remote_port):
+        """Returns the forward of a service, allocating a port if needed."""
+        forward = forwards.setdefault(host, {}).get(service)
+        if forward is not None and forward["remote_port"] == remote_port:
+            # Keep the port, even if bound: it may be by this forward
+            return forward
+        taken = {
+            forward["local_port"]
+            for services in forwards.values()
+            for forward in services.values()
+        }
+        for port in candidate_ports(host, service, remote_port):
+            if port not in taken and self.is_free(port):
+                break
+        else:
+            raise RuntimeError(f"No free local port for {host} {service}")
+        forward = {"local_port": port, "remote_port": remote_port}
+        forwards[host][service] = forward
+        return forward
+
+    def allocate(self, services_by_host):
+        """Allocates the forwards of several hosts with a single write.
+
+        Parameters
+        ----------
+        services_by_host : dict
+            Maps host names to ``{service: remote port}``. Services of
+            these hosts that are no longer listed are released.
+
+        Returns
+        -------
+        forwards : dict
+            The forwards of each host, by service name.
+        """
+        forwards = self._read()
+        result = {}
+        for host, services in services_by_host.items():
+            for service in set(forwards.get(host, {})) - set(services):
+                del forwards[host][service]
+            result[host] = {
+                service: self._allocate(forwards, host, service, remote_port)
+                for service, remote_port in sorted(services.items())
+            }
+        self._write(forwards)
+        return result
+
+    def add(self, host, service, remote_port):
+        """Allocates the forward of one more service of ``host``."""
+        forwards = self._read()
+        forward = self._allocate(forwards, host, service, remote_port)
+        self._write(forwards)
+        return forward
+
+    def release(self, host, *services):
+        """Releases some services of ``host``, or all of them."""
+        forwards = self._read()
+        if host not in forwards:
+            return
+        for service in services or list(forwards[host]):
+            forwards[host].pop(service, None)
+        if not forwards[host]:
+            del forwards[host]
+        self._write(forwards)
+
+
+def control_forward(
+    host, local_port, remote_port, cancel=False, config_file=None
+):
+    """Adds or removes a forward on the shared connection to ``host``.
+
+    This uses ``ssh -O forward`` (or ``-O cancel``), so it needs an open
+    shared connection, i.e. a profile with ControlMaster.
+
+    Raises
+    ------
+    subprocess.CalledProcessError
+        If there is no shared connection to ``host``, or the local port
+        can't be bound.
+    """
+    command = ["ssh", "-O", "cancel" if cancel else "forward"]
+    if config_file:
+        command += ["-F", config_file]
+    command += ["-L", f"{local_port}:localhost:{remote_port}", host]
+    return subprocess.run(command, check=True, capture_output=True, text=True)
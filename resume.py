@@ -0,0 +1,181 @@
+"""
+Brings stopped notebooks and bastions back, and waits until they are
+ready to connect to.
+
+A notebook that is Pending or Stopped has no usable address yet, so
+"obtain_key.py resume" starts the stopped notebook instances and bastion
+instances, all at once, and polls them until they are InService and
+running. ``wait_ready`` polls every instance that isn't ready in each
+round: the notebooks with concurrent describe calls, as SageMaker has no
+batch describe, and the bastions with a single describe_instances call.
+The rounds are spaced with exponential backoff and jitter (see
+tunnel.backoff_delay), and the whole wait is bounded by a deadline.
+"""
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tunnel import backoff_delay
+
+# Concurrent describe and start calls to SageMaker
+CONCURRENCY = 8
+
+# How long to wait for everything to be ready, in seconds. Notebooks
+# usually take a few minutes to start.
+DEFAULT_TIMEOUT = 15 * 60
+
+# The delay between polls grows from MIN_DELAY to MAX_DELAY seconds
+MIN_DELAY = 2.0
+MAX_DELAY = 30.0
+
+NOTEBOOK_READY = "InService"
+NOTEBOOK_FAILED = {"Failed", "Deleting"}
+INSTANCE_READY = "running"
+INSTANCE_FAILED = {"shutting-down", "terminated"}
+
+
+def notebook_statuses(sagemaker, names, max_workers=CONCURRENCY):
+    """Returns the status of each notebook instance, by name."""
+    names = list(names)
+    if not names:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        statuses = pool.map(
+            lambda name: sagemaker.describe_notebook_instance(
+                NotebookInstanceName=name
+            )["NotebookInstanceStatus"],
+            names,
+        )
+        return dict(zip(names, statuses))
+
+
+def instance_states(ec2, instance_ids):
+    """Returns the state of each EC2 instance, by ID, with one call."""
+    instance_ids = list(instance_ids)
+    if not instance_ids:
+        return {}
+    reservations = ec2.describe_instances(InstanceIds=instance_ids)[
+        "Reservations"
+    ]
+    return {
+        instance["InstanceId"]: instance["State"]["Name"]
+        for reservation in reservations
+        for instance in reservation["Instances"]
+    }
+
+
+def start_notebooks(sagemaker, names, max_workers=CONCURRENCY):
+    """Starts the notebook instances concurrently."""
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(
+            pool.map(
+                lambda name: sagemaker.start_notebook_instance(
+                    NotebookInstanceName=name
+                ),
+                names,
+            )
+        )
+
+
+def wait_ready(
+    sagemaker,
+    ec2,
+    notebook_names,
+    instance_ids=(),
+    start=True,
+    timeout=DEFAULT_TIMEOUT,
+    clock=time.monotonic,
+    sleep=time.sleep,
+    rand=random.random,
+):
+    """Waits until the notebooks are InService and the instances running.
+
+    Parameters
+    ----------
+    sagemaker, ec2 : botocore.client.BaseClient
+        The clients to call.
+    notebook_names : list
+        The notebook instances to wait for.
+    instance_ids : list
+        The EC2 instances to wait for, the bastions.
+    start : bool
+        Whether to start the stopped notebooks and instances. Otherwise
+        a stopped one is an error.
+    timeout : float
+        How long to wait in all, in seconds.
+    clock, sleep, rand : callable
+        The monotonic clock, sleep and random functions, for tests.
+
+    Returns
+    -------
+    resumed : set
+        The names and IDs that weren't ready at first, whose addresses
+        may have changed.
+
+    Raises
+    ------
+    RuntimeError
+        If a notebook or instance failed, is being deleted, or is stopped
+        and ``start`` is false.
+    TimeoutError
+        If they aren't all ready by the deadline.
+    """
+    deadline = clock() + timeout
+    waiting_notebooks = set(notebook_names)
+    waiting_instances = set(instance_ids)
+    resumed = set()
+    attempt = 0
+    while True:
+        statuses = notebook_statuses(sagemaker, sorted(waiting_notebooks))
+        states = instance_states(ec2, sorted(waiting_instances))
+        errors = []
+        stopped_notebooks = []
+        stopped_instances = []
+        for name, status in statuses.items():
+            if status == NOTEBOOK_READY:
+                waiting_notebooks.discard(name)
+                if name in resumed:
+                    print(f"{name} is {status}")
+                continue
+            resumed.add(name)
+            if status == "Stopped" and start:
+                stopped_notebooks.append(name)
+            elif status in NOTEBOOK_FAILED or status == "Stopped":
+                errors.append(f"notebook {name} is {status}")
+        for instance_id, state in states.items():
+            if state == INSTANCE_READY:
+                waiting_instances.discard(instance_id)
+                if instance_id in resumed:
+                    print(f"{instance_id} is {state}")
+                continue
+            resumed.add(instance_id)
+            if state == "stopped" and start:
+                stopped_instances.append(instance_id)
+            elif state in INSTANCE_FAILED or state == "stopped":
+                errors.append(f"instance {instance_id} is {state}")
+        if errors:
+            raise RuntimeError("; ".join(errors))
+        if stopped_notebooks:
+            print(f"Starting {', '.join(stopped_notebooks)}")
+            start_notebooks(sagemaker, stopped_notebooks)
+        if stopped_instances:
+            print(f"Starting {', '.join(stopped_instances)}")
+            ec2.start_instances(InstanceIds=stopped_instances)
+        if not waiting_notebooks and not waiting_instances:
+            return resumed
+
+        remaining = deadline - clock()
+        if remaining <= 0:
+            waiting = {**statuses, **states}
+            raise TimeoutError(
+                f"Not ready after {timeout:.0f}s: "
+                + ", ".join(
+                    f"{name} ({waiting[name]})"
+                    for name in sorted(waiting_notebooks | waiting_instances)
+                )
+            )
+        sleep(
+            min(remaining, backoff_delay(attempt, MIN_DELAY, MAX_DELAY, rand))
+        )
+        attempt += 1
@@ -0,0 +1,137 @@
+"""
+Connection profiles for the generated SSH hosts.
+
+A profile is a small set of connection settings that obtain_key.py turns
+into options of the bastion and notebook Host blocks. Every profile
+reaches the notebook with ProxyJump, which needs no extra local ssh
+process, and shares connections with ControlMaster, so that VS Code
+windows, terminals and scp reuse an open two-hop connection instead of
+authenticating to both hosts again.
+
+Profiles are chosen with ``ssh.profile`` in config.yaml. The built-in
+profiles can be changed, and new ones added, under ``ssh.profiles``:
+
+.. code-block:: yaml
+
+    ssh:
+      profile: mine
+      profiles:
+        mine:
+          control_persist: 30m
+          keepalive: 15
+          compression: false
+          ciphers: aes128-gcm@openssh.com
+"""
+
+import os
+
+# The settings each profile can set
+PROFILE_KEYS = (
+    "control_persist",
+    "keepalive",
+    "compression",
+    "ciphers",
+    "ip_qos",
+)
+
+# The built-in profiles
+PROFILES = {
+    "default": {
+        "control_persist": "10m",
+        "keepalive": 60,
+        "compression": False,
+        "ciphers": None,
+        "ip_qos": None,
+    },
+    # Interactive use: keep connections open for longer, detect dead ones
+    # sooner and prefer the ciphers with the cheapest per-packet cost
+    "latency": {
+        "control_persist": "4h",
+        "keepalive": 15,
+        "compression": False,
+        "ciphers": "aes128-gcm@openssh.com,chacha20-poly1305@openssh.com",
+        "ip_qos": "lowdelay",
+    },
+    # Bulk transfers on fast links, where compression costs more CPU time
+    # than it saves in transfer time
+    "throughput": {
+        "control_persist": "10m",
+        "keepalive": 60,
+        "compression": False,
+        "ciphers": "aes128-gcm@openssh.com,aes256-gcm@openssh.com",
+        "ip_qos": "throughput",
+    },
+    # Bulk transfers on slow links
+    "slow-link": {
+        "control_persist": "10m",
+        "keepalive": 30,
+        "compression": True,
+        "ciphers": "aes128-gcm@openssh.com,chacha20-poly1305@openssh.com",
+        "ip_qos": "throughput",
+    },
+}
+
+# Where the shared connections' sockets go. %C is a hash of the local
+# host, remote host, port and user, which keeps the path short enough for
+# a Unix socket and unique per destination.
+CONTROL_DIR = os.path.join("~", ".ssh", "sockets")
+CONTROL_PATH = CONTROL_DIR + "/%C"
+
+
+def load_profile(name="default", profiles=None):
+    """Returns the settings of a profile.
+
+    Parameters
+    ----------
+    name : str
+        The name of the profile.
+    profiles : dict
+        Profiles from config.yaml, which override the built-in profiles
+        of the same name and add to them.
+
+    Returns
+    -------
+    profile : dict
+        The profile's settings, with the defaults filled in.
+    """
+    profiles = profiles or {}
+    if name not in profiles and name not in PROFILES:
+        available = sorted({*PROFILES, *profiles})
+        raise ValueError(
+            f"Unknown SSH profile {name!r}, use one of {available}"
+        )
+    profile = dict(PROFILES["default"])
+    profile.update(PROFILES.get(name, {}))
+    profile.update(profiles.get(name) or {})
+    unknown = set(profile) - set(PROFILE_KEYS)
+    if unknown:
+        raise ValueError(
+            f"Unknown settings in SSH profile {name!r}: {sorted(unknown)}"
+        )
+    return profile
+
+
+def connection_options(profile):
+    """Returns the SSH options of a profile, for both the bastion and the
+    notebook hosts.
+    """
+    options = {
+        "ControlMaster": "auto",
+        "ControlPath": CONTROL_PATH,
+        "ControlPersist": profile["control_persist"],
+        "ServerAliveInterval": str(profile["keepalive"]),
+        "ServerAliveCountMax": "3",
+        "Compression": "yes" if profile["compression"] else "no",
+        "Ciphers": profile["ciphers"],
+        "IPQoS": profile["ip_qos"],
+    }
+    if not profile["control_persist"]:
+        # Don't share connections
+        options.update(ControlMaster="no", ControlPath="none")
+        del options["ControlPersist"]
+    return {key: value for key, value in options.items() if value}
+
+
+def ensure_control_dir():
+    """Creates the directory of the control sockets, private to the user."""
+    os.makedirs(os.path.expanduser(CONTROL_DIR), mode=0o700, exist_ok=True)
@@ -0,0 +1,33 @@
+from aws_cdk import CfnOutput, Stack
+from constructs import Construct
+
+
+# Define the EC2 Instance Connect Endpoint stack, which replaces the
+# bastion when ssh.connection is "instance-connect"
+class InstanceConnectStack(Stack):
+    def __init__(
+        self,
+        scope: Construct,
+        id: str,
+        vpc,
+        security_group,
+        **kwargs,
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+        # Imported here, only when a stack is built
+        from aws_cdk import aws_ec2 as ec2
+
+        # Create the endpoint in the notebooks' subnet. SSH connections
+        # open a tunnel through it with the AWS CLI, so no instance and
+        # no public IP stand between VS Code and the notebooks.
+        private_subnets = vpc.select_subnets(subnet_group_name="Private")
+        endpoint = ec2.CfnInstanceConnectEndpoint(
+            self,
+            "MyInstanceConnectEndpoint",
+            subnet_id=private_subnets.subnet_ids[0],
+            security_group_ids=[security_group.security_group_id],
+            preserve_client_ip=False,
+        )
+
+        # Output the endpoint ID, for the hosts' ProxyCommand
+        CfnOutput(self, "EndpointID", value=endpoint.attr_id)
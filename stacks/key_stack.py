@@ -1,12 +1,7 @@
-import yaml
 from aws_cdk import Aws, CfnOutput, Stack
-from aws_cdk import aws_ec2 as ec2
 from constructs import Construct
 
-# Get configs
-with open("config.yaml") as file:
-    config = yaml.load(file, Loader=yaml.SafeLoader)
-key_name = config["ssh"]["key_name"]
+from app_config import export_name, load_config, physical_name
 
 # Get configs
 account_id = Aws.ACCOUNT_ID
@@ -14,28 +9,46 @@ region = Aws.REGION
 
 
 class KeyStack(Stack):
-    def __init__(self, scope: Construct, id: str, **kwargs) -> None:
+    def __init__(
+        self,
+        scope: Construct,
+        id: str,
+        config: dict = None,
+        namespace: str = None,
+        **kwargs,
+    ) -> None:
         super().__init__(scope, id, **kwargs)
+        # Imported here, only when a stack is built
+        from aws_cdk import aws_ec2 as ec2
+
+        config = config or load_config()
+        key_name = physical_name(config["ssh"]["key_name"], namespace)
+        key_type = config["ssh"].get("key_type", "rsa")
 
-        # Create a new key pair
+        # Create a new key pair. ed25519 keys are stored in SSM in the
+        # OpenSSH format, RSA keys in the PEM format.
         key_pair = ec2.CfnKeyPair(
-            self, "MyKeyPair", key_name=key_name, key_type="rsa"
+            self, "MyKeyPair", key_name=key_name, key_type=key_type
         )
 
+        # The notebooks read the private key from here, to authorize the
+        # key pair when they start
+        self.parameter_name = f"/ec2/keypair/{key_pair.attr_key_pair_id}"
+
         # Output the name of the key pair
         CfnOutput(
             self,
             "MyKeyPairName",
             value=key_pair.key_name,
-            export_name="keypair-name",
+            export_name=export_name("keypair-name", namespace),
         )
 
         # Output the key pair Parameter Store name
         CfnOutput(
             self,
             "MyKeyPairParameterName",
-            value=f"/ec2/keypair/{key_pair.attr_key_pair_id}",
-            export_name="keypair-parameter-name",
+            value=self.parameter_name,
+            export_name=export_name("keypair-parameter-name", namespace),
         )
 
         CfnOutput(self, "AccountID", value=account_id)
@@ -0,0 +1,70 @@
+from aws_cdk import CfnOutput, Fn, Stack
+from constructs import Construct
+
+from app_config import load_config, physical_name
+from lifecycle_steps import load_steps, render
+
+# The size limit of the persistent VS Code server and conda cache, in MB
+DEFAULT_TOOLCHAIN_CACHE_MB = 4096
+
+
+# Define the notebook lifecycle config stack
+class LifecycleStack(Stack):
+    def __init__(
+        self,
+        scope: Construct,
+        id: str,
+        key_parameter_name: str = None,
+        file_system_dns_name: str = None,
+        config: dict = None,
+        namespace: str = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+        # Imported here, only when a stack is built
+        from aws_cdk import aws_sagemaker as sagemaker
+
+        config = config or load_config()
+        lifecycle_name = physical_name(config["lifecycle"]["name"], namespace)
+
+        # Generate the lifecycle scripts from the configured steps
+        steps = load_steps(config)
+        environment = {
+            "CACHE_MAX_MB": config["lifecycle"].get(
+                "toolchain_cache_mb", DEFAULT_TOOLCHAIN_CACHE_MB
+            )
+        }
+        # The ssh-keys step authorizes the key pair in this parameter
+        if key_parameter_name:
+            environment["SSH_KEY_PARAMETER"] = key_parameter_name
+        # The efs-mount step mounts the shared datasets from this name
+        if file_system_dns_name:
+            environment["EFS_DNS_NAME"] = file_system_dns_name
+            mount_point = (config.get("efs") or {}).get("mount_point")
+            if mount_point:
+                environment["EFS_MOUNT_POINT"] = mount_point
+        oncreate_content = render(steps, "create", environment)
+        onstart_content = render(steps, "start", environment)
+
+        # Create a SageMaker lifecycle configuration resource
+        lifecycle_config = sagemaker.CfnNotebookInstanceLifecycleConfig(
+            self,
+            "MyLifecycleConfig",
+            notebook_instance_lifecycle_config_name=lifecycle_name,
+            on_create=[
+                sagemaker.CfnNotebookInstanceLifecycleConfig.NotebookInstanceLifecycleHookProperty(  # noqa: E501
+                    content=Fn.base64(oncreate_content)
+                )
+            ],
+            on_start=[
+                sagemaker.CfnNotebookInstanceLifecycleConfig.NotebookInstanceLifecycleHookProperty(  # noqa: E501
+                    content=Fn.base64(onstart_content)
+                )
+            ],
+        )
+        # Output the lifecycle config name
+        CfnOutput(
+            self,
+            "MIDIFLifecycleConfig",
+            value=lifecycle_config.notebook_instance_lifecycle_config_name,
+        )
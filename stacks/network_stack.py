@@ -0,0 +1,220 @@
+from aws_cdk import Aws, CfnOutput, RemovalPolicy, Size, Stack
+from constructs import Construct
+
+from app_config import export_name, load_config, physical_name
+
+# The interface endpoints of the endpoints mode, by construct ID: the
+# APIs the notebooks call, and ECR for image pulls
+INTERFACE_ENDPOINTS = [
+    ("EcrApi", "ECR"),
+    ("EcrDocker", "ECR_DOCKER"),
+    ("SageMakerApi", "SAGEMAKER_API"),
+    ("SageMakerRuntime", "SAGEMAKER_RUNTIME"),
+    ("Ssm", "SSM"),
+    ("Logs", "CLOUDWATCH_LOGS"),
+]
+
+
+# Define the network stack, shared by the bastion and the notebooks
+class NetworkStack(Stack):
+    def __init__(
+        self,
+        scope: Construct,
+        id: str,
+        config: dict = None,
+        namespace: str = None,
+        **kwargs,
+    ) -> None:
+        super().__init__(scope, id, **kwargs)
+        # Imported here, only when a stack is built
+        from aws_cdk import aws_ec2 as ec2
+
+        config = config or load_config()
+        network = config.get("network") or {}
+        nat_gateway = network.get("nat_gateway", True)
+
+        # Without a NAT gateway, the private subnets have no route out of
+        # the VPC
+        if nat_gateway:
+            private_subnet_type = ec2.SubnetType.PRIVATE_WITH_EGRESS
+            nat_gateways = None
+        else:
+            private_subnet_type = ec2.SubnetType.PRIVATE_ISOLATED
+            nat_gateways = 0
+
+        # Create a VPC with two subnets
+        self.vpc = vpc = ec2.Vpc(
+            self,
+            "MyVPC",
+            max_azs=2,
+            nat_gateways=nat_gateways,
+            subnet_configuration=[
+                ec2.SubnetConfiguration(
+                    name="Public",
+                    subnet_type=ec2.SubnetType.PUBLIC,
+                    cidr_mask=24,
+                ),
+                ec2.SubnetConfiguration(
+                    name="Private",
+                    subnet_type=private_subnet_type,
+                    cidr_mask=24,
+                ),
+            ],
+        )
+
+        # Create the security groups
+        self.bastion_security_group = sg1 = ec2.SecurityGroup(
+            self,
+            "SG1",
+            vpc=vpc,
+            allow_all_outbound=False,
+            security_group_name=physical_name("sg1", namespace),
+        )
+
+        sg2 = ec2.SecurityGroup(
+            self,
+            "SG2",
+            vpc=vpc,
+            allow_all_outbound=True,
+            security_group_name=physical_name("sg2", namespace),
+        )
+
+        # Add the rules to the security groups
+        # Without a bastion, SG1 belongs to the EC2 Instance Connect
+        # Endpoint, which needs no ingress
+        if config["ssh"].get("connection", "bastion") == "bastion":
+            sg1.add_ingress_rule(
+                peer=ec2.Peer.any_ipv4(),
+                connection=ec2.Port.tcp(22),
+                description="SSH access from anywhere",
+            )
+        sg1.add_egress_rule(
+            peer=ec2.Peer.ipv4(vpc.vpc_cidr_block),
+            connection=ec2.Port.tcp(22),
+            description="SSH access to subnet 2",
+        )
+
+        sg2.add_ingress_rule(
+            peer=sg1,
+            connection=ec2.Port.tcp(22),
+            description="SSH access from subnet 1",
+        )
+
+        # Keep the notebooks' AWS traffic off the NAT gateway
+        if network.get("vpc_endpoints"):
+            self.add_endpoints(vpc, sg2)
+
+        # The notebooks mount the shared datasets, see
+        # lifecycle/efs-mount.sh
+        self.file_system_dns_name = None
+        if config.get("efs") is not None:
+            self.add_file_system(vpc, sg2, config["efs"])
+
+        # Export the resources. The notebooks' subnet is isolated without
+        # a NAT gateway.
+        private_subnet_ids = vpc.select_subnets(
+            subnet_group_name="Private"
+        ).subnet_ids
+        CfnOutput(
+            self,
+            "SageMakerVPC",
+            value=vpc.vpc_id,
+            export_name=export_name("MyVPC-VPCID", namespace),
+        )
+
+        CfnOutput(
+            self,
+            "SageMakerSubnet",
+            value=private_subnet_ids[0],
+            export_name=export_name("MyVPC-PrivateSubnet2", namespace),
+        )
+
+        CfnOutput(
+            self,
+            "SageMakerSecurityGroup",
+            value=sg2.security_group_id,
+            export_name=export_name("MyVPC-SecurityGroup2", namespace),
+        )
+
+    def add_endpoints(self, vpc, notebook_security_group):
+        """Adds the S3 gateway endpoint and the interface endpoints of the
+        private subnets, which only the notebooks may connect to."""
+        from aws_cdk import aws_ec2 as ec2
+
+        private_subnets = ec2.SubnetSelection(subnet_group_name="Private")
+
+        # S3 traffic goes through the route tables, at no charge
+        vpc.add_gateway_endpoint(
+            "S3Endpoint",
+            service=ec2.GatewayVpcEndpointAwsService.S3,
+            subnets=[private_subnets],
+        )
+
+        endpoint_security_group = ec2.SecurityGroup(
+            self,
+            "EndpointSG",
+            vpc=vpc,
+            allow_all_outbound=False,
+            description="HTTPS from the notebooks to the VPC endpoints",
+        )
+        endpoint_security_group.add_ingress_rule(
+            peer=notebook_security_group,
+            connection=ec2.Port.tcp(443),
+            description="HTTPS from the notebooks",
+        )
+        for construct_id, service in INTERFACE_ENDPOINTS:
+            vpc.add_interface_endpoint(
+                f"{construct_id}Endpoint",
+                service=getattr(ec2.InterfaceVpcEndpointAwsService, service),
+                subnets=private_subnets,
+                security_groups=[endpoint_security_group],
+                # Only from the notebooks, not the whole VPC
+                open=False,
+            )
+
+    def add_file_system(self, vpc, notebook_security_group, settings):
+        """Adds the EFS file system of the shared datasets, with a mount
+        target in each private subnet, which only the notebooks may
+        connect to."""
+        from aws_cdk import aws_ec2 as ec2
+        from aws_cdk import aws_efs as efs
+
+        file_system_security_group = ec2.SecurityGroup(
+            self,
+            "EfsSG",
+            vpc=vpc,
+            allow_all_outbound=False,
+            description="NFS from the notebooks to the dataset file system",
+        )
+        file_system_security_group.add_ingress_rule(
+            peer=notebook_security_group,
+            connection=ec2.Port.tcp(2049),
+            description="NFS from the notebooks",
+        )
+
+        throughput_mode = settings.get("throughput_mode", "elastic")
+        provisioned = None
+        if throughput_mode == "provisioned":
+            provisioned = Size.mebibytes(settings["provisioned_mibps"])
+        file_system = efs.FileSystem(
+            self,
+            "Datasets",
+            vpc=vpc,
+            vpc_subnets=ec2.SubnetSelection(subnet_group_name="Private"),
+            security_group=file_system_security_group,
+            throughput_mode=getattr(
+                efs.ThroughputMode, throughput_mode.upper()
+            ),
+            provisioned_throughput_per_second=provisioned,
+            performance_mode=efs.PerformanceMode.GENERAL_PURPOSE,
+            encrypted=True,
+            # The notebooks mount it over plain NFS, without IAM
+            # authorization: only their security group can reach it
+            allow_anonymous_access=True,
+            # The datasets outlive the stacks
+            removal_policy=RemovalPolicy.RETAIN,
+        )
+        self.file_system_dns_name = (
+            f"{file_system.file_system_id}.efs.{Aws.REGION}.{Aws.URL_SUFFIX}"
+        )
+        CfnOutput(self, "FileSystemID", value=file_system.file_system_id)
@@ -1,37 +1,50 @@
 import getpass
 
-import yaml
 from aws_cdk import Aws, CfnOutput, Fn, Stack
-from aws_cdk import aws_iam as iam
-from aws_cdk import aws_sagemaker as sagemaker
 from constructs import Construct
 
+from app_config import export_name, load_config, physical_name
+
 # Get configs
 account_id = Aws.ACCOUNT_ID
 region = Aws.REGION
 
-with open("config.yaml") as file:
-    config = yaml.load(file, Loader=yaml.SafeLoader)
-notebook_name = config["notebook"]["name"]
-append_username = config["notebook"]["append_username"]
-instance_type = config["notebook"]["instance_type"]
-volume_size = config["notebook"]["volume_size"]
-lifecycle_name = config["lifecycle"]["name"]
-
-if append_username:
-    username = getpass.getuser()
-    notebook_name = f"{notebook_name}-{username}"
-
 
 # Define SageMaker notebook stack
 class SageMakerStack(Stack):
-    def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
+    def __init__(
+        self,
+        scope: Construct,
+        construct_id: str,
+        notebook: dict,
+        key_parameter_name: str = None,
+        config: dict = None,
+        namespace: str = None,
+        **kwargs,
+    ) -> None:
         super().__init__(scope, construct_id, **kwargs)
+        # Imported here, only when a stack is built
+        from aws_cdk import aws_iam as iam
+        from aws_cdk import aws_sagemaker as sagemaker
+
+        config = config or load_config()
+        lifecycle_name = physical_name(config["lifecycle"]["name"], namespace)
+
+        # Get the notebook settings, see app_config.notebooks
+        notebook_name = notebook["name"]
+        if notebook["append_username"]:
+            username = getpass.getuser()
+            notebook_name = f"{notebook_name}-{username}"
+        notebook_name = physical_name(notebook_name, namespace)
 
         # Get VPC, subnet, and security group IDs from the Bastion stack
-        Fn.import_value("MyVPC-VPCID")
-        subnet_id = Fn.import_value("MyVPC-PrivateSubnet2")
-        security_group_id = Fn.import_value("MyVPC-SecurityGroup2")
+        Fn.import_value(export_name("MyVPC-VPCID", namespace))
+        subnet_id = Fn.import_value(
+            export_name("MyVPC-PrivateSubnet2", namespace)
+        )
+        security_group_id = Fn.import_value(
+            export_name("MyVPC-SecurityGroup2", namespace)
+        )
 
         # Create role with the required policies and trust relationships
         role = iam.Role(
@@ -64,20 +77,42 @@ class SageMakerStack(Stack):
                 ),
             ],
         )
+        # Let the lifecycle script read the key pair, to authorize it. The
+        # SSM read-only policy allows it too, but provisioning shouldn't
+        # depend on that broad a policy.
+        if key_parameter_name:
+            role.add_to_policy(
+                iam.PolicyStatement(
+                    actions=["ssm:GetParameter"],
+                    resources=[
+                        f"arn:{Aws.PARTITION}:ssm:{region}:{account_id}:"
+                        f"parameter{key_parameter_name}"
+                    ],
+                )
+            )
+
         # Print the RoleARN
         CfnOutput(self, "RoleARN", value=role.role_arn)
 
+        # Without direct internet access, all of the notebook's traffic
+        # goes through the VPC, see NetworkStack. Only set when disabled,
+        # as changing it replaces the notebook.
+        direct_internet_access = None
+        if notebook.get("direct_internet_access") is False:
+            direct_internet_access = "Disabled"
+
         # Create a SageMaker notebook instance
         notebook = sagemaker.CfnNotebookInstance(
             self,
             "SageMakerNotebook",
             notebook_instance_name=notebook_name,
-            instance_type=instance_type,
-            volume_size_in_gb=volume_size,
+            instance_type=notebook["instance_type"],
+            volume_size_in_gb=notebook["volume_size"],
             role_arn=role.role_arn,
             subnet_id=subnet_id,
             security_group_ids=[security_group_id],
             lifecycle_config_name=lifecycle_name,
+            direct_internet_access=direct_internet_access,
         )
 
         # Output SageMaker notebook instance name
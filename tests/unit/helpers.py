@@ -0,0 +1,38 @@
+import time
+
+import boto3
+from botocore.stub import Stubber
+
+
+class FakeClock:
+    """A clock that only moves when a test moves it or when it sleeps."""
+
+    def __init__(self, now=0.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_stubbed_client(service, latency=0):
+    """A boto3 client answering with the canned responses of the returned
+    Stubber, each ``latency`` seconds late."""
+    client = boto3.client(
+        service,
+        region_name="us-east-1",
+        aws_access_key_id="testing",
+        aws_secret_access_key="testing",
+    )
+    if latency:
+        # Registered before the stubber so it runs before the canned response
+        client.meta.events.register(
+            "before-parameter-build.*.*", lambda **kwargs: time.sleep(latency)
+        )
+    stubber = Stubber(client)
+    stubber.activate()
+    return client, stubber
@@ -0,0 +1,160 @@
+import os
+
+import pytest
+import yaml
+
+import app_config
+from app_config import CONFIG_PATH, ConfigError, load_config, notebooks
+
+
+def write_config(path, **changes):
+    with open(CONFIG_PATH) as f:
+        config = yaml.safe_load(f)
+    for dotted, value in changes.items():
+        section, key = dotted.split("__")
+        config.setdefault(section, {})[key] = value
+    path.write_text(yaml.safe_dump(config))
+    return str(path)
+
+
+def test_config_is_found_from_any_directory(monkeypatch):
+    monkeypatch.chdir("/")
+    assert load_config()["ssh"]["config_suffix"]
+
+
+def test_config_is_parsed_once_until_it_changes(tmp_path, monkeypatch):
+    path = write_config(tmp_path / "config.yaml")
+    loads = []
+    load = yaml.load
+
+    def counting_load(stream, *args, **kwargs):
+        loads.append(getattr(stream, "name", None))
+        return load(stream, *args, **kwargs)
+
+    monkeypatch.setattr(yaml, "load", counting_load)
+    config = load_config(path)
+    assert load_config(path) is config
+    assert loads.count(path) == 1
+
+    write_config(tmp_path / "config.yaml", ec2__instance_type="t3.nano")
+    os.utime(path, ns=(0, 0))
+    assert load_config(path)["ec2"]["instance_type"] == "t3.nano"
+    assert loads.count(path) == 2
+
+
+def test_all_problems_are_reported_with_their_keys(tmp_path):
+    path = write_config(
+        tmp_path / "config.yaml",
+        ssh__key_tpye="ed25519",
+        notebook__volume_size="30",
+        ssh__key_type="dsa",
+    )
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    del config["lifecycle"]["name"]
+    (tmp_path / "config.yaml").write_text(yaml.safe_dump(config))
+
+    with pytest.raises(ConfigError) as error:
+        load_config(path)
+    message = str(error.value)
+    assert "unknown key ssh.key_tpye, did you mean key_type?" in message
+    assert "notebook.volume_size must be an integer, got '30'" in message
+    assert "ssh.key_type must be one of rsa, ed25519" in message
+    assert "missing key lifecycle.name" in message
+    assert path not in app_config._CACHE
+
+
+def test_ssh_profiles_are_checked(tmp_path):
+    path = write_config(
+        tmp_path / "config.yaml",
+        ssh__profile="latnecy",
+        ssh__profiles={"mine": {"keepalive": 5, "ciphres": "aes128-ctr"}},
+    )
+    with pytest.raises(ConfigError) as error:
+        load_config(path)
+    message = str(error.value)
+    assert "ssh.profile 'latnecy' is not one of" in message
+    assert "did you mean latency?" in message
+    assert (
+        "unknown key ssh.profiles.mine.ciphres, did you mean ciphers?"
+        in message
+    )
+
+    path = write_config(
+        tmp_path / "config.yaml",
+        ssh__profile="mine",
+        ssh__profiles={"mine": {"keepalive": 5}},
+    )
+    assert load_config(path)["ssh"]["profile"] == "mine"
+
+
+def test_notebook_entries_may_override_any_key(tmp_path):
+    path = tmp_path / "config.yaml"
+    write_config(path)
+    config = yaml.safe_load(path.read_text())
+    config["notebooks"] = [{"name": "a"}, {"name": "b", "volume_size": 100}]
+    path.write_text(yaml.safe_dump(config))
+
+    config = load_config(str(path))
+    assert [n["volume_size"] for n in notebooks(config)] == [
+        config["notebook"]["volume_size"],
+        100,
+    ]
+
+    config["notebooks"] = [{"volume_size": True}]
+    with pytest.raises(ConfigError, match=r"notebooks\[0\].volume_size"):
+        app_config.validate(config)
+
+
+def test_notebooks_need_a_route_to_aws(tmp_path):
+    path = write_config(
+        tmp_path / "config.yaml",
+        network__nat_gateway=False,
+        notebook__direct_internet_access=False,
+    )
+    with pytest.raises(ConfigError, match="has no direct internet access"):
+        load_config(path)
+
+    path = write_config(
+        tmp_path / "endpoints.yaml",
+        network__nat_gateway=False,
+        network__vpc_endpoints=True,
+        notebook__direct_internet_access=False,
+    )
+    assert load_config(path)["network"]["vpc_endpoints"] is True
+
+
+def test_provisioned_efs_needs_its_throughput(tmp_path):
+    path = write_config(
+        tmp_path / "config.yaml", efs__throughput_mode="provisioned"
+    )
+    with pytest.raises(ConfigError, match="efs.provisioned_mibps"):
+        load_config(path)
+
+
+def test_environment_names_are_checked(tmp_path):
+    path = tmp_path / "config.yaml"
+    write_config(path)
+    config = yaml.safe_load(path.read_text())
+    config["environments"] = [
+        {"name": "dev", "region": "us-east-1"},
+        {"name": "prod", "region": "eu-west-1", "profile": "prod"},
+    ]
+    path.write_text(yaml.safe_dump(config))
+    config = load_config(str(path))
+    assert app_config.environment(config, "prod")["profile"] == "prod"
+    with pytest.raises(ConfigError, match="lists: dev, prod"):
+        app_config.environment(config, "test")
+
+    config = dict(
+        config,
+        environments=[
+            {"name": "dev", "region": "us-east-1"},
+            {"name": "dev", "region": "us-west-2"},
+            {"name": "eu_prod", "region": "eu-west-1"},
+        ],
+    )
+    with pytest.raises(ConfigError) as error:
+        app_config.validate(config)
+    assert "environment dev is listed twice" in str(error.value)
+    assert "'eu_prod' must start with a letter" in str(error.value)
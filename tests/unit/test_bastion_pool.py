@@ -0,0 +1,130 @@
+import shlex
+import socket
+import sys
+import threading
+import time
+
+import pytest
+
+import bastion_pool
+from bastion_pool import BastionPool, probe, proxy_command
+from tests.unit.helpers import FakeClock
+
+# Loopback addresses, so that every stand-in bastion listens on one port
+ADDRESSES = ["127.0.0.2", "127.0.0.3", "127.0.0.4"]
+
+
+class Bastion:
+    """A stand-in bastion that sends ``banner`` after ``delay`` seconds."""
+
+    def __init__(self, address, port, delay=0.0, banner=b"SSH-2.0-test\r\n"):
+        self.delay = delay
+        self.banner = banner
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((address, port))
+        self.sock.listen()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                connection, _ = self.sock.accept()
+            except OSError:
+                return
+            time.sleep(self.delay)
+            with connection:
+                connection.sendall(self.banner)
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def port():
+    with socket.socket() as sock:
+        sock.bind((ADDRESSES[0], 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def bastions():
+    bastions = []
+    yield bastions
+    for bastion in bastions:
+        bastion.close()
+
+
+def test_fastest_healthy_bastion_is_selected(tmp_path, port, bastions):
+    bastions.append(Bastion(ADDRESSES[0], port, delay=0.3))
+    bastions.append(Bastion(ADDRESSES[1], port, delay=0.05))
+    # Accepts connections but isn't an SSH server
+    bastions.append(Bastion(ADDRESSES[2], port, banner=b"HTTP/1.1"))
+    pool = BastionPool(str(tmp_path / "cache.json"))
+    rtts = pool.rtts(ADDRESSES, port)
+    assert 0.05 <= rtts[ADDRESSES[1]] < rtts[ADDRESSES[0]]
+    assert rtts[ADDRESSES[2]] is None
+    assert pool.select(ADDRESSES, port) == ADDRESSES[1]
+
+
+def test_probes_time_out_and_unreachable_bastions_fail(port, bastions):
+    bastions.append(Bastion(ADDRESSES[0], port, delay=0.5))
+    assert probe(ADDRESSES[0], port, timeout=0.1) is None
+    # Nothing listens on the second address
+    assert probe(ADDRESSES[1], port) is None
+
+
+def test_probes_are_cached_for_the_ttl(tmp_path, port):
+    probes = []
+
+    def fake_probe(address, port, timeout):
+        probes.append(address)
+        return {ADDRESSES[0]: 0.2, ADDRESSES[1]: 0.1}[address]
+
+    clock = FakeClock(now=1000.0)
+    path = str(tmp_path / "cache.json")
+    addresses = ADDRESSES[:2]
+    pool = BastionPool(path, ttl=30, clock=clock, probe=fake_probe)
+    assert pool.select(addresses, port) == ADDRESSES[1]
+    # The cache is shared between processes, through the file
+    clock.now += 29
+    other = BastionPool(path, ttl=30, clock=clock, probe=fake_probe)
+    assert other.select(addresses[::-1], port) == ADDRESSES[1]
+    assert len(probes) == 2
+
+    clock.now += 1
+    assert pool.select(addresses, port) == ADDRESSES[1]
+    assert len(probes) == 4
+
+
+def test_first_bastion_is_returned_when_none_is_healthy(tmp_path, port):
+    pool = BastionPool(str(tmp_path / "cache.json"), probe=lambda *args: None)
+    assert pool.select(ADDRESSES, port) == ADDRESSES[0]
+
+
+def test_proxy_command_lists_the_bastions():
+    command = proxy_command({"bastion-1": "1.2.3.4", "bastion-2": "5.6.7.8"})
+    args = shlex.split(command)
+    assert args[0] == sys.executable
+    assert args[1].endswith("bastion_pool.py")
+    assert args[2:] == [
+        "proxy",
+        "%h",
+        "%p",
+        "bastion-1=1.2.3.4",
+        "bastion-2=5.6.7.8",
+    ]
+
+
+def test_proxy_connects_through_the_selected_bastion(monkeypatch):
+    calls = []
+
+    def select(self, addresses):
+        return addresses[1]
+
+    monkeypatch.setattr(bastion_pool.BastionPool, "select", select)
+    monkeypatch.setattr(bastion_pool.os, "execvp", lambda *a: calls.append(a))
+    bastion_pool.main(
+        ["proxy", "10.0.1.5", "22", "bastion-1=1.2.3.4", "bastion-2=5.6.7.8"]
+    )
+    assert calls == [("ssh", ["ssh", "-W", "10.0.1.5:22", "bastion-2"])]
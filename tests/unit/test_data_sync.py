@@ -0,0 +1,172 @@
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+import data_sync
+from data_sync import Manifest, split_streams
+
+BENCHMARKS = os.path.join(os.path.dirname(__file__), "../../benchmarks")
+sys.path.insert(0, BENCHMARKS)
+import bench_handshake  # noqa: E402
+
+# Stands in for ssh: runs the remote command in $FAKE_HOME, and logs it
+FAKE_SSH = """#!/bin/sh
+for command; do :; done
+echo "$command" >> "$FAKE_HOME/.commands"
+cd "$FAKE_HOME" && exec sh -c "$command"
+"""
+
+
+@pytest.fixture
+def fake_ssh(tmp_path, monkeypatch):
+    home = tmp_path / "home"
+    home.mkdir()
+    script = tmp_path / "fake-ssh"
+    script.write_text(FAKE_SSH)
+    script.chmod(0o755)
+    monkeypatch.setenv("FAKE_HOME", str(home))
+    return (str(script),), home
+
+
+def make_tree(root, files):
+    for name, data in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+
+def run_sync(root, ssh, manifest, **kwargs):
+    return data_sync.sync(
+        str(root),
+        "notebook",
+        "SageMaker/data",
+        manifest=manifest,
+        ssh=ssh,
+        progress_stream=io.StringIO(),
+        **kwargs,
+    )
+
+
+def test_split_streams_balances_sizes():
+    sizes = {"a": 10, "b": 7, "c": 5, "d": 3, "e": 1}
+    groups = split_streams(list(sizes), sizes, 2)
+    assert sorted(sum(sizes[n] for n in group) for group in groups) == [13, 13]
+    assert split_streams(["a"], sizes, 4) == [["a"]]
+    assert split_streams([], sizes, 4) == []
+
+
+@pytest.mark.parametrize("compress", [0, 1])
+def test_only_changed_files_are_sent(tmp_path, fake_ssh, compress):
+    ssh, home = fake_ssh
+    root = tmp_path / "data"
+    files = {f"dir{i % 3}/file{i}": os.urandom(1000 * i) for i in range(20)}
+    make_tree(root, files)
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+
+    stats = run_sync(root, ssh, manifest, streams=4, compress=compress)
+    assert (stats["sent"], stats["skipped"], stats["streams"]) == (20, 0, 4)
+    for name, data in files.items():
+        assert (home / "SageMaker/data" / name).read_bytes() == data
+
+    # Change one file, touch another without changing it
+    (root / "dir1/file1").write_bytes(b"changed")
+    os.utime(root / "dir2/file2", ns=(0, 0))
+    manifest = Manifest(manifest.path)
+    stats = run_sync(root, ssh, manifest, compress=compress)
+    assert (stats["sent"], stats["skipped"]) == (1, 19)
+    assert (home / "SageMaker/data/dir1/file1").read_bytes() == b"changed"
+
+
+def test_unchanged_files_are_not_hashed_again(tmp_path, fake_ssh, monkeypatch):
+    ssh, _ = fake_ssh
+    root = tmp_path / "data"
+    make_tree(root, {"a": b"a", "b": b"b"})
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    run_sync(root, ssh, manifest)
+
+    hashed = []
+    sha256 = data_sync.file_sha256
+    monkeypatch.setattr(
+        data_sync,
+        "file_sha256",
+        lambda path: hashed.append(path) or sha256(path),
+    )
+    (root / "b").write_bytes(b"bb")
+    run_sync(root, ssh, Manifest(manifest.path))
+    assert hashed == [str(root / "b")]
+
+
+def test_checksum_compares_with_the_notebook(tmp_path, fake_ssh):
+    ssh, home = fake_ssh
+    root = tmp_path / "data"
+    make_tree(root, {"a": b"a", "b": b"b"})
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    run_sync(root, ssh, manifest)
+
+    (home / "SageMaker/data/a").write_bytes(b"changed on the notebook")
+    assert run_sync(root, ssh, Manifest(manifest.path))["sent"] == 0
+    stats = run_sync(root, ssh, Manifest(manifest.path), checksum=True)
+    assert stats["sent"] == 1
+    assert (home / "SageMaker/data/a").read_bytes() == b"a"
+
+
+def test_failed_streams_are_sent_again(tmp_path, fake_ssh):
+    ssh, home = fake_ssh
+    root = tmp_path / "data"
+    make_tree(root, {"a": b"a"})
+    # The destination can't be created
+    (home / "SageMaker").write_text("not a directory")
+    manifest = Manifest(str(tmp_path / "manifest.json"))
+    with pytest.raises(subprocess.CalledProcessError):
+        run_sync(root, ssh, manifest)
+    assert manifest.remote == {}
+
+
+@pytest.mark.skipif(
+    bench_handshake.find_sshd() is None, reason="needs the OpenSSH server"
+)
+def test_sync_through_sshd_stand_ins(tmp_path):
+    directory = tempfile.mkdtemp(dir="/tmp")
+    config_file = f"{directory}/config"
+    processes = []
+    try:
+        bench_handshake.keygen(f"{directory}/host_key", "ed25519")
+        bench_handshake.keygen(f"{directory}/id_ed25519", "ed25519")
+        shutil.copy(
+            f"{directory}/id_ed25519.pub", f"{directory}/authorized_keys"
+        )
+        ports = {}
+        for name in ("bastion", "notebook"):
+            process, ports[name] = bench_handshake.start_sshd(
+                bench_handshake.find_sshd(), directory, name
+            )
+            processes.append(process)
+        bench_handshake.write_config(
+            config_file, directory, "default", ports, "ed25519"
+        )
+        root = tmp_path / "data"
+        files = {f"file{i}": os.urandom(100_000) for i in range(8)}
+        make_tree(root, files)
+        destination = str(tmp_path / "remote")
+        stats = data_sync.sync(
+            str(root),
+            "notebook",
+            destination,
+            manifest=Manifest(str(tmp_path / "manifest.json")),
+            ssh=("ssh", "-F", config_file),
+            progress_stream=io.StringIO(),
+        )
+        assert stats["sent"] == 8
+        for name, data in files.items():
+            assert (tmp_path / "remote" / name).read_bytes() == data
+    finally:
+        bench_handshake.close_connections(config_file)
+        for process in processes:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(directory)
@@ -0,0 +1,396 @@
+import datetime
+import io
+import json
+import os
+import subprocess
+import threading
+import time
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+import deploy
+from app_config import ENVIRONMENT_VARIABLE
+
+
+class FakeCdk:
+    """Stands in for the cdk CLI: synth writes a cloud assembly with a
+    template per stack, deploy writes the stack's outputs."""
+
+    def __init__(self, templates):
+        self.templates = templates
+        self.commands = []
+        self.environments = []
+
+    def __call__(self, command, check, cwd, env=None):
+        self.commands.append(command)
+        self.environments.append(env)
+        # The stacks of an environment are named after it, as in app.py
+        namespace = (env or {}).get(ENVIRONMENT_VARIABLE)
+
+        def stack_name(name):
+            return f"{namespace}-{name}" if namespace else name
+
+        if command[1] == "synth":
+            out_dir = command[command.index("--output") + 1]
+            os.makedirs(out_dir, exist_ok=True)
+            artifacts = {}
+            previous = None
+            for name, template in self.templates.items():
+                path = os.path.join(out_dir, f"{name}.template.json")
+                with open(path, "w") as f:
+                    json.dump(template, f)
+                artifacts[name] = {
+                    "type": "aws:cloudformation:stack",
+                    "environment": "aws://123456789012/us-east-1",
+                    "properties": {
+                        "templateFile": f"{name}.template.json",
+                        "stackName": stack_name(name),
+                    },
+                    "dependencies": [previous] if previous else [],
+                }
+                previous = name
+            artifacts["Tree"] = {"type": "cdk:tree"}
+            with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+                json.dump({"artifacts": artifacts}, f)
+        else:
+            path = command[command.index("--outputs-file") + 1]
+            end = command.index("--app")
+            names = command[2:end]
+            with open(path, "w") as f:
+                json.dump(
+                    {stack_name(name): {"Name": name} for name in names}, f
+                )
+
+    def deployed(self):
+        names = []
+        for command in self.commands:
+            if command[1] == "deploy":
+                end = command.index("--app")
+                names += command[2:end]
+        return names
+
+
+@pytest.fixture
+def cdk(monkeypatch):
+    monkeypatch.setattr(deploy, "input_digest", lambda: "inputs-1")
+    return FakeCdk(
+        {
+            "KeyStack": {"Resources": {"Key": 1}},
+            "BastionStack": {"Resources": {"Bastion": 1}},
+            "SageMakerStack": {"Resources": {"Notebook": 1}},
+        }
+    )
+
+
+def unstubbed_client(region, profile=None):
+    """A CloudFormation client with no responses: reading the events
+    fails, as it does without credentials."""
+    client = boto3.client("cloudformation", region_name=region)
+    Stubber(client).activate()
+    return client
+
+
+def run(tmp_path, cdk, **kwargs):
+    kwargs.setdefault("clients", unstubbed_client)
+    return deploy.deploy(
+        out_dir=str(tmp_path / "cdk.out"),
+        outputs_path=str(tmp_path / "outputs.json"),
+        run=cdk,
+        **kwargs,
+    )
+
+
+def actions(report):
+    return {row["name"]: row["action"] for row in report}
+
+
+def test_first_deploy_deploys_every_stack_at_once(tmp_path, cdk):
+    report = run(tmp_path, cdk, concurrency=3)
+    assert cdk.deployed() == ["KeyStack", "BastionStack", "SageMakerStack"]
+    assert len(cdk.commands) == 2
+    assert cdk.commands[1][cdk.commands[1].index("--concurrency") + 1] == "3"
+    assert actions(report)["synth"] == "synthesized"
+    with open(tmp_path / "outputs.json") as f:
+        assert set(json.load(f)) == {
+            "KeyStack",
+            "BastionStack",
+            "SageMakerStack",
+        }
+
+
+def test_unchanged_inputs_skip_synth_and_deploys(tmp_path, cdk, capsys):
+    run(tmp_path, cdk)
+    cdk.commands.clear()
+
+    report = run(tmp_path, cdk)
+    assert cdk.commands == []
+    assert set(actions(report).values()) == {"skipped"}
+    # Each skip saved about as long as the stack's last deploy took
+    assert all(row["saved"] is not None for row in report)
+    deploy.print_report(report)
+    assert "Saved about" in capsys.readouterr().out
+
+
+def test_only_changed_templates_are_deployed(tmp_path, cdk, monkeypatch):
+    run(tmp_path, cdk)
+    cdk.commands.clear()
+
+    monkeypatch.setattr(deploy, "input_digest", lambda: "inputs-2")
+    cdk.templates["SageMakerStack"] = {"Resources": {"Notebook": 2}}
+    report = run(tmp_path, cdk)
+    assert cdk.deployed() == ["SageMakerStack"]
+    assert actions(report) == {
+        "deploy": "total",
+        "synth": "synthesized",
+        "KeyStack": "skipped",
+        "BastionStack": "skipped",
+        "SageMakerStack": "deployed",
+    }
+
+    # A new synth with the same templates deploys nothing
+    cdk.commands.clear()
+    monkeypatch.setattr(deploy, "input_digest", lambda: "inputs-3")
+    run(tmp_path, cdk)
+    assert cdk.deployed() == []
+
+
+def test_stacks_without_outputs_are_deployed(tmp_path, cdk):
+    run(tmp_path, cdk)
+    cdk.commands.clear()
+    outputs = json.loads((tmp_path / "outputs.json").read_text())
+    del outputs["BastionStack"]
+    (tmp_path / "outputs.json").write_text(json.dumps(outputs))
+
+    run(tmp_path, cdk)
+    assert cdk.deployed() == ["BastionStack"]
+
+
+def test_dry_run_and_force(tmp_path, cdk):
+    report = run(tmp_path, cdk, dry_run=True)
+    assert cdk.deployed() == []
+    assert actions(report)["KeyStack"] == "would deploy"
+
+    run(tmp_path, cdk)
+    cdk.commands.clear()
+    run(tmp_path, cdk, force=True)
+    assert cdk.commands[0][1] == "synth"
+    assert cdk.deployed() == ["KeyStack", "BastionStack", "SageMakerStack"]
+
+
+def event(resource, status, second, resource_type="AWS::EC2::Instance"):
+    return {
+        "StackId": "id",
+        "EventId": f"{resource}-{status}",
+        "StackName": "BastionStack",
+        "LogicalResourceId": resource,
+        "ResourceType": resource_type,
+        "ResourceStatus": status,
+        "Timestamp": datetime.datetime(
+            2024, 1, 1, 0, 0, second, tzinfo=datetime.timezone.utc
+        ),
+    }
+
+
+def test_timings_come_from_the_deploy_events(tmp_path, cdk):
+    client = boto3.client("cloudformation", region_name="us-east-1")
+    stubber = Stubber(client)
+    stack = "AWS::CloudFormation::Stack"
+    # Newest first, with an event of an earlier deploy
+    events = [
+        event("BastionStack", "UPDATE_COMPLETE", 50, stack),
+        event("Instance", "CREATE_COMPLETE", 45),
+        event("EIP", "CREATE_COMPLETE", 12, "AWS::EC2::EIP"),
+        event("Instance", "CREATE_IN_PROGRESS", 11),
+        event("EIP", "CREATE_IN_PROGRESS", 10, "AWS::EC2::EIP"),
+        event("Instance", "CREATE_IN_PROGRESS", 10),
+        event("BastionStack", "UPDATE_IN_PROGRESS", 5, stack),
+        event("BastionStack", "CREATE_COMPLETE", 1, stack),
+    ]
+    stubber.add_response(
+        "describe_stack_events",
+        {"StackEvents": events},
+        {"StackName": "BastionStack"},
+    )
+    stubber.activate()
+
+    since = event("BastionStack", "UPDATE_IN_PROGRESS", 2)["Timestamp"]
+    timings = deploy.stack_timings(client, "BastionStack", since)
+    assert timings["seconds"] == 45
+    assert [(r["id"], r["seconds"]) for r in timings["resources"]] == [
+        ("Instance", 35),
+        ("EIP", 2),
+    ]
+    assert timings["resources"][0]["status"] == "CREATE_COMPLETE"
+
+
+def test_report_lists_the_slowest_resources(tmp_path, cdk, monkeypatch):
+    timings = {
+        "seconds": 40.0,
+        "resources": [
+            {
+                "id": "Instance",
+                "type": "AWS::EC2::Instance",
+                "status": "CREATE_COMPLETE",
+                "seconds": 35.0,
+            }
+        ],
+    }
+    monkeypatch.setattr(
+        deploy, "stack_timings", lambda client, name, since: timings
+    )
+    report = run(tmp_path, cdk)
+    rows = {row["name"]: row for row in report}
+    assert rows["BastionStack"]["seconds"] == 40.0
+    assert rows["deploy"]["action"] == "total"
+
+    stream = io.StringIO()
+    deploy.print_report(report, stream)
+    assert "Instance (AWS::EC2::Instance) 35.0s" in stream.getvalue()
+
+    # The next run estimates the time saved from the recorded timings
+    report = run(tmp_path, cdk)
+    assert {row["name"]: row["saved"] for row in report}["KeyStack"] == 40.0
+
+
+def test_modules_the_app_imports_are_inputs(tmp_path):
+    (tmp_path / "stacks").mkdir()
+    (tmp_path / "app.py").write_text(
+        "import os\nfrom stacks.stack import Stack\n"
+    )
+    (tmp_path / "stacks" / "stack.py").write_text(
+        "def build():\n    from steps import render\n"
+    )
+    (tmp_path / "steps.py").write_text("def render(): pass\n")
+    (tmp_path / "unused.py").write_text("")
+    assert deploy.input_files(str(tmp_path)) == [
+        str(tmp_path / name)
+        for name in ["app.py", "stacks/stack.py", "steps.py"]
+    ]
+
+    digest = deploy.input_digest(str(tmp_path))
+    (tmp_path / "unused.py").write_text("import os\n")
+    assert deploy.input_digest(str(tmp_path)) == digest
+    (tmp_path / "steps.py").write_text("def render(): return 1\n")
+    assert deploy.input_digest(str(tmp_path)) != digest
+
+
+def test_dependency_levels():
+    stacks = [
+        {"name": "Network", "dependencies": []},
+        {"name": "Key", "dependencies": []},
+        {"name": "Bastion", "dependencies": ["Network", "Key"]},
+        {"name": "Notebook", "dependencies": ["Network"]},
+        {"name": "Tool", "dependencies": ["Notebook"]},
+    ]
+    assert deploy.dependency_levels(stacks) == [
+        ["Network", "Key"],
+        ["Bastion", "Notebook"],
+        ["Tool"],
+    ]
+
+
+class SlowCdk(FakeCdk):
+    """A FakeCdk whose commands take a while, and that counts how many
+    run at once."""
+
+    def __init__(self, templates, fail=()):
+        super().__init__(templates)
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most_running = 0
+
+    def __call__(self, command, check, cwd, env=None):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        try:
+            time.sleep(0.05)
+            if env[ENVIRONMENT_VARIABLE] in self.fail:
+                raise subprocess.CalledProcessError(1, command)
+            return super().__call__(command, check, cwd, env)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+TARGETS = [
+    {"name": "dev", "region": "us-east-1"},
+    {"name": "staging", "region": "us-west-2"},
+    {"name": "prod", "region": "eu-west-1", "profile": "prod"},
+]
+
+
+@pytest.fixture
+def environment_dirs(tmp_path, monkeypatch):
+    def environment_dir(name):
+        return str(tmp_path / "cdk.out" / name)
+
+    monkeypatch.setattr(deploy, "environment_dir", environment_dir)
+
+
+def deploy_environments(tmp_path, cdk, **kwargs):
+    return deploy.deploy_environments(
+        TARGETS,
+        outputs_path=str(tmp_path / "outputs.json"),
+        run=cdk,
+        clients=unstubbed_client,
+        **kwargs,
+    )
+
+
+def test_environments_deploy_in_parallel(tmp_path, cdk, environment_dirs):
+    slow = SlowCdk(cdk.templates)
+    reports = deploy_environments(tmp_path, slow, jobs=2)
+    assert slow.most_running == 2
+    assert {
+        name: actions(report)["KeyStack"] for name, report in reports.items()
+    } == {
+        "dev": "deployed",
+        "staging": "deployed",
+        "prod": "deployed",
+    }
+
+    # Each environment is synthesized to its own cloud assembly, and
+    # deployed with its profile
+    synths = {
+        env[ENVIRONMENT_VARIABLE]: command[command.index("--output") + 1]
+        for command, env in zip(slow.commands, slow.environments)
+        if command[1] == "synth"
+    }
+    assert synths == {
+        target["name"]: str(tmp_path / "cdk.out" / target["name"])
+        for target in TARGETS
+    }
+    for command, env in zip(slow.commands, slow.environments):
+        if env[ENVIRONMENT_VARIABLE] == "prod":
+            assert command[-2:] == ["--profile", "prod"]
+        else:
+            assert "--profile" not in command
+
+    # The outputs of all of them are merged, by stack name
+    with open(tmp_path / "outputs.json") as f:
+        outputs = json.load(f)
+    assert len(outputs) == 9
+    assert outputs["prod-KeyStack"] == {"Name": "KeyStack"}
+
+    # And each keeps its own deploy state
+    slow.commands.clear()
+    reports = deploy_environments(tmp_path, slow)
+    assert slow.commands == []
+    assert all(
+        set(actions(report).values()) == {"skipped"}
+        for report in reports.values()
+    )
+
+
+def test_failed_environment_does_not_stop_the_others(
+    tmp_path, cdk, environment_dirs
+):
+    reports = deploy_environments(tmp_path, SlowCdk(cdk.templates, {"prod"}))
+    assert isinstance(reports["prod"], subprocess.CalledProcessError)
+    assert actions(reports["dev"])["KeyStack"] == "deployed"
+    with open(tmp_path / "outputs.json") as f:
+        assert "staging-KeyStack" in json.load(f)
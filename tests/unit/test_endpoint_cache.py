@@ -0,0 +1,26 @@
+from endpoint_cache import EndpointCache
+
+
+def test_entries_expire_after_ttl(tmp_path):
+    now = [1000.0]
+    cache = EndpointCache(
+        str(tmp_path / "endpoints.json"), ttl=60, clock=lambda: now[0]
+    )
+    cache.store("nb", private_ip="10.0.0.1")
+    now[0] += 59
+    assert cache.load("nb")["private_ip"] == "10.0.0.1"
+    now[0] += 2
+    assert cache.load("nb") is None
+
+
+def test_store_merges_and_delete_removes(tmp_path):
+    cache = EndpointCache(str(tmp_path / "endpoints.json"))
+    cache.store("nb", private_ip="10.0.0.1", network_interface_id="eni-1")
+    cache.store("nb", private_ip="10.0.0.2")
+    cache.store("other", private_ip="10.0.0.3")
+    entry = cache.load("nb")
+    assert entry["network_interface_id"] == "eni-1"
+    assert entry["private_ip"] == "10.0.0.2"
+    cache.delete("nb")
+    assert cache.load("nb") is None
+    assert cache.load("other") is not None
@@ -0,0 +1,500 @@
+import base64
+import http.server
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+
+import aws_cdk as cdk
+import pytest
+from aws_cdk import assertions
+
+import lifecycle_steps
+import obtain_key
+from app_config import PROJECT_DIR, ConfigError, load_config
+from stacks.lifecycle_stack import LifecycleStack
+
+TOOLCHAIN_CACHE = os.path.join(PROJECT_DIR, "lifecycle", "toolchain-cache.sh")
+
+
+def run_cache(home, max_mb=4096):
+    """Runs the toolchain cache script against a fake home directory."""
+    return subprocess.run(
+        ["bash", TOOLCHAIN_CACHE],
+        env=dict(
+            os.environ,
+            HOME_DIR=str(home),
+            CACHE_MAX_MB=str(max_mb),
+            OWNER="nobody-here",
+        ),
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+
+def write_mb(path, size, mtime):
+    os.makedirs(path.parent, exist_ok=True)
+    path.write_bytes(os.urandom(size * 2**20))
+    os.utime(path.parent, (mtime, mtime))
+
+
+def restart(home):
+    """Wipes the home directory but the persistent SageMaker volume."""
+    for entry in home.iterdir():
+        if entry.is_symlink() or entry.is_file():
+            entry.unlink()
+        elif entry.name != "SageMaker":
+            shutil.rmtree(entry)
+
+
+@pytest.fixture
+def home(tmp_path):
+    (tmp_path / "SageMaker").mkdir()
+    return tmp_path
+
+
+def test_server_survives_a_restart(home):
+    server = home / ".vscode-server" / "bin" / "abc123"
+    server.mkdir(parents=True)
+    (server / "node").write_text("server")
+
+    run_cache(home)
+    cache = home / "SageMaker" / ".toolchain-cache" / "v1"
+    assert os.readlink(home / ".vscode-server") == str(cache / "vscode-server")
+
+    restart(home)
+    assert not (home / ".vscode-server").exists()
+    run_cache(home)
+    node = home / ".vscode-server" / "bin" / "abc123" / "node"
+    assert node.read_text() == "server"
+    # Running again changes nothing
+    assert "linked" not in run_cache(home)
+
+
+def test_conda_dirs_come_first_in_condarc(home):
+    (home / ".condarc").write_text("envs_dirs:\nchannel_priority: strict\n")
+    run_cache(home)
+    cache = home / "SageMaker" / ".toolchain-cache" / "v1"
+    lines = (home / ".condarc").read_text().splitlines()
+    assert lines == [
+        "envs_dirs:",
+        f"  - {cache}/conda/envs",
+        "pkgs_dirs:",
+        f"  - {cache}/conda/pkgs",
+        "channel_priority: strict",
+    ]
+    assert (cache / "conda" / "envs").is_dir()
+
+
+def test_old_versions_are_evicted_down_to_the_limit(home):
+    bin_dir = home / ".vscode-server" / "bin"
+    write_mb(bin_dir / "old" / "node", 2, 1000)
+    write_mb(bin_dir / "older" / "node", 2, 500)
+    write_mb(bin_dir / "new" / "node", 2, 2000)
+    envs = home / "SageMaker" / ".toolchain-cache" / "v1" / "conda" / "envs"
+    write_mb(envs / "torch" / "lib", 2, 100)
+
+    output = run_cache(home, max_mb=5)
+    assert sorted(os.listdir(home / ".vscode-server" / "bin")) == ["new"]
+    assert "evicted vscode-server/bin/older" in output
+    # Environments are never evicted, even if the cache stays too large
+    assert (envs / "torch" / "lib").exists()
+
+    output = run_cache(home, max_mb=1)
+    assert sorted(os.listdir(home / ".vscode-server" / "bin")) == ["new"]
+    assert "over 1 MB" in output
+
+
+def test_other_cache_layouts_are_removed(home):
+    old = home / "SageMaker" / ".toolchain-cache" / "v0"
+    old.mkdir(parents=True)
+    run_cache(home)
+    assert os.listdir(home / "SageMaker" / ".toolchain-cache") == ["v1"]
+
+
+def test_lifecycle_scripts_are_generated_from_the_steps():
+    config = {
+        "lifecycle": {
+            "name": "lifecycle",
+            "toolchain_cache_mb": 1024,
+            "steps": [
+                {"name": "keys", "script": "ssh-keys.sh", "on": ["create"]},
+                {"name": "cache", "script": "toolchain-cache.sh"},
+            ],
+        },
+    }
+    stack = LifecycleStack(cdk.App(), "LifecycleStack", config=config)
+    resources = assertions.Template.from_stack(stack).find_resources(
+        "AWS::SageMaker::NotebookInstanceLifecycleConfig"
+    )
+    (resource,) = resources.values()
+    hooks = {
+        event: resource["Properties"][key][0]["Content"]["Fn::Base64"]
+        for event, key in (("create", "OnCreate"), ("start", "OnStart"))
+    }
+    with open(TOOLCHAIN_CACHE) as f:
+        assert lifecycle_steps.compact(f.read()) in hooks["start"]
+    assert "export CACHE_MAX_MB=1024" in hooks["start"]
+    assert "STEPS=(cache)" in hooks["start"]
+    assert "STEPS=(keys)" in hooks["create"]
+
+
+@pytest.mark.parametrize("efs", [None, {}])
+def test_default_lifecycle_scripts_fit_in_a_lifecycle_config(efs):
+    config = dict(load_config(), efs=efs)
+    steps = lifecycle_steps.load_steps(config)
+    names = [step["name"] for step in steps]
+    assert ("efs-mount" in names) == (efs is not None)
+    environment = {
+        "CACHE_MAX_MB": 4096,
+        "SSH_KEY_PARAMETER": "/ec2/keypair/key-0123456789abcdef0",
+        "EFS_DNS_NAME": "fs-0123456789abcdef0.efs.us-east-1.amazonaws.com",
+        "EFS_MOUNT_POINT": "/home/ec2-user/SageMaker/datasets",
+    }
+    for event in ("create", "start"):
+        script = lifecycle_steps.render(steps, event, environment)
+        # SageMaker limits the base64-encoded content
+        assert len(base64.b64encode(script.encode())) <= 16384
+        subprocess.run(["bash", "-n", "-c", script], check=True)
+
+
+def test_scripts_too_long_once_encoded_are_rejected():
+    # About 14k characters as text, 19k once base64-encoded
+    steps = make_steps({"name": "long", "run": f": {'x' * 12000}"})
+    with pytest.raises(ValueError, match="once base64-encoded"):
+        lifecycle_steps.render(steps, "start")
+
+
+def test_compacted_scripts_keep_their_shebangs_and_commands():
+    script = "#!/usr/bin/env bash\n# Comment\n\n    # Indented\necho a  # b\n"
+    assert lifecycle_steps.compact(script) == (
+        "#!/usr/bin/env bash\necho a  # b\n"
+    )
+
+
+def test_environment_values_are_quoted():
+    steps = lifecycle_steps.load_steps({"lifecycle": {}})
+    mount_point = "/home/ec2-user/My datasets; touch hacked"
+    script = lifecycle_steps.render(
+        steps, "start", {"EFS_MOUNT_POINT": mount_point}
+    )
+    (line,) = [
+        line
+        for line in script.splitlines()
+        if line.startswith("export EFS_MOUNT_POINT=")
+    ]
+    printed = subprocess.run(
+        ["bash", "-c", f'{line}; printf %s "$EFS_MOUNT_POINT"'],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert printed == mount_point
+
+
+def make_steps(*steps):
+    return lifecycle_steps.load_steps({"lifecycle": {"steps": list(steps)}})
+
+
+def run_lifecycle(tmp_path, steps, event="start"):
+    """Runs a generated lifecycle script in the foreground, and returns
+    its timings."""
+    script = lifecycle_steps.render(steps, event)
+    subprocess.run(
+        ["bash", "-c", script],
+        env=dict(
+            os.environ,
+            LIFECYCLE_FOREGROUND="1",
+            LOG_DIR=str(tmp_path / "log"),
+            RUN_DIR=str(tmp_path / "run"),
+        ),
+        check=True,
+    )
+    with open(tmp_path / "log" / f"{event}.json") as f:
+        return json.load(f)
+
+
+def test_independent_steps_run_in_parallel(tmp_path):
+    steps = make_steps(
+        {"name": "a", "run": "sleep 0.5"},
+        {"name": "b", "run": "sleep 0.5"},
+        {"name": "c", "run": "echo $EVENT", "after": ["a", "b"]},
+    )
+    timings = run_lifecycle(tmp_path, steps)
+    step = {s["name"]: s for s in timings["steps"]}
+    assert timings["finished"] - timings["started"] < 0.9 + 0.5
+    assert abs(step["a"]["start"] - step["b"]["start"]) < 0.3
+    assert step["c"]["start"] >= max(step["a"]["end"], step["b"]["end"])
+    assert {s["status"] for s in timings["steps"]} == {"ok"}
+    with open(step["c"]["log"]) as f:
+        assert f.read() == "start\n"
+
+
+def test_steps_after_a_failed_step_are_skipped(tmp_path):
+    steps = make_steps(
+        {"name": "broken", "run": "exit 3"},
+        {"name": "next", "run": "true", "after": ["broken"]},
+        {"name": "other", "run": "true"},
+    )
+    timings = run_lifecycle(tmp_path, steps)
+    step = {s["name"]: s for s in timings["steps"]}
+    assert (step["broken"]["status"], step["broken"]["exit_code"]) == (
+        "failed",
+        3,
+    )
+    assert step["next"]["status"] == "skipped"
+    assert step["other"]["status"] == "ok"
+    assert "broken" in lifecycle_steps.format_timings(timings)
+
+
+def test_steps_only_run_on_their_events(tmp_path):
+    steps = make_steps(
+        {"name": "once", "run": "true", "on": ["create"]},
+        {"name": "always", "run": "true", "on": ["create", "start"]},
+        # Its dependency doesn't run on start, so it is dropped
+        {"name": "start", "run": "true", "after": ["once"]},
+    )
+    timings = run_lifecycle(tmp_path, steps, "start")
+    assert [s["name"] for s in timings["steps"]] == ["always", "start"]
+
+
+@pytest.mark.parametrize(
+    "steps, message",
+    [
+        ([{"name": "a", "run": "true", "after": ["b"]}], "unknown step b"),
+        ([{"name": "a"}], "one of script and run"),
+        ([{"name": "a b", "run": "true"}], "Invalid lifecycle step name"),
+        (
+            [
+                {"name": "a", "run": "true", "after": ["b"]},
+                {"name": "b", "run": "true", "after": ["a"]},
+            ],
+            "a -> b -> a",
+        ),
+    ],
+)
+def test_invalid_steps(steps, message):
+    with pytest.raises(ConfigError, match=message):
+        make_steps(*steps)
+
+
+def test_obtain_key_prints_the_timings(tmp_path, monkeypatch, capsys):
+    timings = run_lifecycle(
+        tmp_path, make_steps({"name": "step", "run": "true"})
+    )
+    monkeypatch.setattr(lifecycle_steps, "LOG_DIR", str(tmp_path / "log"))
+    fake_ssh = tmp_path / "fake-ssh"
+    fake_ssh.write_text(
+        '#!/bin/sh\nfor command; do :; done\nexec sh -c "$command"\n'
+    )
+    fake_ssh.chmod(0o755)
+    settings = {"notebooks": [{"host_name": "notebook"}]}
+
+    results = obtain_key.lifecycle_timings(settings, ssh=(str(fake_ssh),))
+    assert results == {"notebook": timings}
+    assert "step" in capsys.readouterr().out
+
+    assert (
+        obtain_key.lifecycle_timings(settings, "create", ssh=(str(fake_ssh),))
+        == {}
+    )
+    assert "no create lifecycle timings" in capsys.readouterr().out
+
+
+# Stands in for the AWS CLI, which isn't a dependency of this project:
+# the same botocore call "aws ssm get-parameter" makes
+AWS_CLI = """#!{python}
+import argparse, sys
+import boto3, botocore.exceptions
+
+parser = argparse.ArgumentParser()
+parser.add_argument("service", choices=["ssm"])
+parser.add_argument("operation", choices=["get-parameter"])
+parser.add_argument("--name", required=True)
+parser.add_argument("--with-decryption", action="store_true")
+parser.add_argument("--query", choices=["Parameter.Value"])
+parser.add_argument("--output", choices=["text"])
+args = parser.parse_args()
+try:
+    response = boto3.client("ssm").get_parameter(
+        Name=args.name, WithDecryption=args.with_decryption
+    )
+except botocore.exceptions.ClientError as e:
+    sys.exit(f"An error occurred: {{e}}")
+print(response["Parameter"]["Value"])
+"""
+
+
+class StubSSM(http.server.BaseHTTPRequestHandler):
+    """Answers GetParameter calls from ``responses``, and records them."""
+
+    responses = []
+    requests = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        target = self.headers["X-Amz-Target"]
+        self.requests.append((target, json.loads(body)))
+        status, response = self.responses.pop(0)
+        payload = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/x-amz-json-1.1")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def ssm_endpoint():
+    StubSSM.responses = []
+    StubSSM.requests = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubSSM)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", StubSSM
+    server.shutdown()
+    server.server_close()
+
+
+def run_ssh_keys(home, work, endpoint, check=True, **env):
+    """Runs ssh-keys.sh against the stub SSM endpoint, with the AWS CLI
+    stand-in in ``work``."""
+    aws_cli = work / "aws"
+    aws_cli.write_text(AWS_CLI.format(python=sys.executable))
+    aws_cli.chmod(0o755)
+    (work / "bin").mkdir(exist_ok=True)
+    return subprocess.run(
+        ["bash", os.path.join(PROJECT_DIR, "lifecycle", "ssh-keys.sh")],
+        env=dict(
+            os.environ,
+            HOME_DIR=str(home),
+            BIN_DIR=str(work / "bin"),
+            OWNER="nobody-here",
+            SSH_KEY_PARAMETER="/ec2/keypair/key-123",
+            AWS_CLI=str(aws_cli),
+            AWS_ENDPOINT_URL_SSM=endpoint,
+            AWS_DEFAULT_REGION="us-east-1",
+            AWS_ACCESS_KEY_ID="test",
+            AWS_SECRET_ACCESS_KEY="test",
+            AWS_CONFIG_FILE=os.devnull,
+            AWS_SHARED_CREDENTIALS_FILE=os.devnull,
+            **env,
+        ),
+        check=check,
+        capture_output=True,
+        text=True,
+    )
+
+
+def test_ssh_keys_authorizes_the_key_pair_from_ssm(
+    home, tmp_path_factory, ssm_endpoint
+):
+    endpoint, stub = ssm_endpoint
+    work = tmp_path_factory.mktemp("work")
+    key = work / "key"
+    subprocess.run(
+        ["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-f", str(key)],
+        check=True,
+    )
+    blob = (work / "key.pub").read_text().split()[1]
+    parameter = {
+        "Parameter": {
+            "Name": "/ec2/keypair/key-123",
+            "Type": "SecureString",
+            "Value": key.read_text(),
+        }
+    }
+    # The role's credentials aren't usable yet at the first attempt
+    denied = {"__type": "AccessDeniedException", "message": "Not yet"}
+    stub.responses += [(400, denied), (200, parameter), (200, parameter)]
+
+    keys = home / "SageMaker" / "authorized_keys"
+    keys.write_text("ssh-rsa AAAAadded-by-hand someone\n")
+
+    run_ssh_keys(home, work, endpoint)
+    authorized = (home / ".ssh" / "authorized_keys").read_text()
+    assert authorized.splitlines() == [
+        "ssh-rsa AAAAadded-by-hand someone",
+        f"ssh-ed25519 {blob} sagemaker-ssh",
+    ]
+    assert stub.requests[-1] == (
+        "AmazonSSM.GetParameter",
+        {"Name": "/ec2/keypair/key-123", "WithDecryption": True},
+    )
+    # The private key never touches the disk
+    for path in home.rglob("*"):
+        if path.is_file():
+            assert "PRIVATE KEY" not in path.read_text()
+
+    # At the next start, the key isn't added twice
+    run_ssh_keys(home, work, endpoint)
+    assert (home / ".ssh" / "authorized_keys").read_text() == authorized
+    assert len(stub.requests) == 3
+
+
+def test_hand_added_keys_are_copied_without_the_key_pair(
+    home, tmp_path_factory, ssm_endpoint
+):
+    endpoint, stub = ssm_endpoint
+    denied = {"__type": "AccessDeniedException", "message": "Denied"}
+    stub.responses += [(400, denied)]
+    keys = home / "SageMaker" / "authorized_keys"
+    keys.write_text("ssh-rsa AAAAadded-by-hand someone\n")
+
+    work = tmp_path_factory.mktemp("work")
+    result = run_ssh_keys(home, work, endpoint, check=False, ATTEMPTS="1")
+    assert result.returncode == 1
+    assert "could not read /ec2/keypair/key-123" in result.stderr
+    authorized = (home / ".ssh" / "authorized_keys").read_text()
+    assert authorized == "ssh-rsa AAAAadded-by-hand someone\n"
+    assert os.access(work / "bin" / "copy-ssh-keys", os.X_OK)
+
+
+def test_efs_mount_retries_until_the_file_system_resolves(tmp_path):
+    calls = tmp_path / "calls"
+    mount = tmp_path / "mount"
+    # Fails like mount.nfs4 while the mount target's name doesn't resolve
+    mount.write_text(
+        "#!/usr/bin/env bash\n"
+        f'echo "$*" >>{calls}\n'
+        f'[ "$(wc -l <{calls})" -gt 1 ] || exit 32\n'
+    )
+    mount.chmod(0o755)
+    mount_point = tmp_path / "SageMaker" / "datasets"
+
+    def run_efs_mount(dns_name):
+        return subprocess.run(
+            ["bash", os.path.join(PROJECT_DIR, "lifecycle", "efs-mount.sh")],
+            env=dict(
+                os.environ,
+                EFS_DNS_NAME=dns_name,
+                EFS_MOUNT_POINT=str(mount_point),
+                MOUNT=str(mount),
+                RETRY_DELAY="0",
+                OWNER="nobody-here",
+            ),
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+
+    assert "no file system" in run_efs_mount("")
+    assert not calls.exists()
+
+    dns_name = "fs-123.efs.us-east-1.amazonaws.com"
+    assert "mounted" in run_efs_mount(dns_name)
+    first, second = calls.read_text().splitlines()
+    assert first == second
+    options = first.split()[3].split(",")
+    assert first.split()[:3] == ["-t", "nfs4", "-o"]
+    assert {"nfsvers=4.1", "rsize=1048576", "hard", "noresvport"} <= set(
+        options
+    )
+    assert first.split()[4:] == [f"{dns_name}:/", str(mount_point)]
+    assert mount_point.is_dir()
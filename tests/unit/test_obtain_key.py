@@ -0,0 +1,724 @@
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+import pytest
+import yaml
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import obtain_key
+from app_config import CONFIG_PATH, ConfigError
+from endpoint_cache import EndpointCache
+from port_forwards import ForwardRegistry
+from ssh_profiles import load_profile
+from ssh_utils import SSHConfig
+from tests.unit.helpers import make_stubbed_client
+
+LATENCY = 0.3
+
+
+def interfaces(ips):
+    """A describe_network_interfaces response for ``{eni: ip}``."""
+    return {
+        "NetworkInterfaces": [
+            {"NetworkInterfaceId": eni, "PrivateIpAddress": ip}
+            for eni, ip in ips.items()
+        ]
+    }
+
+
+def eni_filter(network_interface_ids):
+    return {
+        "Filters": [
+            {"Name": "network-interface-id", "Values": network_interface_ids}
+        ]
+    }
+
+
+@pytest.fixture
+def key_material():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption(),
+    ).decode()
+
+
+@pytest.fixture
+def settings(tmp_path):
+    return {
+        "region": "us-east-1",
+        "key_name": "bastion-ssh-key",
+        "key_parameter_name": "/ec2/keypair/key-123",
+        "key_filepath": str(tmp_path / "bastion-ssh-key.pem"),
+        "key_storage": "file",
+        "agent_lifetime": 3600,
+        "connection": "bastion",
+        "bastion_host_name": "ec2-bastion-sagemaker-ssh",
+        "bastions": {"ec2-bastion-sagemaker-ssh": "203.0.113.10"},
+        "bastion_instance_ids": ["i-0123"],
+        "instance_connect_endpoint_id": None,
+        "notebooks": [
+            {
+                "instance_name": "accessible-notebook-me",
+                "url": "https://example.com",
+                "host_name": "sagemaker-notebook-sagemaker-ssh",
+                "services": {"tensorboard": 6006},
+            }
+        ],
+        "profile": load_profile("default"),
+        "outputs_digest": "digest-1",
+        "include_file": None,
+        "main_config_file": str(tmp_path / "config"),
+        "ssh_config_file": str(tmp_path / "config"),
+    }
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return EndpointCache(str(tmp_path / "cache" / "endpoints.json"))
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return ForwardRegistry(
+        str(tmp_path / "cache" / "forwards.json"), is_free=lambda port: True
+    )
+
+
+@pytest.fixture
+def clients(key_material):
+    ssm, ssm_stub = make_stubbed_client("ssm", latency=LATENCY)
+    sagemaker, sagemaker_stub = make_stubbed_client(
+        "sagemaker", latency=LATENCY
+    )
+    ec2, ec2_stub = make_stubbed_client("ec2", latency=LATENCY)
+    ssm_stub.add_response(
+        "get_parameter",
+        {"Parameter": {"Value": key_material}},
+        {"Name": "/ec2/keypair/key-123", "WithDecryption": True},
+    )
+    sagemaker_stub.add_response(
+        "describe_notebook_instance",
+        {"NetworkInterfaceId": "eni-123"},
+        {"NotebookInstanceName": "accessible-notebook-me"},
+    )
+    ec2_stub.add_response(
+        "describe_network_interfaces",
+        interfaces({"eni-123": "10.0.1.5"}),
+        eni_filter(["eni-123"]),
+    )
+    yield {"ssm": ssm, "sagemaker": sagemaker, "ec2": ec2}
+    for stub in (ssm_stub, sagemaker_stub, ec2_stub):
+        stub.assert_no_pending_responses()
+
+
+@pytest.fixture(autouse=True)
+def home(monkeypatch, tmp_path):
+    # Run inside tmp_path
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+
+
+def test_get_overlaps_independent_calls(settings, clients, cache, registry):
+    timings = obtain_key.Timings()
+    start = time.perf_counter()
+    results = obtain_key.get(settings, clients, timings, cache, registry)
+    elapsed = time.perf_counter() - start
+
+    # The key (one call) overlaps the notebook lookup (two calls)
+    assert elapsed < 3 * LATENCY
+    assert results["notebook_ips"] == {"accessible-notebook-me": "10.0.1.5"}
+    assert results["public_key"].startswith("ssh-rsa ")
+    phases = {name for name, _, _ in timings.phases}
+    assert {"key_material", "network_interface_ids", "ssh_config"} <= phases
+
+    ssh_config = SSHConfig(settings["ssh_config_file"])
+    notebook = ssh_config.lookup_host("sagemaker-notebook-sagemaker-ssh")
+    assert notebook["Hostname"] == "10.0.1.5"
+    assert ssh_config.lookup_host("ec2-bastion-sagemaker-ssh")["Hostname"] == (
+        "203.0.113.10"
+    )
+
+
+def test_hosts_tunnel_through_the_instance_connect_endpoint(
+    settings, clients, cache, registry, tmp_path
+):
+    with open(CONFIG_PATH) as f:
+        config = yaml.safe_load(f)
+    config["ssh"]["connection"] = "instance-connect"
+    (tmp_path / "config.yaml").write_text(yaml.safe_dump(config))
+    suffix = config["notebook"]["name"]
+    outputs = {
+        f"KeyStack-{suffix}": {
+            "MyKeyPairName": "bastion-ssh-key",
+            "MyKeyPairParameterName": "/ec2/keypair/key-123",
+            "Region": "us-east-1",
+        },
+        f"InstanceConnectStack-{suffix}": {"EndpointID": "eice-0123"},
+        f"SageMakerStack-{suffix}": {
+            "SageMakerNotebookName": "accessible-notebook-me",
+            "SageMakerNotebookURL": "https://example.com",
+        },
+    }
+    (tmp_path / "outputs.json").write_text(json.dumps(outputs))
+    loaded = obtain_key.load_settings(
+        str(tmp_path / "config.yaml"), str(tmp_path / "outputs.json")
+    )
+    assert loaded["connection"] == "instance-connect"
+    assert loaded["instance_connect_endpoint_id"] == "eice-0123"
+
+    settings.update(
+        connection="instance-connect",
+        bastions={},
+        instance_connect_endpoint_id="eice-0123",
+    )
+    obtain_key.get(settings, clients, obtain_key.Timings(), cache, registry)
+    ssh_config = SSHConfig(settings["ssh_config_file"])
+    notebook = ssh_config.lookup_host("sagemaker-notebook-sagemaker-ssh")
+    assert notebook["Hostname"] == "10.0.1.5"
+    assert notebook["ProxyCommand"] == (
+        "aws ec2-instance-connect open-tunnel "
+        "--instance-connect-endpoint-id eice-0123 "
+        "--private-ip-address %h --remote-port %p --region us-east-1"
+    )
+    assert "ProxyJump" not in notebook
+    with pytest.raises(ValueError):
+        ssh_config.lookup_host("ec2-bastion-sagemaker-ssh")
+
+
+def test_notebook_hosts_go_through_the_bastion_pool(settings, tmp_path):
+    with open(CONFIG_PATH) as f:
+        config = yaml.safe_load(f)
+    config["ec2"]["bastions"] = 2
+    (tmp_path / "config.yaml").write_text(yaml.safe_dump(config))
+    suffix = config["notebook"]["name"]
+    outputs = {
+        f"KeyStack-{suffix}": {
+            "MyKeyPairName": "bastion-ssh-key",
+            "MyKeyPairParameterName": "/ec2/keypair/key-123",
+            "Region": "us-east-1",
+        },
+        f"BastionStack-{suffix}": {
+            "PublicIP": "203.0.113.10",
+            "PublicIP2": "203.0.113.11",
+            "InstanceID": "i-0123",
+            "InstanceID2": "i-4567",
+        },
+        f"SageMakerStack-{suffix}": {
+            "SageMakerNotebookName": "accessible-notebook-me",
+            "SageMakerNotebookURL": "https://example.com",
+        },
+    }
+    (tmp_path / "outputs.json").write_text(json.dumps(outputs))
+    loaded = obtain_key.load_settings(
+        str(tmp_path / "config.yaml"), str(tmp_path / "outputs.json")
+    )
+    assert loaded["bastions"] == {
+        "ec2-bastion-sagemaker-ssh": "203.0.113.10",
+        "ec2-bastion-sagemaker-ssh-2": "203.0.113.11",
+    }
+    assert loaded["bastion_instance_ids"] == ["i-0123", "i-4567"]
+
+    settings["bastions"] = loaded["bastions"]
+    hosts = obtain_key.host_entries(
+        settings, {"accessible-notebook-me": "10.0.1.5"}
+    )
+    assert hosts["ec2-bastion-sagemaker-ssh-2"]["Hostname"] == "203.0.113.11"
+    notebook = hosts["sagemaker-notebook-sagemaker-ssh"]
+    assert "ProxyJump" not in notebook
+    assert notebook["ProxyCommand"].endswith(
+        "proxy %h %p ec2-bastion-sagemaker-ssh=203.0.113.10 "
+        "ec2-bastion-sagemaker-ssh-2=203.0.113.11"
+    )
+
+
+def test_environment_settings_come_from_its_stacks(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.delenv("XDG_CACHE_HOME", raising=False)
+    with open(CONFIG_PATH) as f:
+        config = yaml.safe_load(f)
+    config["environments"] = [
+        {"name": "dev", "region": "us-east-1"},
+        {"name": "prod", "region": "eu-west-1", "profile": "prod"},
+    ]
+    (tmp_path / "config.yaml").write_text(yaml.safe_dump(config))
+    suffix = config["notebook"]["name"]
+    # The merged outputs of both environments
+    outputs = {}
+    for name, ip in [("dev", "203.0.113.10"), ("prod", "198.51.100.10")]:
+        outputs.update(
+            {
+                f"{name}-KeyStack-{suffix}": {
+                    "MyKeyPairName": "bastion-ssh-key",
+                    "MyKeyPairParameterName": f"/ec2/keypair/key-{name}",
+                    "Region": dict(dev="us-east-1", prod="eu-west-1")[name],
+                },
+                f"{name}-BastionStack-{suffix}": {
+                    "PublicIP": ip,
+                    "InstanceID": f"i-{name}",
+                },
+                f"{name}-SageMakerStack-{suffix}": {
+                    "SageMakerNotebookName": "accessible-notebook-me",
+                    "SageMakerNotebookURL": "https://example.com",
+                },
+            }
+        )
+    (tmp_path / "outputs.json").write_text(json.dumps(outputs))
+    loaded = obtain_key.load_settings(
+        str(tmp_path / "config.yaml"), str(tmp_path / "outputs.json"), "prod"
+    )
+    assert loaded["region"] == "eu-west-1"
+    assert loaded["aws_profile"] == "prod"
+    assert loaded["key_parameter_name"] == "/ec2/keypair/key-prod"
+    assert loaded["bastions"] == {
+        "ec2-bastion-prod-sagemaker-ssh": "198.51.100.10"
+    }
+    assert loaded["bastion_instance_ids"] == ["i-prod"]
+    # Hosts, key file and cache don't collide with the other environment's
+    (notebook,) = loaded["notebooks"]
+    assert notebook["host_name"] == "sagemaker-notebook-prod-sagemaker-ssh"
+    assert loaded["key_filepath"] == str(
+        tmp_path / ".ssh" / "bastion-ssh-key-prod.pem"
+    )
+    assert loaded["endpoint_cache_path"] == str(
+        tmp_path / ".cache" / "sagemaker-ssh" / "endpoints-prod.json"
+    )
+
+    with pytest.raises(ConfigError, match="Unknown environment test"):
+        obtain_key.load_settings(
+            str(tmp_path / "config.yaml"),
+            str(tmp_path / "outputs.json"),
+            "test",
+        )
+
+
+def test_key_is_written_read_only_without_subprocesses(
+    tmp_path, key_material, monkeypatch
+):
+    monkeypatch.setattr(obtain_key.subprocess, "run", None)
+    key_filepath = tmp_path / "home" / ".ssh" / "key.pem"
+    obtain_key.install_key("old key", str(key_filepath))
+    # A read-only key from an earlier get is replaced
+    obtain_key.install_key(key_material, str(key_filepath))
+    assert key_filepath.read_text() == key_material
+    assert os.stat(key_filepath).st_mode & 0o777 == 0o400
+    assert os.listdir(key_filepath.parent) == ["key.pem"]
+
+
+@pytest.mark.skipif(
+    not shutil.which("ssh-agent"), reason="needs the ssh client"
+)
+def test_key_is_loaded_into_the_agent(
+    settings, clients, cache, registry, tmp_path, monkeypatch
+):
+    socket_path = str(tmp_path / "agent.sock")
+    agent = subprocess.Popen(["ssh-agent", "-D", "-a", socket_path])
+    try:
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+        monkeypatch.setenv("SSH_AUTH_SOCK", socket_path)
+        public_key_path = str(tmp_path / "home" / ".ssh" / "key.pub")
+        settings.update(key_storage="agent", key_filepath=public_key_path)
+        results = obtain_key.get(
+            settings, clients, obtain_key.Timings(), cache, registry
+        )
+        listed = subprocess.run(
+            ["ssh-add", "-l"], capture_output=True, check=True, text=True
+        ).stdout
+    finally:
+        agent.terminate()
+        agent.wait()
+
+    fingerprint = obtain_key.key_fingerprint(results["public_key"])
+    assert listed.split()[1] == fingerprint
+    with open(public_key_path) as f:
+        assert f.read() == results["public_key"] + "\n"
+    # The private key never touches the disk
+    for path in tmp_path.rglob("*"):
+        if path.is_file():
+            assert "PRIVATE KEY" not in path.read_text(errors="ignore")
+
+    ssh_config = SSHConfig(settings["ssh_config_file"])
+    notebook = ssh_config.lookup_host("sagemaker-notebook-sagemaker-ssh")
+    assert notebook["IdentityFile"] == public_key_path
+    assert notebook["IdentitiesOnly"] == "yes"
+
+
+def test_agent_mode_needs_an_agent(monkeypatch):
+    monkeypatch.delenv("SSH_AUTH_SOCK", raising=False)
+    with pytest.raises(RuntimeError, match="no ssh-agent is running"):
+        obtain_key.add_key_to_agent("key", "ssh-ed25519 AAAA", "key.pub", 60)
+
+
+def test_public_key_is_derived_once(
+    settings, clients, cache, monkeypatch, registry
+):
+    calls = []
+    derive = obtain_key.private_to_public_key
+    monkeypatch.setattr(
+        obtain_key,
+        "private_to_public_key",
+        lambda key: calls.append(key) or derive(key),
+    )
+    obtain_key.get(settings, clients, obtain_key.Timings(), cache, registry)
+    # From the key material, not re-read from the key file
+    with open(settings["key_filepath"], "rb") as f:
+        assert calls == [f.read()]
+
+
+def test_run_graph_orders_dependencies():
+    order = []
+    tasks = {
+        "c": (lambda a, b: order.append("c") or a + b, ["a", "b"]),
+        "a": (lambda: order.append("a") or 1, []),
+        "b": (lambda a: order.append("b") or a + 1, ["a"]),
+    }
+    results = obtain_key.run_graph(tasks, obtain_key.Timings())
+    assert results == {"a": 1, "b": 2, "c": 3}
+    assert order == ["a", "b", "c"]
+
+
+def test_run_graph_rejects_missing_dependencies():
+    with pytest.raises(ValueError):
+        obtain_key.run_graph({"a": (lambda b: b, ["b"])}, obtain_key.Timings())
+
+
+def restarted_clients(responses):
+    """Stubbed clients that expect exactly ``responses``, in order."""
+    clients, stubs = {}, []
+    for service in ("ssm", "sagemaker", "ec2"):
+        clients[service], stub = make_stubbed_client(service)
+        stubs.append(stub)
+    for service, method, response, params in responses:
+        stub = stubs[["ssm", "sagemaker", "ec2"].index(service)]
+        stub.add_response(method, response, params)
+    return clients, stubs
+
+
+def test_refresh_only_checks_the_ip(settings, clients, cache, registry):
+    obtain_key.get(settings, clients, obtain_key.Timings(), cache, registry)
+    ssh_config = SSHConfig(settings["ssh_config_file"])
+    before = ssh_config.lookup_host("sagemaker-notebook-sagemaker-ssh")
+
+    new_clients, stubs = restarted_clients(
+        [
+            (
+                "ec2",
+                "describe_network_interfaces",
+                interfaces({"eni-123": "10.0.1.99"}),
+                eni_filter(["eni-123"]),
+            )
+        ]
+    )
+    assert obtain_key.refresh(
+        settings, new_clients, obtain_key.Timings(), cache
+    )
+    for stub in stubs:
+        stub.assert_no_pending_responses()
+
+    ssh_config = SSHConfig(settings["ssh_config_file"])
+    after = ssh_config.lookup_host("sagemaker-notebook-sagemaker-ssh")
+    assert after == dict(before, Hostname="10.0.1.99")
+    assert after["LocalForward"] == "6006 localhost:6006"
+    assert cache.load("accessible-notebook-me")["private_ip"] == "10.0.1.99"
+
+
+def test_refresh_follows_a_new_network_interface(
+    settings, clients, cache, registry
+):
+    obtain_key.get(settings, clients, obtain_key.Timings(), cache, registry)
+    new_clients, stubs = restarted_clients(
+        [
+            (
+                "ec2",
+                "describe_network_interfaces",
+                interfaces({}),
+                eni_filter(["eni-123"]),
+            ),
+            (
+                "sagemaker",
+                "describe_notebook_instance",
+                {"NetworkInterfaceId": "eni-456"},
+                {"NotebookInstanceName": "accessible-notebook-me"},
+            ),
+            (
+                "ec2",
+                "describe_network_interfaces",
+                interfaces({"eni-456": "10.0.1.7"}),
+                eni_filter(["eni-456"]),
+            ),
+        ]
+    )
+    assert obtain_key.refresh(
+        settings, new_clients, obtain_key.Timings(), cache
+    )
+    entry = cache.load("accessible-notebook-me")
+    assert entry["network_interface_id"] == "eni-456"
+    assert entry["private_ip"] == "10.0.1.7"
+
+
+def test_refresh_reports_a_notebook_without_an_address(
+    settings, clients, cache, registry, capsys
+):
+    obtain_key.get(settings, clients, obtain_key.Timings(), cache, registry)
+    ssh_config = SSHConfig(settings["ssh_config_file"])
+    before = ssh_config.lookup_host("sagemaker-notebook-sagemaker-ssh")
+    # Restarted, but not running yet
+    new_clients, stubs = restarted_clients(
+        [
+            (
+                "ec2",
+                "describe_network_interfaces",
+                interfaces({}),
+                eni_filter(["eni-123"]),
+            ),
+            (
+                "sagemaker",
+                "describe_notebook_instance",
+                {"NotebookInstanceStatus": "Pending"},
+                {"NotebookInstanceName": "accessible-notebook-me"},
+            ),
+        ]
+    )
+    capsys.readouterr()
+    assert obtain_key.refresh(
+        settings, new_clients, obtain_key.Timings(), cache
+    )
+    for stub in stubs:
+        stub.assert_no_pending_responses()
+    output = capsys.readouterr().out
+    assert "accessible-notebook-me has no address" in output
+    assert '"wait"' in output
+    ssh_config = SSHConfig(settings["ssh_config_file"])
+    after = ssh_config.lookup_host("sagemaker-notebook-sagemaker-ssh")
+    assert after == before
+    assert cache.load("accessible-notebook-me")["private_ip"] == "10.0.1.5"
+
+
+def test_resume_starts_and_refreshes_the_stopped_notebook(
+    settings, clients, cache, registry, monkeypatch
+):
+    obtain_key.get(settings, clients, obtain_key.Timings(), cache, registry)
+    monkeypatch.setattr(obtain_key.resume, "MIN_DELAY", 0.01)
+    name = {"NotebookInstanceName": "accessible-notebook-me"}
+    bastion = {
+        "Reservations": [
+            {
+                "Instances": [
+                    {"InstanceId": "i-0123", "State": {"Name": "running"}}
+                ]
+            }
+        ]
+    }
+    bastion_ids = {"InstanceIds": ["i-0123"]}
+    new_clients, stubs = restarted_clients(
+        [
+            (
+                "sagemaker",
+                "describe_notebook_instance",
+                {"NotebookInstanceStatus": "Stopped"},
+                name,
+            ),
+            ("ec2", "describe_instances", bastion, bastion_ids),
+            ("sagemaker", "start_notebook_instance", {}, name),
+            (
+                "sagemaker",
+                "describe_notebook_instance",
+                {"NotebookInstanceStatus": "InService"},
+                name,
+            ),
+            # The refresh of the resumed notebook
+            (
+                "ec2",
+                "describe_network_interfaces",
+                interfaces({"eni-123": "10.0.1.42"}),
+                eni_filter(["eni-123"]),
+            ),
+        ]
+    )
+    assert obtain_key.resume_notebooks(
+        settings, new_clients, obtain_key.Timings(), cache
+    )
+    for stub in stubs:
+        stub.assert_no_pending_responses()
+    ssh_config = SSHConfig(settings["ssh_config_file"])
+    notebook = ssh_config.lookup_host("sagemaker-notebook-sagemaker-ssh")
+    assert notebook["Hostname"] == "10.0.1.42"
+
+
+def test_refresh_needs_a_valid_cache(settings, clients, cache, registry):
+    new_clients, _ = restarted_clients([])
+    assert not obtain_key.refresh(
+        settings, new_clients, obtain_key.Timings(), cache
+    )
+
+    obtain_key.get(settings, clients, obtain_key.Timings(), cache, registry)
+    changed = dict(settings, outputs_digest="digest-2")
+    assert not obtain_key.refresh(
+        changed, new_clients, obtain_key.Timings(), cache
+    )
+
+
+class FakeSageMaker:
+    """Answers describe_notebook_instance and tracks concurrent calls."""
+
+    def __init__(self, latency, stopped=()):
+        self.latency = latency
+        self.stopped = set(stopped)
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def describe_notebook_instance(self, NotebookInstanceName):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(self.latency)
+        with self.lock:
+            self.active -= 1
+        if NotebookInstanceName in self.stopped:
+            return {"NotebookInstanceStatus": "Stopped"}
+        return {"NetworkInterfaceId": f"eni-{NotebookInstanceName}"}
+
+
+def test_fleet_is_resolved_with_batched_calls(
+    settings, cache, key_material, registry
+):
+    names = [f"nb-{i}" for i in range(250)]
+    settings["notebooks"] = [
+        {
+            "instance_name": name,
+            "url": "",
+            "host_name": f"sagemaker-{name}",
+            "services": {"tensorboard": 6006},
+        }
+        for name in names
+    ]
+    ssm, ssm_stub = make_stubbed_client("ssm")
+    ssm_stub.add_response(
+        "get_parameter", {"Parameter": {"Value": key_material}}
+    )
+    ec2, ec2_stub = make_stubbed_client("ec2")
+    ips = {
+        f"eni-{name}": f"10.0.{i // 200}.{i % 200}"
+        for i, name in enumerate(names)
+    }
+    enis = list(ips)
+    ec2_stub.add_response(
+        "describe_network_interfaces",
+        dict(interfaces({e: ips[e] for e in enis[:150]}), NextToken="page-2"),
+        eni_filter(enis[:200]),
+    )
+    ec2_stub.add_response(
+        "describe_network_interfaces",
+        interfaces({e: ips[e] for e in enis[150:200]}),
+        dict(eni_filter(enis[:200]), NextToken="page-2"),
+    )
+    ec2_stub.add_response(
+        "describe_network_interfaces",
+        interfaces({e: ips[e] for e in enis[200:]}),
+        eni_filter(enis[200:]),
+    )
+    sagemaker = FakeSageMaker(latency=0.01)
+    clients = {"ssm": ssm, "sagemaker": sagemaker, "ec2": ec2}
+
+    results = obtain_key.get(
+        settings, clients, obtain_key.Timings(), cache, registry
+    )
+    ec2_stub.assert_no_pending_responses()
+    assert 1 < sagemaker.max_active <= obtain_key.DESCRIBE_CONCURRENCY
+    assert results["notebook_ips"]["nb-249"] == ips["eni-nb-249"]
+
+    hosts = SSHConfig(settings["ssh_config_file"]).config
+    assert len(hosts) == 251
+    assert hosts["sagemaker-nb-0"]["Hostname"] == "10.0.0.0"
+
+    # Every notebook's TensorBoard gets its own local port
+    local_ports = {
+        forwards["tensorboard"]["local_port"]
+        for forwards in results["forwards"].values()
+    }
+    assert len(local_ports) == 250 and 6006 in local_ports
+
+
+def test_notebooks_without_a_network_interface_are_reported(
+    settings, cache, key_material, registry, capsys
+):
+    settings["notebooks"] = [
+        {
+            "instance_name": name,
+            "url": "",
+            "host_name": f"sagemaker-{name}",
+            "services": {},
+        }
+        for name in ("nb-running", "nb-stopped")
+    ]
+    ssm, ssm_stub = make_stubbed_client("ssm")
+    ssm_stub.add_response(
+        "get_parameter", {"Parameter": {"Value": key_material}}
+    )
+    ec2, ec2_stub = make_stubbed_client("ec2")
+    ec2_stub.add_response(
+        "describe_network_interfaces",
+        interfaces({"eni-nb-running": "10.0.1.5"}),
+        eni_filter(["eni-nb-running"]),
+    )
+    sagemaker = FakeSageMaker(latency=0, stopped=["nb-stopped"])
+    clients = {"ssm": ssm, "sagemaker": sagemaker, "ec2": ec2}
+
+    results = obtain_key.get(
+        settings, clients, obtain_key.Timings(), cache, registry
+    )
+    assert results["notebook_ips"] == {"nb-running": "10.0.1.5"}
+    assert "nb-stopped has no address" in capsys.readouterr().out
+    hosts = SSHConfig(settings["ssh_config_file"]).config
+    assert hosts["sagemaker-nb-running"]["Hostname"] == "10.0.1.5"
+    assert "sagemaker-nb-stopped" not in hosts
+    assert cache.load("nb-running")["private_ip"] == "10.0.1.5"
+    assert cache.load("nb-stopped") is None
+
+
+def test_tunnel_relays_each_notebook(
+    settings, clients, cache, registry, monkeypatch
+):
+    obtain_key.get(settings, clients, obtain_key.Timings(), cache, registry)
+    daemons = []
+
+    def run(coroutine):
+        daemons.append(coroutine.cr_frame.f_locals["self"])
+        coroutine.close()
+
+    monkeypatch.setattr(obtain_key.asyncio, "run", run)
+    obtain_key.tunnel(settings, cache, registry)
+
+    (daemon,) = daemons
+    targets = {
+        listener.name: (listener.host, listener.port)
+        for listener in daemon.listeners
+    }
+    host = "sagemaker-notebook-sagemaker-ssh"
+    assert targets == {
+        host: ("10.0.1.5", 22),
+        f"{host} tensorboard": ("10.0.1.5", 6006),
+    }
+    assert daemon.transport.command[-1] == "ec2-bastion-sagemaker-ssh"
+    tunnel_host = SSHConfig(settings["ssh_config_file"]).lookup_host(
+        f"{host}-tunnel"
+    )
+    assert tunnel_host["Hostname"] == "127.0.0.1"
+    assert tunnel_host["Port"] == str(daemon.listeners[0].local_port)
+    assert "ProxyJump" not in tunnel_host
+
+
+def test_sync_reports_a_missing_source(settings, tmp_path, capsys):
+    missing = str(tmp_path / "missing")
+    assert obtain_key.sync_data(settings, missing, ssh=("false",)) is None
+    assert "Error syncing to sagemaker-notebook-sagemaker-ssh" in (
+        capsys.readouterr().out
+    )
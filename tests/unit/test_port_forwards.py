@@ -0,0 +1,159 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+import obtain_key
+import port_forwards
+from port_forwards import ForwardRegistry, candidate_ports
+
+# The sshd stand-ins of the handshake benchmark
+BENCHMARKS = os.path.join(os.path.dirname(__file__), "../../benchmarks")
+sys.path.insert(0, BENCHMARKS)
+import bench_handshake  # noqa: E402
+
+
+@pytest.fixture
+def registry(tmp_path):
+    return ForwardRegistry(
+        str(tmp_path / "forwards.json"), is_free=lambda port: port != 6006
+    )
+
+
+def test_candidate_ports_are_deterministic():
+    def candidates(host):
+        return list(candidate_ports(host, "ray", 8265, (100, 110)))
+
+    first = candidates("notebook-a")
+    assert first[0] == 8265
+    assert sorted(first[1:]) == list(range(100, 110))
+    assert first == candidates("notebook-a")
+    assert first != candidates("notebook-b")
+    assert next(candidate_ports("notebook-a", "web", 80)) >= 20000
+
+
+def test_services_keep_their_ports_across_runs(registry, tmp_path):
+    services = {
+        "notebook-a": {"tensorboard": 6006, "jupyter": 8888},
+        "notebook-b": {"jupyter": 8888},
+    }
+    forwards = registry.allocate(services)
+    # 6006 is taken, and 8888 only goes to the first notebook
+    assert forwards["notebook-a"]["jupyter"]["local_port"] == 8888
+    local_ports = [
+        forward["local_port"]
+        for host in forwards.values()
+        for forward in host.values()
+    ]
+    assert len(set(local_ports)) == 3 and 6006 not in local_ports
+
+    # A new registry on the same file, where every port is now bound
+    again = ForwardRegistry(registry.path, is_free=lambda port: False)
+    assert again.allocate(services) == forwards
+
+
+def test_undeclared_services_are_released(registry):
+    registry.allocate({"notebook-a": {"tensorboard": 6006, "ray": 8265}})
+    forwards = registry.allocate({"notebook-a": {"ray": 8265}})
+    assert list(forwards["notebook-a"]) == ["ray"]
+    assert list(registry.forwards("notebook-a")) == ["ray"]
+    registry.release("notebook-a")
+    assert registry.forwards("notebook-a") == {}
+
+
+def test_forward_action_uses_the_control_socket(registry, monkeypatch):
+    commands = []
+    monkeypatch.setattr(
+        port_forwards.subprocess,
+        "run",
+        lambda command, **kwargs: commands.append(command),
+    )
+    settings = {
+        "notebooks": [{"host_name": "notebook-a", "services": {"ray": 8265}}]
+    }
+    obtain_key.forward(settings, registry, "notebook-a", "ray")
+    obtain_key.forward(settings, registry, "notebook-a", "9000")
+    obtain_key.forward(settings, registry, "notebook-a", "ray", cancel=True)
+    assert commands == [
+        ["ssh", "-O", "forward", "-L", "8265:localhost:8265", "notebook-a"],
+        ["ssh", "-O", "forward", "-L", "9000:localhost:9000", "notebook-a"],
+        ["ssh", "-O", "cancel", "-L", "8265:localhost:8265", "notebook-a"],
+    ]
+    assert list(registry.forwards("notebook-a")) == ["port-9000"]
+
+
+def test_failed_forward_releases_its_port(registry, monkeypatch):
+    def run(command, **kwargs):
+        raise subprocess.CalledProcessError(
+            255, command, stderr="Control socket connect: No such file"
+        )
+
+    monkeypatch.setattr(port_forwards.subprocess, "run", run)
+    settings = {
+        "notebooks": [{"host_name": "notebook-a", "services": {"ray": 8265}}]
+    }
+    obtain_key.forward(settings, registry, "notebook-a", "ray")
+    assert registry.forwards("notebook-a") == {}
+
+    # A forward allocated before, e.g. by get, keeps its port
+    registry.allocate({"notebook-a": {"ray": 8265}})
+    obtain_key.forward(settings, registry, "notebook-a", "ray")
+    assert list(registry.forwards("notebook-a")) == ["ray"]
+
+
+@pytest.mark.skipif(
+    bench_handshake.find_sshd() is None, reason="needs the OpenSSH server"
+)
+def test_forwards_are_added_and_removed_without_reconnecting():
+    # A short path, for the control sockets
+    directory = tempfile.mkdtemp(dir="/tmp")
+    config_file = f"{directory}/config"
+    processes = []
+    try:
+        bench_handshake.keygen(f"{directory}/host_key", "ed25519")
+        bench_handshake.keygen(f"{directory}/id_ed25519", "ed25519")
+        shutil.copy(
+            f"{directory}/id_ed25519.pub", f"{directory}/authorized_keys"
+        )
+        ports = {}
+        for name in ("bastion", "notebook"):
+            process, ports[name] = bench_handshake.start_sshd(
+                bench_handshake.find_sshd(), directory, name
+            )
+            processes.append(process)
+        bench_handshake.write_config(
+            config_file, directory, "default", ports, "ed25519"
+        )
+        subprocess.run(
+            ["ssh", "-F", config_file, "-fN", "notebook"], check=True
+        )
+        registry = ForwardRegistry(f"{directory}/forwards.json")
+        # Forward a local port to the bastion's sshd, through the notebook
+        forward = registry.add("notebook", "sshd", ports["bastion"])
+        port_forwards.control_forward(
+            "notebook",
+            forward["local_port"],
+            ports["bastion"],
+            config_file=config_file,
+        )
+        with socket.create_connection(("127.0.0.1", forward["local_port"])):
+            pass
+        port_forwards.control_forward(
+            "notebook",
+            forward["local_port"],
+            ports["bastion"],
+            cancel=True,
+            config_file=config_file,
+        )
+        with pytest.raises(OSError):
+            socket.create_connection(("127.0.0.1", forward["local_port"]))
+    finally:
+        bench_handshake.close_connections(config_file)
+        for process in processes:
+            process.terminate()
+            process.wait()
+        shutil.rmtree(directory)
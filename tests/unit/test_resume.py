@@ -0,0 +1,106 @@
+import pytest
+
+import resume
+from tests.unit.helpers import FakeClock, make_stubbed_client
+
+
+@pytest.fixture
+def clients():
+    sagemaker, sagemaker_stub = make_stubbed_client("sagemaker")
+    ec2, ec2_stub = make_stubbed_client("ec2")
+    yield sagemaker, sagemaker_stub, ec2, ec2_stub
+    sagemaker_stub.assert_no_pending_responses()
+    ec2_stub.assert_no_pending_responses()
+
+
+def notebook(stub, status, name="nb"):
+    stub.add_response(
+        "describe_notebook_instance",
+        {"NotebookInstanceStatus": status},
+        {"NotebookInstanceName": name},
+    )
+
+
+def instance(stub, state, instance_id="i-0123"):
+    stub.add_response(
+        "describe_instances",
+        {
+            "Reservations": [
+                {
+                    "Instances": [
+                        {"InstanceId": instance_id, "State": {"Name": state}}
+                    ]
+                }
+            ]
+        },
+        {"InstanceIds": [instance_id]},
+    )
+
+
+def test_stopped_notebook_and_bastion_are_started(clients):
+    sagemaker, sagemaker_stub, ec2, ec2_stub = clients
+    # The scripted transitions, one describe per poll
+    notebook(sagemaker_stub, "Stopped")
+    sagemaker_stub.add_response(
+        "start_notebook_instance", {}, {"NotebookInstanceName": "nb"}
+    )
+    notebook(sagemaker_stub, "Pending")
+    notebook(sagemaker_stub, "Pending")
+    notebook(sagemaker_stub, "InService")
+    instance(ec2_stub, "stopped")
+    ec2_stub.add_response("start_instances", {}, {"InstanceIds": ["i-0123"]})
+    instance(ec2_stub, "pending")
+    instance(ec2_stub, "running")
+
+    clock = FakeClock()
+    resumed = resume.wait_ready(
+        sagemaker,
+        ec2,
+        ["nb"],
+        ["i-0123"],
+        clock=clock,
+        sleep=clock.sleep,
+        rand=lambda: 1,
+    )
+    assert resumed == {"nb", "i-0123"}
+    # The bastion is only polled until it is running
+    assert clock.sleeps == [2, 4, 8]
+
+
+def test_ready_notebooks_are_not_resumed(clients):
+    sagemaker, sagemaker_stub, ec2, ec2_stub = clients
+    notebook(sagemaker_stub, "InService")
+    instance(ec2_stub, "running")
+    clock = FakeClock()
+    resumed = resume.wait_ready(
+        sagemaker, ec2, ["nb"], ["i-0123"], clock=clock, sleep=clock.sleep
+    )
+    assert resumed == set()
+    assert clock.sleeps == []
+
+
+def test_waiting_is_bounded_by_the_deadline(clients):
+    sagemaker, sagemaker_stub, ec2, _ = clients
+    for _ in range(8):
+        notebook(sagemaker_stub, "Pending")
+    clock = FakeClock()
+    with pytest.raises(TimeoutError, match=r"nb \(Pending\)"):
+        resume.wait_ready(
+            sagemaker,
+            ec2,
+            ["nb"],
+            timeout=50,
+            clock=clock,
+            sleep=clock.sleep,
+            rand=lambda: 0,
+        )
+    # Jittered down to half, and the last sleep cut at the deadline
+    assert clock.sleeps == [1, 2, 4, 8, 15, 15, 5]
+    assert clock.now == 50
+
+
+def test_wait_does_not_start_stopped_notebooks(clients):
+    sagemaker, sagemaker_stub, ec2, _ = clients
+    notebook(sagemaker_stub, "Stopped")
+    with pytest.raises(RuntimeError, match="notebook nb is Stopped"):
+        resume.wait_ready(sagemaker, ec2, ["nb"], start=False)
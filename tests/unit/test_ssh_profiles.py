@@ -0,0 +1,102 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import obtain_key
+from ssh_profiles import PROFILES, connection_options, load_profile
+
+
+def test_config_profiles_override_and_extend_the_built_in_ones():
+    profiles = {"latency": {"keepalive": 5}, "mine": {"compression": True}}
+    latency = load_profile("latency", profiles)
+    assert latency == dict(PROFILES["latency"], keepalive=5)
+    assert load_profile("mine", profiles)["compression"] is True
+    assert load_profile("mine", profiles)["control_persist"] == "10m"
+
+    with pytest.raises(ValueError):
+        load_profile("missing", profiles)
+    with pytest.raises(ValueError):
+        load_profile("mine", {"mine": {"ciphres": "aes128-ctr"}})
+
+
+def test_multiplexing_can_be_turned_off():
+    options = connection_options(dict(PROFILES["default"], control_persist=0))
+    assert options["ControlMaster"] == "no"
+    assert options["ControlPath"] == "none"
+    assert "ControlPersist" not in options
+
+
+@pytest.mark.skipif(not shutil.which("ssh"), reason="needs the ssh client")
+@pytest.mark.parametrize("name", sorted(PROFILES))
+def test_generated_hosts_are_understood_by_ssh(tmp_path, monkeypatch, name):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    settings = {
+        "key_filepath": str(tmp_path / "key.pem"),
+        "connection": "bastion",
+        "bastion_host_name": "bastion",
+        "bastions": {"bastion": "203.0.113.10"},
+        "notebooks": [{"instance_name": "nb", "host_name": "notebook"}],
+        "profile": load_profile(name),
+        "include_file": None,
+        "ssh_config_file": str(tmp_path / "config"),
+    }
+    obtain_key.write_hosts(
+        settings, obtain_key.host_entries(settings, {"nb": "10.0.1.5"})
+    )
+    assert os.stat(tmp_path / ".ssh" / "sockets").st_mode & 0o777 == 0o700
+
+    output = subprocess.run(
+        ["ssh", "-G", "-F", settings["ssh_config_file"], "notebook"],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    options = dict(line.split(" ", 1) for line in output.splitlines())
+    profile = PROFILES[name]
+    assert options["proxyjump"] == "bastion"
+    assert options["identitiesonly"] == "yes"
+    assert "proxycommand" not in options
+    assert options["controlmaster"] == "auto"
+    # ssh expands ~ from the password database, not $HOME
+    control_dir, socket = os.path.split(options["controlpath"])
+    assert control_dir.endswith("/.ssh/sockets") and len(socket) == 40
+    assert options["serveraliveinterval"] == str(profile["keepalive"])
+    compression = "yes" if profile["compression"] else "no"
+    assert options["compression"] == compression
+    if profile["ciphers"]:
+        assert options["ciphers"] == profile["ciphers"]
+
+
+@pytest.mark.skipif(not shutil.which("ssh"), reason="needs the ssh client")
+def test_instance_connect_hosts_are_understood_by_ssh(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    settings = {
+        "region": "us-east-1",
+        "key_filepath": str(tmp_path / "key.pem"),
+        "connection": "instance-connect",
+        "instance_connect_endpoint_id": "eice-0123",
+        "bastions": {},
+        "notebooks": [{"instance_name": "nb", "host_name": "notebook"}],
+        "profile": load_profile("default"),
+        "include_file": None,
+        "ssh_config_file": str(tmp_path / "config"),
+    }
+    obtain_key.write_hosts(
+        settings, obtain_key.host_entries(settings, {"nb": "10.0.1.5"})
+    )
+    output = subprocess.run(
+        ["ssh", "-G", "-F", settings["ssh_config_file"], "notebook"],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    options = dict(line.split(" ", 1) for line in output.splitlines())
+    assert "proxyjump" not in options
+    # ssh -G prints the command before expanding %h and %p
+    assert options["proxycommand"] == (
+        "aws ec2-instance-connect open-tunnel "
+        "--instance-connect-endpoint-id eice-0123 "
+        "--private-ip-address %h --remote-port %p --region us-east-1"
+    )
@@ -0,0 +1,431 @@
+import multiprocessing
+import os
+import shutil
+import stat
+import subprocess
+
+import pytest
+
+import ssh_utils
+from ssh_utils import ConcurrentModificationError, SSHConfig
+
+HAND_WRITTEN = """\
+# Managed by hand, please keep this comment
+Include config.d/*
+ServerAliveInterval 60
+
+Host github.com
+    HostName github.com
+    IdentityFile ~/.ssh/github
+
+# Work machines
+Host work-*
+    User me
+
+Match host *.internal exec "true"
+    ForwardAgent no
+"""
+
+
+def write(path, text):
+    path.write_text(text)
+    return str(path)
+
+
+def test_round_trip_is_lossless(tmp_path):
+    filename = write(tmp_path / "config", HAND_WRITTEN)
+    config = SSHConfig(filename)
+    config._write_config()
+    assert (tmp_path / "config").read_text() == HAND_WRITTEN
+
+
+def test_hostname_is_not_a_block_header(tmp_path):
+    filename = write(tmp_path / "config", HAND_WRITTEN)
+    config = SSHConfig(filename)
+    assert config.lookup_host("github.com") == {
+        "HostName": "github.com",
+        "IdentityFile": "~/.ssh/github",
+    }
+    assert set(config.config) == {"github.com", "work-*"}
+
+
+def test_add_host_preserves_other_content(tmp_path):
+    filename = write(tmp_path / "config", HAND_WRITTEN)
+    config = SSHConfig(filename)
+    config.add_host("notebook", Hostname="10.0.0.1", User="ec2-user")
+    text = (tmp_path / "config").read_text()
+    assert text.startswith(HAND_WRITTEN)
+    appended = text.replace(HAND_WRITTEN, "", 1)
+    assert appended == (
+        "\nHost notebook\n    Hostname 10.0.0.1\n    User ec2-user\n\n"
+    )
+    assert SSHConfig(filename).lookup_host("notebook")["Hostname"] == (
+        "10.0.0.1"
+    )
+
+
+def test_update_replaces_only_the_block(tmp_path):
+    filename = write(tmp_path / "config", HAND_WRITTEN)
+    config = SSHConfig(filename)
+    config.add_host("github.com", HostName="ssh.github.com", Port="443")
+    expected = HAND_WRITTEN.replace(
+        "    HostName github.com\n    IdentityFile ~/.ssh/github\n",
+        "    HostName ssh.github.com\n    Port 443\n",
+    )
+    assert (tmp_path / "config").read_text() == expected
+
+
+def test_delete_keeps_comments_of_next_block(tmp_path):
+    filename = write(tmp_path / "config", HAND_WRITTEN)
+    config = SSHConfig(filename)
+    config.delete_host("github.com")
+    text = (tmp_path / "config").read_text()
+    assert "github" not in text
+    assert "ServerAliveInterval 60\n\n# Work machines\nHost work-*\n" in text
+
+
+def test_repeated_edits_and_missing_host(tmp_path, capsys):
+    filename = str(tmp_path / "config")
+    config = SSHConfig(filename)
+    config.add_host("a", Hostname="1.1.1.1")
+    config.add_host("b", Hostname="2.2.2.2")
+    config.delete_host("a")
+    config.delete_host("a")
+    config.add_host("b", Hostname="3.3.3.3")
+    assert "Host a not found in config." in capsys.readouterr().out
+    assert (tmp_path / "config").read_text() == (
+        "Host b\n    Hostname 3.3.3.3\n\n"
+    )
+    assert stat.S_IMODE(os.stat(filename).st_mode) == 0o600
+
+
+def test_write_keeps_mode_and_symlink(tmp_path):
+    target = tmp_path / "dotfiles-config"
+    write(target, HAND_WRITTEN)
+    os.chmod(target, 0o644)
+    link = tmp_path / "config"
+    link.symlink_to(target)
+    SSHConfig(str(link)).add_host("n", Hostname="10.0.0.2")
+    assert link.is_symlink()
+    assert "Host n\n" in target.read_text()
+    assert stat.S_IMODE(os.stat(target).st_mode) == 0o644
+    leftovers = [p.name for p in tmp_path.iterdir() if p.suffix == ".tmp"]
+    assert leftovers == []
+
+
+def test_large_config_edit_leaves_other_bytes_untouched(tmp_path):
+    text = "".join(
+        f"Host host-{i}\n    Hostname 10.0.{i // 256}.{i % 256}\n\n"
+        for i in range(10000)
+    )
+    filename = write(tmp_path / "config", text)
+    config = SSHConfig(filename)
+    config.add_host("host-5000", Hostname="192.168.0.1")
+    new_text = (tmp_path / "config").read_text()
+    old_block = "Host host-5000\n    Hostname 10.0.19.136\n"
+    new_block = "Host host-5000\n    Hostname 192.168.0.1\n"
+    assert new_text == text.replace(old_block, new_block)
+    assert len(config._dirty) == 1
+
+
+def test_transaction_writes_once(tmp_path, monkeypatch):
+    filename = write(tmp_path / "config", HAND_WRITTEN)
+    config = SSHConfig(filename)
+    writes = []
+    write_config = config._write_config
+
+    def counting_write():
+        writes.append(1)
+        write_config()
+
+    monkeypatch.setattr(config, "_write_config", counting_write)
+    with config.transaction() as txn:
+        for i in range(20):
+            txn.add_host(f"nb-{i}", Hostname=f"10.0.0.{i}")
+        txn.update_host("github.com", hostname="ssh.github.com")
+        txn.delete_host("work-*")
+    assert writes == [1]
+    reread = SSHConfig(filename)
+    assert len(reread.config) == 21
+    assert reread.lookup_host("github.com") == {
+        "HostName": "ssh.github.com",
+        "IdentityFile": "~/.ssh/github",
+    }
+
+
+def test_transaction_discarded_on_error(tmp_path):
+    filename = write(tmp_path / "config", HAND_WRITTEN)
+    config = SSHConfig(filename)
+    with pytest.raises(KeyError):
+        with config.transaction() as txn:
+            txn.add_host("nb", Hostname="10.0.0.1")
+            raise KeyError("boom")
+    assert (tmp_path / "config").read_text() == HAND_WRITTEN
+
+
+def test_transaction_replays_onto_concurrent_changes(tmp_path):
+    filename = write(tmp_path / "config", HAND_WRITTEN)
+    first = SSHConfig(filename)
+    second = SSHConfig(filename)
+    first.add_host("from-first", Hostname="10.0.0.1")
+    with second.transaction() as txn:
+        txn.add_host("from-second", Hostname="10.0.0.2")
+    assert set(SSHConfig(filename).config) >= {"from-first", "from-second"}
+
+
+def test_strict_transaction_detects_concurrent_changes(tmp_path):
+    filename = write(tmp_path / "config", HAND_WRITTEN)
+    config = SSHConfig(filename)
+    with open(filename, "a") as f:
+        f.write("Host edited-by-hand\n")
+    with pytest.raises(ConcurrentModificationError):
+        with config.transaction(strict=True) as txn:
+            txn.add_host("nb", Hostname="10.0.0.1")
+    assert "Host nb" not in (tmp_path / "config").read_text()
+
+
+def _add_hosts(filename, worker):
+    config = SSHConfig(filename)
+    for i in range(10):
+        with config.transaction() as txn:
+            txn.add_host(f"w{worker}-{i}", Hostname="10.0.0.1")
+
+
+def test_parallel_processes_do_not_lose_writes(tmp_path):
+    filename = write(tmp_path / "config", HAND_WRITTEN)
+    workers = [
+        multiprocessing.Process(target=_add_hosts, args=(filename, w))
+        for w in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    hosts = SSHConfig(filename).config
+    assert all(f"w{w}-{i}" in hosts for w in range(4) for i in range(10))
+    assert (tmp_path / "config").read_text().startswith(HAND_WRITTEN)
+
+
+PATTERNS = """\
+User global
+Host nb-1 !nb-2 nb-*
+    Port 2201
+    IdentityFile ~/.ssh/a
+Host *.example.com
+    HostName %h.proxy
+Match host *.proxy
+    Port 2222
+    User proxied
+Match originalhost other !user global
+    Port 2300
+Host *
+    IdentityFile ~/.ssh/b
+    HostName 10.0.0.9
+"""
+
+RESOLVED = {
+    "nb-1": {
+        "user": "global",
+        "port": "2201",
+        "identityfile": ["~/.ssh/a", "~/.ssh/b"],
+        "hostname": "10.0.0.9",
+    },
+    "NB-2": {
+        "user": "global",
+        "identityfile": ["~/.ssh/b"],
+        "hostname": "10.0.0.9",
+    },
+    "x.example.com": {
+        "user": "global",
+        "hostname": "x.example.com.proxy",
+        "port": "2222",
+        "identityfile": ["~/.ssh/b"],
+    },
+    "other": {
+        "user": "global",
+        "identityfile": ["~/.ssh/b"],
+        "hostname": "10.0.0.9",
+    },
+}
+
+
+def test_resolve_applies_patterns_in_order(tmp_path):
+    config = SSHConfig(write(tmp_path / "config", PATTERNS))
+    for host, expected in RESOLVED.items():
+        assert config.resolve(host) == expected
+
+
+@pytest.mark.skipif(shutil.which("ssh") is None, reason="needs ssh")
+def test_resolve_agrees_with_ssh(tmp_path):
+    filename = write(tmp_path / "config", PATTERNS)
+    config = SSHConfig(filename)
+    for host in RESOLVED:
+        expected = config.resolve(host)
+        output = subprocess.run(
+            ["ssh", "-G", "-F", filename, host],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        reported = {}
+        for line in output.splitlines():
+            key, _, value = line.partition(" ")
+            if key in expected:
+                reported.setdefault(key, []).append(value)
+        for key, value in expected.items():
+            assert reported[key] == (
+                value if key == "identityfile" else [value]
+            )
+
+
+def test_resolve_sees_edits(tmp_path):
+    config = SSHConfig(write(tmp_path / "config", PATTERNS))
+    assert "port" not in config.resolve("fresh")
+    config.add_host("fresh", Port="2000")
+    assert config.resolve("fresh")["port"] == "2000"
+    # Earlier blocks win, so a new block cannot override them
+    config.add_host("nb-1", Port="2000")
+    assert config.resolve("nb-1")["port"] == "2201"
+    config.delete_host("fresh")
+    assert "port" not in config.resolve("fresh")
+
+
+def test_resolve_follows_includes(tmp_path):
+    (tmp_path / "config.d").mkdir()
+    write(tmp_path / "config.d" / "10-nb", "Host nb\n    Port 2201\n")
+    write(tmp_path / "config.d" / "20-all", "Host *\n    Port 2202\n")
+    write(tmp_path / "work", "Host *\n    User worker\n")
+    filename = write(
+        tmp_path / "config",
+        "Include config.d/*\n"
+        "Host work-*\n"
+        f"    Include {tmp_path / 'work'}\n"
+        "    User ignored\n",
+    )
+    config = SSHConfig(filename)
+    assert config.resolve("nb")["port"] == "2201"
+    assert config.resolve("work-1") == {
+        "port": "2202",
+        "user": "worker",
+        "hostname": "work-1",
+    }
+    assert "user" not in config.resolve("other")
+
+
+def test_include_cycle_is_an_error(tmp_path):
+    write(tmp_path / "other", f"Include {tmp_path / 'config'}\n")
+    filename = write(tmp_path / "config", f"Include {tmp_path / 'other'}\n")
+    with pytest.raises(ValueError, match="Include cycle"):
+        SSHConfig(filename).resolve("nb")
+
+
+def test_unchanged_includes_are_not_reparsed(tmp_path, monkeypatch):
+    (tmp_path / "config.d").mkdir()
+    for i in range(3):
+        write(tmp_path / "config.d" / f"{i}", f"Host nb-{i}\n    Port {i}\n")
+    filename = write(tmp_path / "config", "Include config.d/*\n")
+    SSHConfig(filename).resolve("nb-0")
+
+    parsed = []
+    parse = ssh_utils._parse
+    monkeypatch.setattr(
+        ssh_utils, "_parse", lambda data: parsed.append(data) or parse(data)
+    )
+    write(tmp_path / "config.d" / "1", "Host nb-1\n    Port 1001\n")
+    config = SSHConfig(filename)
+    assert config.resolve("nb-1")["port"] == "1001"
+    assert parsed == [b"Host nb-1\n    Port 1001\n"]
+
+
+def test_hosts_can_be_written_to_an_included_fragment(tmp_path):
+    filename = write(tmp_path / "config", HAND_WRITTEN)
+    fragment = SSHConfig(str(tmp_path / "config.d" / "sagemaker-ssh"))
+    with fragment.transaction() as txn:
+        txn.add_host("nb", Hostname="10.0.0.1")
+    for _ in range(2):
+        with SSHConfig(filename).transaction() as txn:
+            txn.add_include("config.d/sagemaker-ssh")
+    text = (tmp_path / "config").read_text()
+    assert text == "Include config.d/sagemaker-ssh\n" + HAND_WRITTEN
+    assert SSHConfig(filename).resolve("nb")["hostname"] == "10.0.0.1"
+
+
+@pytest.mark.parametrize(
+    "key_type, key_format",
+    [
+        ("rsa", "TraditionalOpenSSL"),
+        ("ed25519", "OpenSSH"),
+        ("ed25519", "PKCS8"),
+    ],
+)
+def test_public_key_from_pem_and_openssh_keys(tmp_path, key_type, key_format):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+    if key_type == "rsa":
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    else:
+        key = ed25519.Ed25519PrivateKey.generate()
+    path = tmp_path / "key.pem"
+    path.write_bytes(
+        key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=getattr(serialization.PrivateFormat, key_format),
+            encryption_algorithm=serialization.NoEncryption(),
+        )
+    )
+    public_key = ssh_utils.private_to_public_key(str(path))
+    assert ssh_utils.private_to_public_key(path.read_bytes()) == public_key
+    expected = key.public_key().public_bytes(
+        encoding=serialization.Encoding.OpenSSH,
+        format=serialization.PublicFormat.OpenSSH,
+    )
+    assert public_key == expected.decode() + " bastion-ssh-key"
+
+    if shutil.which("ssh-keygen"):
+        (tmp_path / "key.pub").write_text(public_key + "\n")
+        output = subprocess.run(
+            ["ssh-keygen", "-lf", str(tmp_path / "key.pub")],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+        assert output.split()[1] == ssh_utils.key_fingerprint(public_key)
+
+
+def test_public_key_is_cached_by_key_contents(tmp_path, monkeypatch):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519
+
+    key = ed25519.Ed25519PrivateKey.generate().private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.OpenSSH,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    (tmp_path / "a.pem").write_bytes(key)
+    (tmp_path / "b.pem").write_bytes(key)
+    calls = []
+    load = ssh_utils.load_private_key
+    monkeypatch.setattr(
+        ssh_utils,
+        "load_private_key",
+        lambda data: calls.append(1) or load(data),
+    )
+    first = ssh_utils.private_to_public_key(str(tmp_path / "a.pem"))
+    assert ssh_utils.private_to_public_key(str(tmp_path / "b.pem")) == first
+    assert len(calls) == 1
+
+
+def test_options_given_more_than_once(tmp_path):
+    config = SSHConfig(str(tmp_path / "config"))
+    forwards = ["6006 localhost:6006", "8888 localhost:8888"]
+    config.add_host("notebook", Hostname="10.0.1.5", LocalForward=forwards)
+    assert (tmp_path / "config").read_text().count("LocalForward") == 2
+    with config.transaction() as txn:
+        txn.update_host("notebook", hostname="10.0.1.6")
+    config = SSHConfig(str(tmp_path / "config"))
+    assert config.lookup_host("notebook") == {
+        "Hostname": "10.0.1.6",
+        "LocalForward": forwards,
+    }
+    assert config.resolve("notebook")["localforward"] == forwards
@@ -0,0 +1,377 @@
+import copy
+import json
+
+import aws_cdk as cdk
+from aws_cdk import assertions
+
+from app import build
+from app_config import load_config
+from deploy import dependency_levels, read_stacks
+from stacks.sagemaker_stack import SageMakerStack
+
+ENV = cdk.Environment(account="123456789012", region="us-east-1")
+
+NOTEBOOK = {
+    "name": "gpu-notebook",
+    "append_username": False,
+    "instance_type": "ml.g5.xlarge",
+    "volume_size": 100,
+}
+
+
+def test_notebook_stack_uses_its_notebook_settings():
+    # A fresh App per stack, since an App can only be synthesized once
+    stack = SageMakerStack(
+        cdk.App(), "SageMakerStack-gpu-notebook", notebook=NOTEBOOK, env=ENV
+    )
+    template = assertions.Template.from_stack(stack)
+    template.resource_count_is("AWS::SageMaker::NotebookInstance", 1)
+    template.has_resource_properties(
+        "AWS::SageMaker::NotebookInstance",
+        {
+            "NotebookInstanceName": "gpu-notebook",
+            "InstanceType": "ml.g5.xlarge",
+            "VolumeSizeInGB": 100,
+        },
+    )
+
+
+def test_notebook_name_can_include_the_username(monkeypatch):
+    monkeypatch.setattr("getpass.getuser", lambda: "alice")
+    notebook = dict(NOTEBOOK, append_username=True)
+    stack = SageMakerStack(cdk.App(), "Stack", notebook=notebook, env=ENV)
+    assertions.Template.from_stack(stack).has_resource_properties(
+        "AWS::SageMaker::NotebookInstance",
+        {"NotebookInstanceName": "gpu-notebook-alice"},
+    )
+
+
+def test_key_pair_type_comes_from_the_config():
+    from stacks.key_stack import KeyStack
+
+    config = copy.deepcopy(load_config())
+    config["ssh"]["key_type"] = "ed25519"
+    stack = KeyStack(cdk.App(), "KeyStack", config=config, env=ENV)
+    assertions.Template.from_stack(stack).has_resource_properties(
+        "AWS::EC2::KeyPair", {"KeyType": "ed25519"}
+    )
+
+
+def test_lifecycle_scripts_are_found_outside_the_project_dir(monkeypatch):
+    from stacks.lifecycle_stack import LifecycleStack
+
+    monkeypatch.chdir("/")
+    stack = LifecycleStack(cdk.App(), "LifecycleStack", env=ENV)
+    assertions.Template.from_stack(stack).resource_count_is(
+        "AWS::SageMaker::NotebookInstanceLifecycleConfig", 1
+    )
+
+
+def synth_stacks(config, outdir):
+    """Synthesizes the whole app and returns its stacks, see read_stacks."""
+    app = cdk.App(outdir=str(outdir))
+    build(app, config, ENV)
+    app.synth()
+    return read_stacks(str(outdir))
+
+
+def kind(name):
+    return name.split("-")[0]
+
+
+def test_independent_stacks_deploy_in_parallel(tmp_path):
+    config = copy.deepcopy(load_config())
+    config["notebooks"] = [{"name": "cpu"}, {"name": "gpu"}]
+    levels = dependency_levels(synth_stacks(config, tmp_path))
+    assert [sorted(map(kind, level)) for level in levels] == [
+        ["KeyStack", "NetworkStack"],
+        ["BastionStack", "LifecycleStack"],
+        ["SageMakerStack", "SageMakerStack"],
+    ]
+
+
+def test_notebooks_do_not_wait_for_the_bastion(tmp_path):
+    for stack in synth_stacks(load_config(), tmp_path):
+        if kind(stack["name"]) == "SageMakerStack":
+            assert sorted(map(kind, stack["dependencies"])) == [
+                "KeyStack",
+                "LifecycleStack",
+                "NetworkStack",
+            ]
+
+
+def test_notebooks_authorize_the_key_pair(tmp_path):
+    stacks = build(cdk.App(outdir=str(tmp_path)), load_config(), ENV)
+    by_kind = {kind(name): stack for name, stack in stacks.items()}
+
+    # The lifecycle scripts get the key pair's parameter from the KeyStack
+    lifecycle = assertions.Template.from_stack(by_kind["LifecycleStack"])
+    (config,) = lifecycle.find_resources(
+        "AWS::SageMaker::NotebookInstanceLifecycleConfig"
+    ).values()
+    for hook in ("OnCreate", "OnStart"):
+        content = json.dumps(config["Properties"][hook])
+        assert "export SSH_KEY_PARAMETER='/ec2/keypair/" in content
+        assert "Fn::ImportValue" in content
+
+    # And the notebooks' role may read it
+    notebook = assertions.Template.from_stack(by_kind["SageMakerStack"])
+    notebook.has_resource_properties(
+        "AWS::IAM::Policy",
+        {
+            "PolicyDocument": {
+                "Statement": [
+                    assertions.Match.object_like(
+                        {"Action": "ssm:GetParameter", "Effect": "Allow"}
+                    )
+                ]
+            }
+        },
+    )
+
+
+def network_template(**network):
+    from stacks.network_stack import NetworkStack
+
+    config = dict(load_config(), network=network)
+    stack = NetworkStack(cdk.App(), "NetworkStack", config=config, env=ENV)
+    return assertions.Template.from_stack(stack)
+
+
+def test_network_defaults_to_nat_gateways_without_endpoints():
+    template = network_template()
+    template.resource_count_is("AWS::EC2::NatGateway", 2)
+    template.resource_count_is("AWS::EC2::VPCEndpoint", 0)
+
+
+def test_endpoints_mode_only_lets_the_notebooks_in():
+    template = network_template(vpc_endpoints=True)
+    endpoints = template.find_resources("AWS::EC2::VPCEndpoint")
+    types = sorted(
+        endpoint["Properties"].get("VpcEndpointType", "Gateway")
+        for endpoint in endpoints.values()
+    )
+    assert types == ["Gateway"] + ["Interface"] * 6
+    template.has_resource_properties(
+        "AWS::EC2::VPCEndpoint",
+        {
+            "ServiceName": {
+                "Fn::Join": [
+                    "",
+                    ["com.amazonaws.", {"Ref": "AWS::Region"}, ".s3"],
+                ]
+            },
+            "VpcEndpointType": "Gateway",
+        },
+    )
+    template.has_resource_properties(
+        "AWS::EC2::VPCEndpoint",
+        {"ServiceName": "com.amazonaws.us-east-1.ecr.dkr"},
+    )
+
+    # The endpoints' security group only allows HTTPS from the notebooks
+    (endpoint_group,) = [
+        name
+        for name, group in template.find_resources(
+            "AWS::EC2::SecurityGroup"
+        ).items()
+        if group["Properties"]["GroupDescription"].startswith("HTTPS")
+    ]
+    (ingress,) = template.find_resources(
+        "AWS::EC2::SecurityGroupIngress",
+        {
+            "Properties": {
+                "GroupId": {"Fn::GetAtt": [endpoint_group, "GroupId"]}
+            }
+        },
+    ).values()
+    source = ingress["Properties"]["SourceSecurityGroupId"]["Fn::GetAtt"]
+    assert ingress["Properties"]["FromPort"] == 443
+    assert source[0].startswith("SG2")
+
+
+def test_nat_less_network_has_isolated_private_subnets():
+    template = network_template(vpc_endpoints=True, nat_gateway=False)
+    template.resource_count_is("AWS::EC2::NatGateway", 0)
+    subnets = template.find_resources("AWS::EC2::Subnet").values()
+    assert sorted(
+        tag["Value"]
+        for subnet in subnets
+        for tag in subnet["Properties"]["Tags"]
+        if tag["Key"] == "aws-cdk:subnet-type"
+    ) == ["Isolated", "Isolated", "Public", "Public"]
+
+
+def test_notebooks_can_go_without_direct_internet_access():
+    notebook = dict(NOTEBOOK, direct_internet_access=False)
+    stack = SageMakerStack(cdk.App(), "Stack", notebook=notebook, env=ENV)
+    assertions.Template.from_stack(stack).has_resource_properties(
+        "AWS::SageMaker::NotebookInstance",
+        {"DirectInternetAccess": "Disabled"},
+    )
+
+
+def test_instance_connect_endpoint_replaces_the_bastion(tmp_path):
+    config = copy.deepcopy(load_config())
+    config["ssh"]["connection"] = "instance-connect"
+    stacks = build(cdk.App(outdir=str(tmp_path)), config, ENV)
+    by_kind = {kind(name): stack for name, stack in stacks.items()}
+    assert "BastionStack" not in by_kind
+
+    template = assertions.Template.from_stack(by_kind["InstanceConnectStack"])
+    template.resource_count_is("AWS::EC2::InstanceConnectEndpoint", 1)
+    template.resource_count_is("AWS::EC2::Instance", 0)
+    template.resource_count_is("AWS::EC2::EIP", 0)
+    template.has_output("EndpointID", {})
+
+    # The endpoint's security group doesn't take SSH from anywhere
+    network = assertions.Template.from_stack(by_kind["NetworkStack"])
+    for group in network.find_resources("AWS::EC2::SecurityGroup").values():
+        for rule in group["Properties"].get("SecurityGroupIngress", []):
+            assert rule.get("CidrIp") != "0.0.0.0/0"
+
+
+def bastion_template(tmp_path, bastions):
+    config = copy.deepcopy(load_config())
+    config["ec2"]["bastions"] = bastions
+    app = cdk.App(outdir=str(tmp_path / str(bastions)))
+    stacks = build(app, config, ENV)
+    by_kind = {kind(name): stack for name, stack in stacks.items()}
+    return assertions.Template.from_stack(by_kind["BastionStack"])
+
+
+def test_bastions_spread_over_the_azs(tmp_path):
+    template = bastion_template(tmp_path, 3)
+    template.resource_count_is("AWS::EC2::EIP", 3)
+    for output in ["PublicIP", "PublicIP2", "PublicIP3"]:
+        template.has_output(output, {})
+
+    # The first bastion keeps its ID, so that adding bastions doesn't
+    # replace it
+    instances = template.find_resources("AWS::EC2::Instance")
+    single = bastion_template(tmp_path, 1).find_resources("AWS::EC2::Instance")
+    assert len(instances) == 3 and set(single) <= set(instances)
+    subnets = [
+        json.dumps(instance["Properties"]["SubnetId"])
+        for instance in instances.values()
+    ]
+    assert len(set(subnets)) == 2
+
+
+def test_notebooks_mount_the_shared_file_system(tmp_path):
+    network_template().resource_count_is("AWS::EFS::FileSystem", 0)
+
+    config = copy.deepcopy(load_config())
+    config["efs"] = {"throughput_mode": "provisioned", "provisioned_mibps": 64}
+    stacks = build(cdk.App(outdir=str(tmp_path)), config, ENV)
+    by_kind = {kind(name): stack for name, stack in stacks.items()}
+    network = assertions.Template.from_stack(by_kind["NetworkStack"])
+    network.has_resource_properties(
+        "AWS::EFS::FileSystem",
+        {
+            "Encrypted": True,
+            "ThroughputMode": "provisioned",
+            "ProvisionedThroughputInMibps": 64,
+        },
+    )
+    # A mount target in each private subnet
+    targets = network.find_resources("AWS::EFS::MountTarget").values()
+    subnets = [target["Properties"]["SubnetId"]["Ref"] for target in targets]
+    assert len(subnets) == 2
+    assert all(subnet.startswith("MyVPCPrivate") for subnet in subnets)
+
+    # Only the notebooks' security group can reach it, over NFS
+    (ingress,) = [
+        ingress["Properties"]
+        for ingress in network.find_resources(
+            "AWS::EC2::SecurityGroupIngress"
+        ).values()
+        if ingress["Properties"]["GroupId"]["Fn::GetAtt"][0].startswith("Efs")
+    ]
+    assert ingress["FromPort"] == ingress["ToPort"] == 2049
+    assert ingress["SourceSecurityGroupId"]["Fn::GetAtt"][0].startswith("SG2")
+
+    # The notebooks mount it at start
+    lifecycle = json.dumps(
+        assertions.Template.from_stack(by_kind["LifecycleStack"]).to_json()
+    )
+    assert "export EFS_DNS_NAME=" in lifecycle
+    assert "efs-mount.sh" in lifecycle
+
+
+def test_environments_do_not_share_stack_or_export_names(tmp_path):
+    stacks = build(
+        cdk.App(outdir=str(tmp_path)), load_config(), ENV, namespace="prod"
+    )
+    assert all(
+        stack.stack_name == f"prod-{name}" for name, stack in stacks.items()
+    )
+    by_kind = {kind(name): stack for name, stack in stacks.items()}
+
+    def exports(kind):
+        template = assertions.Template.from_stack(by_kind[kind])
+        return sorted(
+            output["Export"]["Name"]
+            for output in template.find_outputs("*").values()
+            if "Export" in output
+        )
+
+    # Including the exports CDK adds for references between stacks
+    names = exports("KeyStack") + exports("NetworkStack")
+    assert all(name.startswith("prod-") for name in names)
+    assert {
+        "prod-keypair-name",
+        "prod-keypair-parameter-name",
+        "prod-MyVPC-PrivateSubnet2",
+        "prod-MyVPC-SecurityGroup2",
+        "prod-MyVPC-VPCID",
+    } <= set(names)
+
+    def imports(kind):
+        template = json.dumps(
+            assertions.Template.from_stack(by_kind[kind]).to_json()
+        )
+        return {
+            name
+            for name in names
+            if f'{{"Fn::ImportValue": "{name}"}}' in template
+        }
+
+    assert "prod-keypair-name" in imports("BastionStack")
+    assert imports("SageMakerStack") >= {
+        "prod-MyVPC-PrivateSubnet2",
+        "prod-MyVPC-SecurityGroup2",
+    }
+
+
+def test_environments_do_not_share_resource_names(monkeypatch, tmp_path):
+    monkeypatch.setattr("getpass.getuser", lambda: "alice")
+    config = load_config()
+    stacks = build(cdk.App(outdir=str(tmp_path)), config, ENV, "prod")
+    by_kind = {kind(name): stack for name, stack in stacks.items()}
+
+    def properties(kind, resource_type):
+        template = assertions.Template.from_stack(by_kind[kind])
+        return [
+            resource["Properties"]
+            for resource in template.find_resources(resource_type).values()
+        ]
+
+    (key_pair,) = properties("KeyStack", "AWS::EC2::KeyPair")
+    assert key_pair["KeyName"] == f"prod-{config['ssh']['key_name']}"
+    lifecycle_name = f"prod-{config['lifecycle']['name']}"
+    (lifecycle,) = properties(
+        "LifecycleStack", "AWS::SageMaker::NotebookInstanceLifecycleConfig"
+    )
+    assert lifecycle["NotebookInstanceLifecycleConfigName"] == lifecycle_name
+    (notebook,) = properties(
+        "SageMakerStack", "AWS::SageMaker::NotebookInstance"
+    )
+    assert notebook["NotebookInstanceName"] == (
+        f"prod-{config['notebook']['name']}-alice"
+    )
+    assert notebook["LifecycleConfigName"] == lifecycle_name
+    groups = properties("NetworkStack", "AWS::EC2::SecurityGroup")
+    assert {"prod-sg1", "prod-sg2"} <= {
+        group.get("GroupName") for group in groups
+    }
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import random
+import socket
+import sys
+
+from tunnel import (
+    Listener,
+    Transport,
+    TunnelDaemon,
+    backoff_delay,
+    transport_command,
+)
+
+# A SOCKS5 proxy standing in for "ssh -D", which connects directly
+SOCKS_PROXY = """
+import asyncio, struct, sys
+
+async def pipe(reader, writer):
+    while data := await reader.read(65536):
+        writer.write(data)
+        await writer.drain()
+    writer.write_eof()
+
+async def handle(reader, writer):
+    try:
+        await reader.readexactly((await reader.readexactly(2))[1])
+    except asyncio.IncompleteReadError:
+        return  # A readiness check
+    writer.write(b"\\x05\\x00")
+    _, _, _, address_type = await reader.readexactly(4)
+    if address_type == 1:
+        host = ".".join(map(str, await reader.readexactly(4)))
+    else:
+        host = (await reader.readexactly((await reader.readexactly(1))[0]))
+        host = host.decode()
+    (port,) = struct.unpack("!H", await reader.readexactly(2))
+    try:
+        target = await asyncio.open_connection(host, port)
+    except OSError:
+        writer.write(b"\\x05\\x05\\x00\\x01" + bytes(6))
+        writer.close()
+        return
+    writer.write(b"\\x05\\x00\\x00\\x01" + bytes(6))
+    await asyncio.gather(pipe(reader, target[1]), pipe(target[0], writer))
+
+async def main():
+    server = await asyncio.start_server(handle, "127.0.0.1", int(sys.argv[1]))
+    await server.serve_forever()
+
+asyncio.run(main())
+"""
+
+
+def free_port():
+    """Returns a free port below the ephemeral range, so that the servers
+    the tests bind to port 0 can't take it before the proxy starts."""
+    while True:
+        port = random.randrange(20000, 32768)
+        with socket.socket() as sock:
+            try:
+                sock.bind(("127.0.0.1", port))
+            except OSError:
+                continue
+            return port
+
+
+async def echo_server():
+    async def echo(reader, writer):
+        while data := await reader.read(65536):
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(echo, "127.0.0.1", 0)
+
+
+async def exchange(port, data):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(data)
+    writer.write_eof()
+    received = await reader.read()
+    writer.close()
+    return received
+
+
+async def fetch_stats(port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET / HTTP/1.0\r\n\r\n")
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+
+def stand_in_transport(**kwargs):
+    port = free_port()
+    command = [sys.executable, "-c", SOCKS_PROXY, str(port)]
+    return Transport(command, port, **kwargs)
+
+
+def test_backoff_doubles_with_jitter():
+    delays = [
+        backoff_delay(attempt, 1, 10, rand=lambda: 1) for attempt in range(6)
+    ]
+    assert delays == [1, 2, 4, 8, 10, 10]
+    assert backoff_delay(3, 1, 10, rand=lambda: 0) == 4
+
+
+def test_transport_command_is_one_unshared_connection():
+    command = transport_command("bastion", 1080, config_file="config")
+    assert command[:4] == ["ssh", "-N", "-D", "127.0.0.1:1080"]
+    assert "ControlPath=none" in command
+    assert command[-1] == "bastion"
+
+
+def test_channels_are_relayed_and_counted():
+    async def run():
+        echo = await echo_server()
+        echo_port = echo.sockets[0].getsockname()[1]
+        listeners = [Listener("notebook", 0, "127.0.0.1", echo_port)]
+        daemon = TunnelDaemon(stand_in_transport(), listeners, rtt_interval=0)
+        await daemon.start()
+        try:
+            port = listeners[0].local_port
+            payloads = [bytes([i]) * 100_000 for i in range(10)]
+            received = await asyncio.gather(
+                *(exchange(port, payload) for payload in payloads)
+            )
+            assert received == payloads
+            await daemon.measure_rtt()
+
+            stats = await fetch_stats(daemon.stats_port)
+            assert stats["transport"]["state"] == "connected"
+            assert stats["channels"]["total"] == 10
+            assert stats["bytes"] == {"sent": 1_000_000, "received": 1_000_000}
+            assert stats["rtt_ms"]["last"] > 0
+        finally:
+            await daemon.stop()
+            echo.close()
+
+    asyncio.run(run())
+
+
+def test_transport_reconnects_after_a_drop():
+    async def run():
+        echo = await echo_server()
+        echo_port = echo.sockets[0].getsockname()[1]
+        listeners = [Listener("notebook", 0, "127.0.0.1", echo_port)]
+        transport = stand_in_transport(min_backoff=0.05, max_backoff=0.1)
+        daemon = TunnelDaemon(transport, listeners, rtt_interval=0)
+        await daemon.start()
+        try:
+            port = listeners[0].local_port
+            assert await exchange(port, b"before") == b"before"
+            transport.disconnect()
+            # Connections wait for the transport to come back
+            assert await exchange(port, b"after") == b"after"
+            assert transport.connects == 2
+        finally:
+            await daemon.stop()
+            echo.close()
+        assert transport.state == "stopped"
+
+    asyncio.run(run())
+
+
+def test_failed_channels_are_counted():
+    async def run():
+        listeners = [Listener("notebook", 0, "127.0.0.1", free_port())]
+        daemon = TunnelDaemon(stand_in_transport(), listeners, rtt_interval=0)
+        await daemon.start()
+        try:
+            assert await exchange(listeners[0].local_port, b"data") == b""
+            assert daemon.stats()["channels"]["failed"] == 1
+        finally:
+            await daemon.stop()
+
+    asyncio.run(run())
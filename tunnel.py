@@ -0,0 +1,406 @@
+"""
+A long-lived local tunnel to the notebooks through the bastion.
+
+The daemon keeps one authenticated ssh connection to the bastion, with
+dynamic forwarding (``ssh -D``) enabled, and listens on local ports: one
+per notebook for SSH, and one per forwarded notebook service. Every
+accepted connection becomes a channel over that one connection, opened
+with a SOCKS5 request to the ssh process, so no ssh process is started and
+no handshake with the bastion is made per connection.
+
+If the bastion connection drops, it is re-established with exponential
+backoff and jitter. A small HTTP endpoint reports the transport's state,
+the channels, the bytes relayed and the channel open round-trip time as
+JSON.
+"""
+
+import asyncio
+import contextlib
+import ipaddress
+import json
+import random
+import struct
+import time
+
+# Bytes read at a time when relaying
+CHUNK_SIZE = 64 * 1024
+
+
+def transport_command(bastion_host, socks_port, config_file=None):
+    """Returns the ssh command of the connection to the bastion.
+
+    Connection sharing is turned off, this connection is the shared one.
+    """
+    command = ["ssh", "-N", "-D", f"127.0.0.1:{socks_port}"]
+    if config_file:
+        command += ["-F", config_file]
+    for option in (
+        "ExitOnForwardFailure=yes",
+        "ControlMaster=no",
+        "ControlPath=none",
+        "ServerAliveInterval=15",
+        "ServerAliveCountMax=3",
+    ):
+        command += ["-o", option]
+    return command + [bastion_host]
+
+
+def backoff_delay(attempt, min_delay=1.0, max_delay=60.0, rand=random.random):
+    """Returns the delay before reconnect ``attempt`` (counted from 0).
+
+    The delay doubles with each attempt up to ``max_delay``, and is
+    randomly reduced by up to half so that clients don't retry in step.
+    """
+    delay = min(max_delay, min_delay * 2**attempt)
+    return delay * (0.5 + rand() / 2)
+
+
+async def socks_connect(socks_port, host, port):
+    """Opens a connection to ``host:port`` through a SOCKS5 proxy.
+
+    Returns
+    -------
+    reader, writer : asyncio.StreamReader, asyncio.StreamWriter
+        The connection, past the SOCKS handshake.
+    """
+    reader, writer = await asyncio.open_connection("127.0.0.1", socks_port)
+    try:
+        # No authentication
+        writer.write(b"\x05\x01\x00")
+        if await reader.readexactly(2) != b"\x05\x00":
+            raise ConnectionError("SOCKS proxy refused the handshake")
+        try:
+            address = b"\x01" + ipaddress.IPv4Address(host).packed
+        except ValueError:
+            name = host.encode("idna")
+            address = b"\x03" + bytes([len(name)]) + name
+        writer.write(b"\x05\x01\x00" + address + struct.pack("!H", port))
+        _, status, _, address_type = await reader.readexactly(4)
+        if status != 0:
+            raise ConnectionError(
+                f"Channel to {host}:{port} failed with SOCKS status {status}"
+            )
+        if address_type == 1:
+            await reader.readexactly(4 + 2)
+        elif address_type == 4:
+            await reader.readexactly(16 + 2)
+        else:
+            (length,) = await reader.readexactly(1)
+            await reader.readexactly(length + 2)
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+
+class Transport:
+    """
+    The one connection to the bastion: an ``ssh -D`` process, restarted
+    with backoff when it exits.
+
+    Parameters
+    ----------
+    command : list
+        The command that runs the SOCKS proxy, see ``transport_command``.
+    socks_port : int
+        The local port the command's SOCKS proxy listens on.
+    min_backoff, max_backoff : float
+        The range of the delay between reconnect attempts, in seconds.
+    stable_after : float
+        After this many seconds up, the next drop starts the backoff over.
+    """
+
+    def __init__(
+        self,
+        command,
+        socks_port,
+        min_backoff=1.0,
+        max_backoff=60.0,
+        stable_after=30.0,
+    ):
+        self.command = command
+        self.socks_port = socks_port
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.state = "starting"
+        self.connects = 0
+        self.connected_at = None
+        self.process = None
+        self._ready = asyncio.Event()
+
+    async def _wait_for_proxy(self, timeout=30.0):
+        """Waits until the SOCKS proxy accepts connections.
+
+        Returns False if the process exited first.
+        """
+        deadline = time.monotonic() + timeout
+        while self.process.returncode is None:
+            try:
+                _, writer = await asyncio.open_connection(
+                    "127.0.0.1", self.socks_port
+                )
+            except OSError:
+                if time.monotonic() > deadline:
+                    return False
+                await asyncio.sleep(0.05)
+                continue
+            writer.close()
+            return True
+        return False
+
+    async def run(self):
+        """Keeps the connection up until cancelled."""
+        attempt = 0
+        try:
+            while True:
+                self.state = "connecting"
+                self.process = await asyncio.create_subprocess_exec(
+                    *self.command, stdin=asyncio.subprocess.DEVNULL
+                )
+                started = time.monotonic()
+                if await self._wait_for_proxy():
+                    self.state = "connected"
+                    self.connects += 1
+                    self.connected_at = time.time()
+                    self._ready.set()
+                elif self.process.returncode is None:
+                    self.process.terminate()
+                await self.process.wait()
+                self._ready.clear()
+                self.connected_at = None
+                if time.monotonic() - started > self.stable_after:
+                    attempt = 0
+                self.state = "backoff"
+                await asyncio.sleep(
+                    backoff_delay(attempt, self.min_backoff, self.max_backoff)
+                )
+                attempt += 1
+        finally:
+            self.state = "stopped"
+            if self.process and self.process.returncode is None:
+                self.process.terminate()
+                await self.process.wait()
+
+    def disconnect(self):
+        """Drops the current connection, which is then re-established."""
+        # New channels wait for the next connection
+        self._ready.clear()
+        if self.process and self.process.returncode is None:
+            self.process.terminate()
+
+    async def open_channel(self, host, port, timeout=30.0):
+        """Opens a channel to ``host:port``, waiting for the connection."""
+        await asyncio.wait_for(self._ready.wait(), timeout)
+        return await asyncio.wait_for(
+            socks_connect(self.socks_port, host, port), timeout
+        )
+
+
+class Listener:
+    """A local port whose connections are relayed to ``host:port``."""
+
+    def __init__(self, name, local_port, host, port):
+        self.name = name
+        self.local_port = local_port
+        self.host = host
+        self.port = port
+        self.open = 0
+        self.total = 0
+        self.failed = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "local_port": self.local_port,
+            "target": f"{self.host}:{self.port}",
+            "open": self.open,
+            "total": self.total,
+            "failed": self.failed,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+        }
+
+
+class TunnelDaemon:
+    """
+    Relays the connections to the listeners over the transport, and
+    serves the stats.
+
+    Parameters
+    ----------
+    transport : Transport
+        The connection to the bastion.
+    listeners : list
+        The ``Listener`` of each local port.
+    stats_port : int
+        The local port of the stats endpoint, 0 for any free port.
+    rtt_interval : float
+        How often to measure the channel open round-trip time, in seconds,
+        by opening a channel to the first listener's target.
+    """
+
+    def __init__(self, transport, listeners, stats_port=0, rtt_interval=30.0):
+        self.transport = transport
+        self.listeners = listeners
+        self.stats_port = stats_port
+        self.rtt_interval = rtt_interval
+        self.rtt = []
+        self.started_at = None
+        self._servers = []
+        self._tasks = []
+        # The running relays. The event loop only keeps weak references to
+        # tasks, and a relay whose streams are all idle is otherwise
+        # unreachable, so the garbage collector could destroy it and close
+        # its connections mid-transfer.
+        self._relays = set()
+
+    async def start(self):
+        """Starts the transport, the listeners and the stats endpoint."""
+        self.started_at = time.time()
+        self._tasks.append(asyncio.create_task(self.transport.run()))
+        for listener in self.listeners:
+            server = await asyncio.start_server(
+                lambda r, w, listener=listener: self._relay(listener, r, w),
+                "127.0.0.1",
+                listener.local_port,
+            )
+            listener.local_port = server.sockets[0].getsockname()[1]
+            self._servers.append(server)
+        stats_server = await asyncio.start_server(
+            self._serve_stats, "127.0.0.1", self.stats_port
+        )
+        self.stats_port = stats_server.sockets[0].getsockname()[1]
+        self._servers.append(stats_server)
+        if self.listeners and self.rtt_interval:
+            self._tasks.append(asyncio.create_task(self._probe_rtt()))
+
+    async def stop(self):
+        """Closes the listeners and the transport."""
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def run(self):
+        """Runs until cancelled, e.g. by Ctrl-C."""
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.stop()
+
+    async def _pipe(self, reader, writer, listener, attribute):
+        try:
+            while True:
+                data = await reader.read(CHUNK_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+                setattr(
+                    listener,
+                    attribute,
+                    getattr(listener, attribute) + len(data),
+                )
+                await writer.drain()
+            if writer.can_write_eof():
+                writer.write_eof()
+        except (ConnectionError, OSError):
+            pass
+
+    async def _relay(self, listener, client_reader, client_writer):
+        relay = asyncio.current_task()
+        self._relays.add(relay)
+        listener.open += 1
+        listener.total += 1
+        try:
+            try:
+                reader, writer = await self.transport.open_channel(
+                    listener.host, listener.port
+                )
+            except (ConnectionError, OSError, asyncio.TimeoutError):
+                listener.failed += 1
+                return
+            try:
+                await asyncio.gather(
+                    self._pipe(client_reader, writer, listener, "bytes_sent"),
+                    self._pipe(
+                        reader, client_writer, listener, "bytes_received"
+                    ),
+                )
+            finally:
+                writer.close()
+        finally:
+            listener.open -= 1
+            client_writer.close()
+            self._relays.discard(relay)
+
+    async def measure_rtt(self):
+        """Returns the time to open a channel through the transport."""
+        listener = self.listeners[0]
+        start = time.perf_counter()
+        _, writer = await self.transport.open_channel(
+            listener.host, listener.port
+        )
+        rtt = time.perf_counter() - start
+        writer.close()
+        self.rtt = (self.rtt + [rtt])[-20:]
+        return rtt
+
+    async def _probe_rtt(self):
+        while True:
+            with contextlib.suppress(
+                ConnectionError, OSError, asyncio.TimeoutError
+            ):
+                await self.measure_rtt()
+            await asyncio.sleep(self.rtt_interval)
+
+    def stats(self):
+        """Returns the daemon's stats as a JSON-serializable dict."""
+        listeners = [listener.stats() for listener in self.listeners]
+        rtt_ms = [rtt * 1e3 for rtt in self.rtt]
+        return {
+            "uptime": time.time() - self.started_at,
+            "transport": {
+                "state": self.transport.state,
+                "connects": self.transport.connects,
+                "connected_at": self.transport.connected_at,
+            },
+            "channels": {
+                "open": sum(listener["open"] for listener in listeners),
+                "total": sum(listener["total"] for listener in listeners),
+                "failed": sum(listener["failed"] for listener in listeners),
+            },
+            "bytes": {
+                "sent": sum(listener["bytes_sent"] for listener in listeners),
+                "received": sum(
+                    listener["bytes_received"] for listener in listeners
+                ),
+            },
+            "rtt_ms": {
+                "last": rtt_ms[-1] if rtt_ms else None,
+                "mean": sum(rtt_ms) / len(rtt_ms) if rtt_ms else None,
+            },
+            "listeners": listeners,
+        }
+
+    async def _serve_stats(self, reader, writer):
+        """Answers any HTTP request with the stats."""
+        try:
+            while (await reader.readline()).strip():
+                pass
+            body = json.dumps(self.stats(), indent=2).encode()
+            writer.write(
+                b"HTTP/1.0 200 OK\r\n"
+                b"Content-Type: application/json\r\n"
+                b"Content-Length: %d\r\n\r\n" % len(body) + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()